@@ -1,7 +1,11 @@
 import datetime
+import heapq
 import logging
+import queue
+import threading
 import typing
 
+import numpy as np
 import pandas as pd
 from atpy.data.ts_util import overlap_by_symbol
 
@@ -21,14 +25,29 @@ class DataReplay(object):
 
         self._data = dict()
 
-        self._timeline = None
+        # sorted unique timestamps (int64 array and DatetimeIndex) of each source with the row offsets of each timestamp
+        # and position of the first timestamp after the current time
+        self._timestamps = dict()
+        self._cursors = dict()
+
+        # (next timestamp, source order, source name) for each source with remaining timestamps
+        self._heap = list()
 
         self._current_time = None
 
         sources = dict()
+        self._order = dict()
+
+        # stop event of the prefetch thread of each source with read_ahead > 0
+        self._prefetch_stops = dict()
 
-        for (iterator, name, historical_depth, listeners) in self._sources_defs:
-            sources[name] = (iter(iterator), historical_depth, listeners)
+        for (iterator, name, historical_depth, listeners, read_ahead) in self._sources_defs:
+            iterator = iter(iterator)
+            if read_ahead > 0:
+                iterator, self._prefetch_stops[name] = self._prefetch(iterator, historical_depth, read_ahead)
+
+            sources[name] = (iterator, historical_depth, listeners, read_ahead)
+            self._order[name] = len(self._order)
 
         self._sources = sources
 
@@ -36,80 +55,194 @@ class DataReplay(object):
 
     def __next__(self):
         # delete "expired" dataframes and obtain new data from the providers
-        for e, (dp, historical_depth, listeners) in dict(self._sources).items():
-            if e not in self._data or \
-                    (self._current_time is not None and self._get_datetime_level(self._data[e].index)[-1] <= self._current_time):
-                self._timeline = None
+        refreshed = False
+        for e, (dp, historical_depth, listeners, read_ahead) in dict(self._sources).items():
+            if e not in self._data or self._cursors[e] == len(self._timestamps[e][0]):
+                refreshed = True
 
                 now = datetime.datetime.now()
-                try:
-                    df = next(dp)
-                    while df is not None and df.empty:
+                if read_ahead > 0:
+                    # the prefetch thread provides chunks, which are already overlapped and prepared
+                    chunk = next(dp, None)
+                else:
+                    try:
                         df = next(dp)
-                except StopIteration:
-                    df = None
+                        while df is not None and df.empty:
+                            df = next(dp)
+                    except StopIteration:
+                        df = None
+
+                    # prepend old data if exists
+                    chunk = self._prepare(overlap_by_symbol(self._data[e], df, historical_depth) if e in self._data and historical_depth > 0 else df) if df is not None else None
 
-                if df is not None:
+                if chunk is not None:
                     logging.getLogger(__name__).debug('Obtained data ' + str(e) + ' in ' + str(datetime.datetime.now() - now))
 
-                    # prepend old data if exists
-                    self._data[e] = overlap_by_symbol(self._data[e], df, historical_depth) if e in self._data and historical_depth > 0 else df
+                    self._data[e], timestamps = chunk
+
+                    self._schedule(e, timestamps)
 
                     if listeners is not None:
                         listeners({'type': 'pre_data', e + '_full': self._data[e]})
                 else:
                     if e in self._data:
                         del self._data[e]
+                        del self._timestamps[e]
+                        del self._cursors[e]
 
                     del self._sources[e]
 
-        # build timeline
-        if self._timeline is None and self._data:
-            now = datetime.datetime.now()
+        if refreshed and len({t[1].tz for t in self._timestamps.values()}) > 1:
+            raise Exception("Multiple timezones detected")
 
-            indices = [self._get_datetime_level(df.index) for df in self._data.values()]
-            tzs = {ind.tz for ind in indices}
+        # produce results
+        if self._heap:
+            current_time, _, e = heapq.heappop(self._heap)
+            current = [e]
 
-            if len(tzs) > 1:
-                raise Exception("Multiple timezones detected")
+            while self._heap and self._heap[0][0] == current_time:
+                current.append(heapq.heappop(self._heap)[2])
 
-            ind = indices[0].union_many(indices[1:]).unique().sort_values()
+            self._current_time = current_time
 
-            self._timeline = pd.DataFrame(index=ind)
+            result = dict()
 
-            for e, df in self._data.items():
-                ind = self._get_datetime_level(df.index)
-                self._timeline[e] = False
-                self._timeline.loc[ind, e] = True
+            for e in [e for e in self._data if e in current]:
+                _, ind, bgn, end = self._timestamps[e]
+                i = self._cursors[e]
 
-            logging.getLogger(__name__).debug('Built timeline in ' + str(datetime.datetime.now() - now))
+                if 'timestamp' not in result:
+                    result['timestamp'] = ind[i].to_pydatetime()
 
-        # produce results
-        if self._timeline is not None:
-            result = dict()
+                historical_depth = self._sources[e][1]
+                result[e] = self._data[e].iloc[bgn[max(0, i - historical_depth)]:end[i]]
+
+                self._advance(e)
 
-            if self._current_time is None or self._current_time < self._timeline.index[0]:
-                self._current_time, current_index = self._timeline.index[0], 0
-            elif self._current_time in self._timeline.index:
-                current_index = self._timeline.index.get_loc(self._current_time) + 1
-                self._current_time = self._timeline.index[current_index]
+            return {'timestamp': result.pop('timestamp'), **result}
+        else:
+            raise StopIteration()
+
+    @staticmethod
+    def _prepare(df):
+        """
+        Compute the sorted unique timestamps of a chunk. For each timestamp, the first and last + 1 row positions are precomputed,
+        so that the historical windows are obtained with iloc. If necessary, the rows are sorted by timestamp
+        :param df: chunk
+        :return: tuple of (chunk, (int64 timestamps, DatetimeIndex, first row positions, last row positions + 1))
+        """
+        ind = DataReplay._get_datetime_level(df.index)
+        if not ind.is_monotonic_increasing or not ind.is_unique:
+            ind = ind.unique().sort_values()
+
+        timestamps = ind.asi8
+
+        rows = DataReplay._get_datetime_values(df.index)
+        if not (rows[:-1] <= rows[1:]).all():
+            order = np.argsort(rows, kind='mergesort')
+            df = df.iloc[order]
+            rows = rows[order]
+
+        return df, (timestamps, ind, np.searchsorted(rows, timestamps, side='left'), np.searchsorted(rows, timestamps, side='right'))
+
+    @staticmethod
+    def _prefetch(iterator, historical_depth: int, read_ahead: int):
+        """
+        Obtain, overlap and prepare the chunks of a source in a background thread
+        :param iterator: data provider iterator
+        :param historical_depth: historical depth of the source
+        :param read_ahead: maximum number of prepared chunks waiting to be replayed
+        :return: (generator over the prepared chunks, stop event). The thread exits, once the generator is closed or the event is set
+        """
+        q = queue.Queue(maxsize=read_ahead)
+        stop = threading.Event()
+
+        def put(item):
+            """
+            :return: False if the replay was stopped before the item was queued
+            """
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+
+            return False
+
+        def produce():
+            try:
+                prev = None
+                for df in iterator:
+                    if df is None or stop.is_set():
+                        break
+                    elif df.empty:
+                        continue
+
+                    # prepend old data if exists. The previous chunk is kept as it was before the pre_data listeners, which run on the replay thread
+                    df, timestamps = DataReplay._prepare(overlap_by_symbol(prev, df, historical_depth) if prev is not None and historical_depth > 0 else df)
+                    prev = df
+
+                    if not put((df.copy(deep=False), timestamps)):
+                        return
+            except Exception as err:
+                logging.getLogger(__name__).exception(err)
+                put(err)
             else:
-                self._current_time = self._timeline.loc[self._timeline.index > self._current_time].iloc[0].name
-                current_index = self._timeline.index.get_loc(self._current_time)
+                put(None)
 
-            result['timestamp'] = self._current_time.to_pydatetime()
+        threading.Thread(target=produce, daemon=True).start()
 
-            row = self._timeline.iloc[current_index]
+        def consume():
+            try:
+                while True:
+                    chunk = q.get()
+                    if chunk is None:
+                        return
+                    elif isinstance(chunk, Exception):
+                        raise chunk
 
-            for e in [e for e in row.index if row[e]]:
-                df = self._data[e]
-                _, historical_depth, _ = self._sources[e]
-                ind = self._get_datetime_level(df)
-                result[e] = df.loc[ind[max(0, ind.get_loc(self._current_time) - historical_depth)]:self._current_time]
+                    yield chunk
+            finally:
+                stop.set()
 
-            return result
-        else:
-            raise StopIteration()
+        return consume(), stop
+
+    def close(self):
+        """
+        Stop the prefetch threads (if the replay is not iterated until the end)
+        """
+        # closing a generator, which was never started, doesn't run its finally block, so the stop events are set directly
+        for stop in getattr(self, '_prefetch_stops', dict()).values():
+            stop.set()
+
+        for (dp, _, _, read_ahead) in getattr(self, '_sources', dict()).values():
+            if read_ahead > 0:
+                dp.close()
+
+    def _schedule(self, e, timestamps):
+        """
+        Add the (new) data of the source e to the heap
+        :param e: source name
+        :param timestamps: chunk timestamps, as computed by _prepare
+        """
+        self._timestamps[e] = timestamps
+
+        timestamps = timestamps[0]
+        self._cursors[e] = 0 if self._current_time is None else int(np.searchsorted(timestamps, self._current_time, side='right'))
+
+        if self._cursors[e] < len(timestamps):
+            heapq.heappush(self._heap, (timestamps[self._cursors[e]], self._order[e], e))
+
+    def _advance(self, e):
+        """
+        Move the source e past the current timestamp
+        """
+        timestamps = self._timestamps[e][0]
+        self._cursors[e] += 1
+
+        if self._cursors[e] < len(timestamps):
+            heapq.heappush(self._heap, (timestamps[self._cursors[e]], self._order[e], e))
 
     @staticmethod
     def _get_datetime_level(index):
@@ -121,7 +254,25 @@ class DataReplay(object):
         elif isinstance(index, pd.MultiIndex):
             return [l for l in index.levels if isinstance(l, pd.DatetimeIndex)][0]
 
-    def add_source(self, data_provider: typing.Union[typing.Iterator, typing.Callable], name: str, historical_depth: int = 0, listeners: typing.Callable = None):
+    @staticmethod
+    def _get_datetime_values(index):
+        """
+        :return: int64 array with the datetime value of each row of the index
+        """
+        if isinstance(index, pd.DatetimeIndex):
+            return index.asi8
+        elif isinstance(index, pd.MultiIndex):
+            i = [i for i, l in enumerate(index.levels) if isinstance(l, pd.DatetimeIndex)][0]
+            return index.levels[i].asi8[index.codes[i]]
+
+    @property
+    def sources(self):
+        """
+        :return: list of (name, historical_depth) of the sources in the order, in which they were added
+        """
+        return [(name, historical_depth) for (_, name, historical_depth, _, _) in self._sources_defs]
+
+    def add_source(self, data_provider: typing.Union[typing.Iterator, typing.Callable], name: str, historical_depth: int = 0, listeners: typing.Callable = None, read_ahead: int = 0):
         """
         Add source for data generation
         :param data_provider: return pd.DataFrame with either DateTimeIndex or MultiIndex, where one of the levels is of datetime type
@@ -130,12 +281,15 @@ class DataReplay(object):
         :param listeners: Fire event after each data provider request.
                 This is necessary, because the data replay functionality is combining the new/old dataframes for continuity.
                 Process data, once obtained from the data provider (applied once for the whole chunk).
+        :param read_ahead: if > 0, the chunks are obtained from the data provider, overlapped and prepared in a background thread.
+                At most read_ahead prepared chunks are kept in advance. In this mode the historical overlap is taken from the previous chunk
+                before the pre_data listeners are applied
         :return: self
         """
         if self._is_running:
             raise Exception("Cannot add sources while the generator is working")
 
-        self._sources_defs.append((data_provider, name, historical_depth, listeners))
+        self._sources_defs.append((data_provider, name, historical_depth, listeners, read_ahead))
 
         return self
 
@@ -148,6 +302,14 @@ class DataReplayEvents(object):
         self.event_name = event_name
 
     def start(self):
-        for d in self.data_replay:
-            d['type'] = self.event_name
-            self.listeners(d)
+        """
+        Replay the data. A 'no_data' event is fired at the end
+        """
+        try:
+            for d in self.data_replay:
+                d['type'] = self.event_name
+                self.listeners(d)
+
+            self.listeners({'type': 'no_data'})
+        finally:
+            self.data_replay.close()
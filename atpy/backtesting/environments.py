@@ -11,8 +11,10 @@ import atpy.data.iqfeed.util as iqutil
 from atpy.backtesting.data_replay import DataReplayEvents, DataReplay
 from atpy.data.cache.lmdb_cache import read_pickle
 from atpy.data.cache.postgres_cache import BarsInPeriodProvider
+from atpy.data.indicators import RollingIndicator
 from atpy.data.quandl.postgres_cache import SFInPeriodProvider
-from atpy.data.ts_util import current_period, current_phase, gaps, rolling_mean, AsyncInPeriodProvider
+from atpy.data.ts_util import current_period, current_phase, gaps
+from pyevents.events import SyncListeners
 
 
 def data_replay_events(listeners):
@@ -25,7 +27,7 @@ def add_postgres_ohlc_1m(dre: DataReplayEvents, bgn_prd: datetime.datetime, hist
     :param dre: DataReplayEvents
     :param bgn_prd: begin period
     :param historical_depth: historical depth for source
-    :param run_async: generate data asynchronously
+    :param run_async: obtain and prepare data in a background thread
     :param url: postgre url (can be obtained via env variable)
     :param lmdb_path: path to lmdb cache file
     :return: dataframe
@@ -37,10 +39,7 @@ def add_postgres_ohlc_1m(dre: DataReplayEvents, bgn_prd: datetime.datetime, hist
     cache = functools.partial(read_pickle, lmdb_path=lmdb_path) if lmdb_path is not None else None
 
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=60, interval_type='s', bars_table='bars_1m', bgn_prd=bgn_prd, delta=relativedelta(weeks=1), overlap=relativedelta(microseconds=-1), cache=cache)
-    if run_async:
-        bars_in_period = AsyncInPeriodProvider(bars_in_period)
-
-    dre.data_replay.add_source(bars_in_period, 'bars_1m', historical_depth=historical_depth, listeners=dre.listeners)
+    dre.data_replay.add_source(bars_in_period, 'bars_1m', historical_depth=historical_depth, listeners=dre.listeners, read_ahead=2 if run_async else 0)
 
     return dre
 
@@ -51,7 +50,7 @@ def add_postgres_ohlc_5m(dre: DataReplayEvents, bgn_prd: datetime.datetime, hist
     :param dre: DataReplayEvents
     :param bgn_prd: begin period
     :param historical_depth: historical depth for source
-    :param run_async: generate data asynchronously
+    :param run_async: obtain and prepare data in a background thread
     :param url: postgre url (can be obtained via env variable)
     :param lmdb_path: path to lmdb cache file
     :return: dataframe
@@ -63,10 +62,7 @@ def add_postgres_ohlc_5m(dre: DataReplayEvents, bgn_prd: datetime.datetime, hist
     cache = functools.partial(read_pickle, lmdb_path=lmdb_path) if lmdb_path is not None else None
 
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=300, interval_type='s', bars_table='bars_5m', bgn_prd=bgn_prd, delta=relativedelta(weeks=1), overlap=relativedelta(microseconds=-1), cache=cache)
-    if run_async:
-        bars_in_period = AsyncInPeriodProvider(bars_in_period)
-
-    dre.data_replay.add_source(bars_in_period, 'bars_5m', historical_depth=historical_depth, listeners=dre.listeners)
+    dre.data_replay.add_source(bars_in_period, 'bars_5m', historical_depth=historical_depth, listeners=dre.listeners, read_ahead=2 if run_async else 0)
 
     return dre
 
@@ -77,7 +73,7 @@ def add_postgres_ohlc_60m(dre: DataReplayEvents, bgn_prd: datetime.datetime, his
     :param dre: DataReplayEvents
     :param bgn_prd: begin period
     :param historical_depth: historical depth for source
-    :param run_async: generate data asynchronously
+    :param run_async: obtain and prepare data in a background thread
     :param url: postgre url (can be obtained via env variable)
     :param lmdb_path: path to lmdb cache file
     :return: dataframe
@@ -89,10 +85,7 @@ def add_postgres_ohlc_60m(dre: DataReplayEvents, bgn_prd: datetime.datetime, his
     cache = functools.partial(read_pickle, lmdb_path=lmdb_path) if lmdb_path is not None else None
 
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=3300, interval_type='s', bars_table='bars_60m', bgn_prd=bgn_prd, delta=relativedelta(weeks=1), overlap=relativedelta(microseconds=-1), cache=cache)
-    if run_async:
-        bars_in_period = AsyncInPeriodProvider(bars_in_period)
-
-    dre.data_replay.add_source(bars_in_period, 'bars_60m', historical_depth=historical_depth, listeners=dre.listeners)
+    dre.data_replay.add_source(bars_in_period, 'bars_60m', historical_depth=historical_depth, listeners=dre.listeners, read_ahead=2 if run_async else 0)
 
     return dre
 
@@ -103,7 +96,7 @@ def add_postgres_ohlc_1d(dre: DataReplayEvents, bgn_prd: datetime.datetime, hist
     :param dre: DataReplayEvents
     :param bgn_prd: begin period
     :param historical_depth: historical depth for source
-    :param run_async: generate data asynchronously
+    :param run_async: obtain and prepare data in a background thread
     :param url: postgre url (can be obtained via env variable)
     :param lmdb_path: path to lmdb cache file
     :return: dataframe
@@ -115,10 +108,7 @@ def add_postgres_ohlc_1d(dre: DataReplayEvents, bgn_prd: datetime.datetime, hist
     cache = functools.partial(read_pickle, lmdb_path=lmdb_path) if lmdb_path is not None else None
 
     bars_in_period = BarsInPeriodProvider(conn=con, interval_len=1, interval_type='d', bars_table='bars_1d', bgn_prd=bgn_prd, delta=relativedelta(weeks=1), overlap=relativedelta(microseconds=-1), cache=cache)
-    if run_async:
-        bars_in_period = AsyncInPeriodProvider(bars_in_period)
-
-    dre.data_replay.add_source(bars_in_period, 'bars_1d', historical_depth=historical_depth, listeners=dre.listeners)
+    dre.data_replay.add_source(bars_in_period, 'bars_1d', historical_depth=historical_depth, listeners=dre.listeners, read_ahead=2 if run_async else 0)
 
     return dre
 
@@ -153,6 +143,32 @@ def add_quandl_sf(dre: DataReplayEvents, bgn_prd: datetime.datetime, dataset_nam
     dre.data_replay.add_source(sf_in_period, name=name, historical_depth=200)
 
 
+def add_rolling_indicator(listeners, datum_name: str, indicator: str, window: int, column: typing.Union[typing.List, str] = 'close', suffix: str = None, full_history: bool = False):
+    """
+    Compute incremental rolling indicator over a column. Only the new rows of each event are computed (see RollingIndicator)
+    :param listeners: listeners
+    :param datum_name: data name
+    :param indicator: mean, std, min, max or ewma
+    :param window: window size
+    :param column: a column (or list of columns, where to apply the indicator)
+    :param suffix: suffix of the new column name. The new column is column + suffix + str(window). Default is '_r' + indicator + '_'
+    :param full_history: if False, the first window - 1 rows of each symbol in the event are nan (like ts_util.rolling_mean).
+            If True, they are computed over the full history
+    """
+
+    columns = [column] if isinstance(column, str) else column
+    suffix = suffix if suffix is not None else '_r' + indicator + '_'
+    indicators = {c: RollingIndicator(indicator, window) for c in columns}
+
+    def ri(e):
+        if datum_name in e:
+            df = e[datum_name]
+            for c in columns:
+                df[c + suffix + str(window)] = indicators[c](df, c, full_history=full_history)
+
+    listeners += ri
+
+
 def add_rolling_mean(listeners, datum_name: str, window: int, column: typing.Union[typing.List, str] = 'close'):
     """
     Compute the rolling mean over a column
@@ -160,14 +176,57 @@ def add_rolling_mean(listeners, datum_name: str, window: int, column: typing.Uni
     :param datum_name: data name
     :param window: window size OHLC DataFrame
     :param column: a column (or list of columns, where to apply the rolling mean)
-    :return DataFrame with changes
     """
 
-    def rm(e):
-        if datum_name in e:
-            e[datum_name][column + '_rm_' + str(window)] = rolling_mean(df=e[datum_name], window=window, column=column)
+    add_rolling_indicator(listeners, datum_name=datum_name, indicator='mean', window=window, column=column, suffix='_rm_')
+
+
+def add_rolling_std(listeners, datum_name: str, window: int, column: typing.Union[typing.List, str] = 'close'):
+    """
+    Compute the rolling standard deviation over a column
+    :param listeners: listeners
+    :param datum_name: data name
+    :param window: window size
+    :param column: a column (or list of columns, where to apply the rolling std)
+    """
+
+    add_rolling_indicator(listeners, datum_name=datum_name, indicator='std', window=window, column=column, suffix='_rstd_')
+
+
+def add_rolling_min(listeners, datum_name: str, window: int, column: typing.Union[typing.List, str] = 'close'):
+    """
+    Compute the rolling min over a column
+    :param listeners: listeners
+    :param datum_name: data name
+    :param window: window size
+    :param column: a column (or list of columns, where to apply the rolling min)
+    """
 
-    listeners += rm
+    add_rolling_indicator(listeners, datum_name=datum_name, indicator='min', window=window, column=column, suffix='_rmin_')
+
+
+def add_rolling_max(listeners, datum_name: str, window: int, column: typing.Union[typing.List, str] = 'close'):
+    """
+    Compute the rolling max over a column
+    :param listeners: listeners
+    :param datum_name: data name
+    :param window: window size
+    :param column: a column (or list of columns, where to apply the rolling max)
+    """
+
+    add_rolling_indicator(listeners, datum_name=datum_name, indicator='max', window=window, column=column, suffix='_rmax_')
+
+
+def add_ewma(listeners, datum_name: str, span: int, column: typing.Union[typing.List, str] = 'close'):
+    """
+    Compute the exponentially weighted moving average over a column
+    :param listeners: listeners
+    :param datum_name: data name
+    :param span: ewma span
+    :param column: a column (or list of columns, where to apply the ewma)
+    """
+
+    add_rolling_indicator(listeners, datum_name=datum_name, indicator='ewma', window=span, column=column, suffix='_ewma_')
 
 
 def add_current_period(listeners, datum_name: str):
@@ -262,3 +321,29 @@ def add_gaps(listeners, datum_name: str):
             e[datum_name + '_gaps'] = gaps(e[datum_name])
 
     listeners += gaps_f
+
+
+def add_parameter_sweep(listeners, stack: typing.Callable, parameters: typing.Iterable):
+    """
+    Fan out the events of a single data replay to multiple independent strategy stacks (e.g. strategy, MockBroker, PortfolioManager).
+    Each stack has its own listeners, so that the orders and portfolio events of the stacks don't interfere.
+    The data is obtained only once and the shared derived features (add_rolling_mean, add_gaps, etc.) are computed only once per event,
+    as long as they are added to the shared listeners before the sweep. The stacks should treat the event data as read-only
+    :param listeners: shared listeners environment
+    :param stack: function(listeners, parameters) -> result. Creates a stack with the given parameters over the private listeners
+    :param parameters: list of parameters. One stack is created for each of them
+    :return: list of the stack results in the order of the parameters
+    """
+
+    stacks = list()
+    for p in parameters:
+        stack_listeners = SyncListeners()
+        stacks.append((stack_listeners, stack(stack_listeners, p)))
+
+    def sweep(e):
+        for stack_listeners, _ in stacks:
+            stack_listeners(e)
+
+    listeners += sweep
+
+    return [result for _, result in stacks]
@@ -2,11 +2,162 @@ import logging
 import threading
 import typing
 
+import numpy as np
 import pandas as pd
 
 import atpy.portfolio.order as orders
 
 
+class _OrderBook(object):
+    """
+    Columnar table of the pending orders in the order of their requests. The eligibility of the orders for execution is computed with numpy.
+    The rows of each symbol are indexed, so that a tick only visits the orders of its symbol. Removed orders are marked as inactive
+    and the table is compacted once the inactive rows outnumber the active ones
+    """
+
+    MARKET, LIMIT, STOP, STOP_LIMIT, OTHER = range(5)
+
+    columns = [('symbol', np.int64), ('buy', np.bool_), ('kind', np.int8), ('stop', np.float64), ('limit', np.float64), ('triggered', np.bool_), ('active', np.bool_)]
+
+    def __init__(self, capacity: int = 64):
+        # order of each row (None for the removed orders)
+        self.orders = list()
+        self._count = 0
+
+        # symbol -> symbol id
+        self.symbol_ids = dict()
+        self._symbols_index = None
+
+        # symbol id -> list of the active rows of the symbol (in request order)
+        self.symbol_rows = dict()
+
+        for name, dtype in self.columns:
+            setattr(self, name, np.empty(capacity, dtype=dtype))
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def size(self):
+        """
+        :return: number of rows (including the removed orders)
+        """
+        return len(self.orders)
+
+    @property
+    def pending_orders(self):
+        return [o for o in self.orders if o is not None]
+
+    @property
+    def symbols_index(self):
+        """
+        :return: pd.Index of the symbols, where the position of each symbol is its id
+        """
+        if self._symbols_index is None or len(self._symbols_index) != len(self.symbol_ids):
+            self._symbols_index = pd.Index(list(self.symbol_ids.keys()))
+
+        return self._symbols_index
+
+    def add(self, o):
+        n = len(self.orders)
+
+        if n == len(self.symbol):
+            for name, _ in self.columns:
+                column = getattr(self, name)
+                setattr(self, name, np.concatenate([column, np.empty_like(column)]))
+
+        stop = limit = np.nan
+        triggered = False
+
+        if type(o) == orders.MarketOrder:
+            kind = self.MARKET
+        elif type(o) == orders.LimitOrder:
+            kind, limit = self.LIMIT, o.price
+        elif type(o) == orders.StopMarketOrder:
+            kind, stop, triggered = self.STOP, o.price, o._is_market
+        elif type(o) == orders.StopLimitOrder:
+            kind, stop, limit, triggered = self.STOP_LIMIT, o.stop_price, o.limit_price, o._is_limit
+        else:
+            # the order itself decides whether it is executed
+            kind = self.OTHER
+
+        symbol_id = self.symbol_ids.setdefault(o.symbol, len(self.symbol_ids))
+
+        self.symbol[n] = symbol_id
+        self.buy[n] = o.order_type == orders.Type.BUY
+        self.kind[n] = kind
+        self.stop[n] = stop
+        self.limit[n] = limit
+        self.triggered[n] = triggered
+        self.active[n] = True
+
+        self.orders.append(o)
+        self.symbol_rows.setdefault(symbol_id, list()).append(n)
+        self._count += 1
+
+    def rows_of(self, symbol_id: int):
+        """
+        :return: the active rows of the symbol in request order
+        """
+        return np.array(self.symbol_rows.get(symbol_id, ()), dtype=np.int64)
+
+    def remove(self, rows):
+        """
+        :param rows: sorted positions of the orders to remove
+        """
+        self.active[rows] = False
+        for r in rows:
+            self.orders[r] = None
+
+        self._count -= len(rows)
+
+        for symbol_id in np.unique(self.symbol[rows]):
+            self.symbol_rows[symbol_id] = [r for r in self.symbol_rows[symbol_id] if self.active[r]]
+
+        if len(self.orders) - self._count > max(self._count, 64):
+            self._compact()
+
+    def _compact(self):
+        """
+        Remove the inactive rows from the table
+        """
+        n = len(self.orders)
+        keep = self.active[:n].copy()
+
+        for name, _ in self.columns:
+            column = getattr(self, name)
+            column[:self._count] = column[:n][keep]
+
+        self.orders = [o for o in self.orders if o is not None]
+
+        symbols = self.symbol[:self._count]
+        order = np.argsort(symbols, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(np.concatenate([[-1], symbols[order], [-1]])) != 0)
+
+        self.symbol_rows = {int(symbols[order[b]]): order[b:e].tolist() for b, e in zip(bounds[:-1], bounds[1:])}
+
+    def eligible(self, rows, price):
+        """
+        Same conditions as the add_position methods of the orders
+        :param rows: positions of the orders
+        :param price: price for each of the orders
+        :return: (triggered, eligible) boolean arrays for each of the rows
+        """
+        buy, kind, stop, limit = self.buy[rows], self.kind[rows], self.stop[rows], self.limit[rows]
+        sell = ~buy
+
+        with np.errstate(invalid='ignore'):
+            is_stop = (kind == self.STOP) | (kind == self.STOP_LIMIT)
+            triggered = self.triggered[rows] | (is_stop & ((buy & (stop >= price)) | (sell & (stop <= price))))
+
+            eligible = (kind == self.MARKET) | (kind == self.OTHER)
+            eligible |= (kind == self.LIMIT) & ~((buy & (limit < price)) | (sell & (limit > price)))
+            eligible |= (kind == self.STOP) & triggered
+            eligible |= (kind == self.STOP_LIMIT) & ((triggered & buy & (limit < price)) | (sell & (limit > price)))
+
+        return triggered, eligible
+
+
 class MockBroker(object):
     """
     Mock broker for executing trades based on the current streaming prices. Works with realtime and historical data.
@@ -33,12 +184,20 @@ class MockBroker(object):
         self.listeners = listeners
         self.listeners += self.on_event
 
-        self._pending_orders = list()
+        self._book = _OrderBook()
         self._lock = threading.RLock()
 
+    @property
+    def pending_orders(self):
+        """
+        :return: list of the pending orders in the order of their requests
+        """
+        with self._lock:
+            return self._book.pending_orders
+
     def process_order_request(self, order):
         with self._lock:
-            self._pending_orders.append(order)
+            self._book.add(order)
 
     def on_event(self, event):
         if event['type'] == 'order_request':
@@ -48,37 +207,105 @@ class MockBroker(object):
         elif self.accept_bars(event) is not None:
             self.process_bar_data(self.accept_bars(event))
 
+    def _execute(self, rows, quantity, price):
+        """
+        Execute the eligible orders in the order of their requests and fire the order_fulfilled events
+        :param rows: sorted positions of the candidate orders in the order book
+        :param quantity: available quantity for each of the rows
+        :param price: price for each of the rows
+        """
+        book = self._book
+
+        triggered, eligible = book.eligible(rows, price)
+        book.triggered[rows] = triggered
+
+        fulfilled = list()
+
+        for i in np.flatnonzero(eligible):
+            o = book.orders[rows[i]]
+            o.add_position(quantity[i], price[i])
+
+            if o.fulfill_time is not None:
+                fulfilled.append(rows[i])
+
+        # stop limit orders, which were triggered, but not executed
+        for i in np.flatnonzero(triggered & ~eligible & (book.kind[rows] == _OrderBook.STOP_LIMIT)):
+            book.orders[rows[i]]._is_limit = True
+
+        if len(fulfilled) > 0:
+            fulfilled_orders = [book.orders[r] for r in fulfilled]
+            book.remove(fulfilled)
+
+            logger = logging.getLogger(__name__)
+
+            for o in fulfilled_orders:
+                logger.info("Order fulfilled: %s", o)
+
+                self.listeners({'type': 'order_fulfilled', 'data': o})
+
     def process_tick_data(self, data):
         with self._lock:
-            matching_orders = [o for o in self._pending_orders if o.symbol == data['symbol']]
-            for o in matching_orders:
-                if o.order_type == orders.Type.BUY:
-                    if 'tick_id' in data:
-                        o.add_position(data['last_size'], data['ask'])
-                    else:
-                        o.add_position(data['ask_size'] if data['ask_size'] > 0 else data['most_recent_trade_size'], data['ask'] if data['ask_size'] > 0 else data['most_recent_trade'])
-                elif o.order_type == orders.Type.SELL:
-                    if 'tick_id' in data:
-                        o.add_position(data['last_size'], data['bid'])
-                    else:
-                        o.add_position(data['bid_size'] if data['bid_size'] > 0 else data['most_recent_trade_size'], data['bid'] if data['bid_size'] > 0 else data['most_recent_trade'])
-
-                if o.fulfill_time is not None:
-                    self._pending_orders.remove(o)
-
-                    logging.getLogger(__name__).info("Order fulfilled: " + str(o))
-
-                    self.listeners({'type': 'order_fulfilled', 'data': o})
+            book = self._book
+
+            if data['symbol'] not in book.symbol_ids:
+                return
+
+            rows = book.rows_of(book.symbol_ids[data['symbol']])
+            if len(rows) == 0:
+                return
+
+            buy = book.buy[rows]
+            quantity, price = np.empty(len(rows), dtype=object), np.empty(len(rows))
+
+            if buy.any():
+                if 'tick_id' in data:
+                    quantity[buy], price[buy] = data['last_size'], data['ask']
+                else:
+                    quantity[buy], price[buy] = (data['ask_size'], data['ask']) if data['ask_size'] > 0 else (data['most_recent_trade_size'], data['most_recent_trade'])
+
+            if not buy.all():
+                if 'tick_id' in data:
+                    quantity[~buy], price[~buy] = data['last_size'], data['bid']
+                else:
+                    quantity[~buy], price[~buy] = (data['bid_size'], data['bid']) if data['bid_size'] > 0 else (data['most_recent_trade_size'], data['most_recent_trade'])
+
+            self._execute(rows, quantity, price)
 
     def process_bar_data(self, data):
         with self._lock:
-            for o, slc in [(o, data.loc[pd.IndexSlice[:, o.symbol], :]) for o in self._pending_orders]:
-                if not slc.empty:
-                    o.add_position(slc.iloc[-1]['period_volume'], slc.iloc[-1]['close'])
+            book = self._book
+
+            if len(book) == 0:
+                return
+
+            symbol_level = data.index.names.index('symbol') if 'symbol' in data.index.names else 1
+            symbols = data.index.levels[symbol_level]
+
+            # symbol id of each symbol of the bar
+            ids = book.symbols_index.get_indexer(symbols)
+            codes = np.flatnonzero(ids >= 0)
+            if len(codes) == 0:
+                return
+
+            # the last bar of each symbol with pending orders
+            row_codes = data.index.codes[symbol_level]
+            bar_rows = np.flatnonzero(np.isin(row_codes, codes))
+            if len(bar_rows) == 0:
+                return
+
+            bar_rows = bar_rows[::-1]
+            _, first = np.unique(row_codes[bar_rows], return_index=True)
+            bar_rows = bar_rows[first]
+
+            # bar row of each pending order
+            symbol_bar_row = np.full(len(book.symbol_ids), -1, dtype=np.int64)
+            symbol_bar_row[ids[row_codes[bar_rows]]] = bar_rows
 
-                    if o.fulfill_time is not None:
-                        self._pending_orders.remove(o)
+            order_bar_row = np.where(book.active[:book.size], symbol_bar_row[book.symbol[:book.size]], -1)
+            rows = np.flatnonzero(order_bar_row >= 0)
+            if len(rows) == 0:
+                return
 
-                        logging.getLogger(__name__).info("Order fulfilled: " + str(o))
+            order_bar_row = order_bar_row[rows]
 
-                        self.listeners({'type': 'order_fulfilled', 'data': o})
+            self._execute(rows, data['period_volume'].values[order_bar_row], data['close'].values[order_bar_row])
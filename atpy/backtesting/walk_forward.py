@@ -0,0 +1,130 @@
+import datetime
+import logging
+import typing
+from multiprocessing import Pool
+
+from dateutil.relativedelta import relativedelta
+
+from atpy.portfolio.portfolio_manager import PortfolioManager
+from pyevents.events import SyncListeners
+
+
+def time_shards(bgn_prd: datetime.datetime, end_prd: datetime.datetime, delta: typing.Union[relativedelta, datetime.timedelta]):
+    """
+    Split period into consecutive shards
+    :param bgn_prd: begin period
+    :param end_prd: end period
+    :param delta: length of each shard
+    :return: list of (shard begin, shard end) tuples. Shard begin is inclusive and shard end is exclusive
+    """
+    result = list()
+
+    while bgn_prd < end_prd:
+        result.append((bgn_prd, min(bgn_prd + delta, end_prd)))
+        bgn_prd += delta
+
+    return result
+
+
+def run_shard(environment: typing.Callable, bgn_prd: datetime.datetime, end_prd: datetime.datetime, warm_up: typing.Union[relativedelta, datetime.timedelta], require_flat: bool = False):
+    """
+    Replay a single time shard with its own listeners graph. The data replay starts at bgn_prd - warm_up,
+    but only the events in [bgn_prd, end_prd) are fired. This way the historical windows of the first events are complete
+    :param environment: function(listeners, bgn_prd) -> (DataReplayEvents, result). Creates the data sources (starting at bgn_prd),
+            the strategy, MockBroker, PortfolioManager etc. The result (for example the PortfolioManager) has to be picklable
+    :param bgn_prd: shard begin (inclusive). Has to be comparable with the event timestamps (e.g. both are timezone aware)
+    :param end_prd: shard end (exclusive)
+    :param warm_up: warm-up period. Has to contain at least historical_depth time steps for each of the data sources
+    :param require_flat: raise, if there are pending order requests or (for PortfolioManager results) open positions at the end of the shard
+    :return: the environment result
+    """
+    listeners = SyncListeners()
+
+    dre, result = environment(listeners, bgn_prd - warm_up)
+
+    # order requests, which are not fulfilled yet
+    pending = dict()
+
+    def track_orders(e):
+        if e['type'] == 'order_request':
+            pending[e['data'].uid] = e['data']
+        elif e['type'] == 'order_fulfilled':
+            pending.pop(e['data'].uid, None)
+
+    listeners += track_orders
+
+    warm_up_steps = {name: 0 for name, _ in dre.data_replay.sources}
+    now = datetime.datetime.now()
+
+    try:
+        for d in dre.data_replay:
+            if d['timestamp'] >= end_prd:
+                break
+            elif d['timestamp'] < bgn_prd:
+                for e in [e for e in d if e in warm_up_steps]:
+                    warm_up_steps[e] += 1
+            else:
+                d['type'] = dre.event_name
+                dre.listeners(d)
+
+        dre.listeners({'type': 'no_data'})
+    finally:
+        dre.data_replay.close()
+
+    for name, historical_depth in dre.data_replay.sources:
+        if warm_up_steps[name] < historical_depth:
+            logging.getLogger(__name__).warning("Warm-up of " + name + " for shard " + str(bgn_prd) + " contains " + str(warm_up_steps[name]) + " steps, but historical depth is " + str(historical_depth))
+
+    if require_flat:
+        if len(pending) > 0:
+            raise Exception("Shard " + str(bgn_prd) + " - " + str(end_prd) + " ends with " + str(len(pending)) + " pending orders")
+
+        if isinstance(result, PortfolioManager) and any(q != 0 for q in result.quantity().values()):
+            raise Exception("Shard " + str(bgn_prd) + " - " + str(end_prd) + " ends with open positions " + str(result.quantity()))
+
+    logging.getLogger(__name__).info("Shard " + str(bgn_prd) + " - " + str(end_prd) + " completed in " + str(datetime.datetime.now() - now))
+
+    return result
+
+
+def walk_forward(environment: typing.Callable, bgn_prd: datetime.datetime, end_prd: datetime.datetime, delta: typing.Union[relativedelta, datetime.timedelta], warm_up: typing.Union[relativedelta, datetime.timedelta],
+                 processes: int = None):
+    """
+    Split the replay period into time shards and run each shard in a separate process. See run_shard.
+    Each shard starts with a new environment (initial capital, no positions and no pending orders), so the strategy has to be flat
+    (no open positions and no pending orders) at the end of each shard, except the last one. Otherwise an exception is raised
+    :param environment: picklable (module level) function(listeners, bgn_prd) -> (DataReplayEvents, result)
+    :param bgn_prd: begin period
+    :param end_prd: end period
+    :param delta: length of each shard
+    :param warm_up: warm-up period for each shard
+    :param processes: number of processes. If None, the number of cpus is used
+    :return: list of shard results, ordered by time
+    """
+    shards = time_shards(bgn_prd, end_prd, delta)
+
+    with Pool(processes=processes) as pool:
+        return pool.starmap(run_shard, [(environment, bgn, end, warm_up, i < len(shards) - 1) for i, (bgn, end) in enumerate(shards)])
+
+
+def merge_portfolios(portfolios: typing.List[PortfolioManager], listeners=None):
+    """
+    Merge the portfolios of consecutive shards, which are flat at the end of each shard (except the last one).
+    The orders are added in shard order with the same checks as in a single run (no selling of more shares than available and no negative capital)
+    :param portfolios: list of portfolios, ordered by time
+    :param listeners: listeners of the new portfolio
+    :return: PortfolioManager
+    """
+    for pm in portfolios[:-1]:
+        if any(q != 0 for q in pm.quantity().values()):
+            raise Exception("Only flat portfolios can be merged, but a shard ends with positions " + str(pm.quantity()))
+
+    result = PortfolioManager(listeners=listeners if listeners is not None else SyncListeners(), initial_capital=portfolios[0].initial_capital)
+
+    for pm in portfolios:
+        for o in pm.orders:
+            result.add_order(o)
+
+        result.update_prices(pm.prices)
+
+    return result
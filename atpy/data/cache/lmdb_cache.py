@@ -1,25 +1,351 @@
+import atexit
+import contextlib
+import os
 import pickle
+import struct
+import threading
+import typing
 import zlib
 
 import lmdb
+import numpy as np
+import pandas as pd
 
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
-def write(key: str, value, lmdb_path: str, compress=True):
-    with lmdb.open(lmdb_path, map_size=int(1e12)) as lmdb_env, lmdb_env.begin(write=True) as lmdb_txn:
-        lmdb_txn.put(key.encode(), zlib.compress(pickle.dumps(value)) if compress else pickle.dumps(value))
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# (compress, decompress) pairs. The decompressed data is writable, so that the decoded arrays can be modified
+_codecs = {'zlib': (zlib.compress, lambda b: bytearray(zlib.decompress(b)))}
+
+if zstandard is not None:
+    _codecs['zstd'] = (lambda b: zstandard.ZstdCompressor().compress(b), lambda b: bytearray(zstandard.ZstdDecompressor().decompress(b)))
+
+if lz4_frame is not None:
+    _codecs['lz4'] = (lz4_frame.compress, lambda b: lz4_frame.decompress(b, return_bytearray=True))
+
+default_codec = 'lz4' if 'lz4' in _codecs else 'zstd' if 'zstd' in _codecs else 'zlib'
+
+_environments = dict()
+
+_environments_lock = threading.Lock()
+
+
+def environment(lmdb_path: str, map_size: int = int(1e12), max_readers: int = 512) -> lmdb.Environment:
+    """
+    Process-wide LMDB environment registry. The environment of each path is opened once and kept for the life of the process
+    (LMDB doesn't allow opening the same environment twice in one process). Any number of threads (up to max_readers) can read concurrently.
+    Forked processes open their own environment
+    :param lmdb_path: path to the lmdb database
+    :param map_size: maximum size of the database (only used when the environment is opened)
+    :param max_readers: maximum number of concurrent read transactions (only used when the environment is opened)
+    :return: environment
+    """
+    path = os.path.abspath(lmdb_path)
+
+    with _environments_lock:
+        pid, env = _environments.get(path, (None, None))
+
+        if env is None or pid != os.getpid():
+            # spare read transactions are reused, instead of acquiring new reader slots
+            env = lmdb.open(path, map_size=map_size, max_readers=max_readers, max_spare_txns=16)
+            _environments[path] = (os.getpid(), env)
+
+        return env
+
+
+def close_environments():
+    """
+    Close all environments, opened by this process
+    """
+    with _environments_lock:
+        for path, (pid, env) in list(_environments.items()):
+            if pid == os.getpid():
+                env.close()
+
+            del _environments[path]
+
+
+atexit.register(close_environments)
+
+
+def write(key: str, value, lmdb_path: str, compress=True, codec: str = None):
+    """
+    Write value to the cache. DataFrames and Series are stored in the columnar format (see to_columnar). Everything else is pickled
+    :param key: key
+    :param value: value
+    :param lmdb_path: path to the lmdb database
+    :param compress: compress the data
+    :param codec: compression codec ('lz4', 'zstd' or 'zlib') for the columnar format. The default is the fastest available
+    """
+    write_many({key: value}, lmdb_path=lmdb_path, compress=compress, codec=codec)
+
+
+def write_many(items: typing.Union[dict, typing.Iterable[typing.Tuple[str, object]]], lmdb_path: str, compress=True, codec: str = None):
+    """
+    Write multiple values in a single transaction
+    :param items: dict or iterable of (key, value) pairs
+    :param lmdb_path: path to the lmdb database
+    :param compress: compress the data
+    :param codec: compression codec ('lz4', 'zstd' or 'zlib') for the columnar format. The default is the fastest available
+    """
+    items = items.items() if isinstance(items, dict) else items
+
+    # encode outside of the write transaction
+    _put_many([(k, _encode(v, compress=compress, codec=codec)) for k, v in items], lmdb_path)
+
+
+def _put_many(items: list, lmdb_path: str):
+    with environment(lmdb_path).begin(write=True) as lmdb_txn:
+        for k, v in items:
+            lmdb_txn.put(k.encode(), v)
 
 
 def read(key: str, lmdb_path: str, decompress=True):
-    with lmdb.open(lmdb_path) as lmdb_env, lmdb_env.begin() as lmdb_txn:
-        result = lmdb_txn.get(key.encode())
-        if result is not None:
-            if decompress:
-                result = zlib.decompress(result)
+    """
+    Read value from the cache
+    :param key: key
+    :param lmdb_path: path to the lmdb database
+    :param decompress: whether pickled values were compressed (the columnar format is detected automatically)
+    :return: value or None
+    """
+    return read_many([key], lmdb_path=lmdb_path, decompress=decompress)[key]
 
-            result = pickle.loads(result)
 
-        return result
+def read_many(keys: typing.Iterable[str], lmdb_path: str, decompress=True) -> dict:
+    """
+    Read multiple values in a single transaction
+    :param keys: keys
+    :param lmdb_path: path to the lmdb database
+    :param decompress: whether pickled values were compressed (the columnar format is detected automatically)
+    :return: dict of key: value (None for the missing keys)
+    """
+    with environment(lmdb_path).begin(buffers=True) as lmdb_txn:
+        # single copy out of the memory map, so that the result outlives the transaction
+        result = {k: lmdb_txn.get(k.encode()) for k in keys}
+        result = {k: bytearray(v) if v is not None else None for k, v in result.items()}
+
+    return {k: _decode(v, decompress=decompress) if v is not None else None for k, v in result.items()}
 
 
 def read_pickle(key: str, lmdb_path: str, decompress=True):
     return read(key=key, lmdb_path=lmdb_path, decompress=decompress)
+
+
+class BatchWriter(object):
+    """
+    Accumulate encoded values and write them in large transactions
+    """
+
+    def __init__(self, lmdb_path: str, max_batch_bytes: int = 2 ** 30, compress=True, codec: str = None):
+        """
+        :param lmdb_path: path to the lmdb database
+        :param max_batch_bytes: the batch is written, when the size of the encoded values exceeds this
+        :param compress: compress the data
+        :param codec: compression codec ('lz4', 'zstd' or 'zlib') for the columnar format. The default is the fastest available
+        """
+        self.lmdb_path = lmdb_path
+        self.max_batch_bytes = max_batch_bytes
+        self.compress = compress
+        self.codec = codec
+        self._batch = list()
+        self._batch_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        # the values, which were written before an exception, are committed too
+        self.flush()
+
+    def write(self, key: str, value):
+        data = _encode(value, compress=self.compress, codec=self.codec)
+
+        self._batch.append((key, data))
+        self._batch_bytes += len(data)
+
+        if self._batch_bytes >= self.max_batch_bytes:
+            self.flush()
+
+    def flush(self):
+        if len(self._batch) > 0:
+            _put_many(self._batch, self.lmdb_path)
+            self._batch, self._batch_bytes = list(), 0
+
+
+def _encode(value, compress=True, codec: str = None) -> bytes:
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return to_columnar(value, codec=(codec or default_codec) if compress else None)
+    else:
+        return zlib.compress(pickle.dumps(value)) if compress else pickle.dumps(value)
+
+
+def _decode(data, decompress=True):
+    if is_columnar(data):
+        return from_columnar(data)
+    else:
+        return pickle.loads(zlib.decompress(data) if decompress else data)
+
+
+@contextlib.contextmanager
+def read_view(key: str, lmdb_path: str, decompress=True):
+    """
+    Read value without copying. The uncompressed columns of columnar values reference the LMDB memory map directly,
+    therefore the result is read-only and valid only within the with block
+    :param key: key
+    :param lmdb_path: path to the lmdb database
+    :param decompress: whether pickled values were compressed
+    :return: context manager, which returns the value or None
+    """
+    with environment(lmdb_path).begin(buffers=True) as lmdb_txn:
+        result = lmdb_txn.get(key.encode())
+
+        yield _decode(result, decompress=decompress) if result is not None else None
+
+
+_columnar_magic = b'ATPYCOL1'
+
+_alignment = 64
+
+
+def is_columnar(data) -> bool:
+    """
+    :param data: bytes-like
+    :return: whether data is in the columnar format
+    """
+    return bytes(data[:len(_columnar_magic)]) == _columnar_magic
+
+
+def to_columnar(value: typing.Union[pd.DataFrame, pd.Series], codec: str = None) -> bytes:
+    """
+    Encode DataFrame/Series in the columnar format: magic, 4 byte header length, pickled header and a sequence of contiguous numpy buffers,
+    each starting at 64 byte aligned offset. The index levels and the columns are stored in separate buffers. Object columns are stored as codes + uniques
+    :param value: DataFrame or Series
+    :param codec: compression codec for the buffers ('lz4', 'zstd', 'zlib' or None)
+    :return: encoded data
+    """
+    compress = _codecs[codec][0] if codec is not None else None
+
+    buffers = list()
+
+    def add(arr: np.ndarray):
+        arr = np.ascontiguousarray(arr)
+        buffers.append(compress(arr.tobytes()) if compress is not None else memoryview(arr.reshape(-1).view(np.uint8)))
+        return {'buffer': len(buffers) - 1, 'dtype': arr.dtype.str, 'shape': arr.shape}
+
+    df = value.to_frame() if isinstance(value, pd.Series) else value
+
+    if not df.columns.is_unique:
+        raise Exception("Columnar format requires unique column names")
+
+    header = {'codec': codec,
+              'series': isinstance(value, pd.Series),
+              'columns': list(df.columns),
+              'values': [_encode_values(df[c], add) for c in df.columns],
+              'index': _encode_index(df.index, add)}
+
+    header['buffers'] = [len(b) if isinstance(b, bytes) else b.nbytes for b in buffers]
+
+    header = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+
+    result = bytearray(_columnar_magic)
+    result += struct.pack('<I', len(header))
+    result += header
+
+    for b in buffers:
+        result += bytes(-len(result) % _alignment)
+        result += b
+
+    return bytes(result)
+
+
+def from_columnar(data) -> typing.Union[pd.DataFrame, pd.Series]:
+    """
+    Decode DataFrame/Series from the columnar format. Uncompressed buffers are not copied - the result references data
+    :param data: bytes-like (bytes, bytearray, memoryview)
+    :return: DataFrame or Series
+    """
+    data = memoryview(data)
+
+    header_len = struct.unpack_from('<I', data, len(_columnar_magic))[0]
+    offset = len(_columnar_magic) + 4
+    header = pickle.loads(data[offset:offset + header_len])
+    offset += header_len
+
+    decompress = _codecs[header['codec']][1] if header['codec'] is not None else None
+
+    buffers = list()
+    for nbytes in header['buffers']:
+        offset += -offset % _alignment
+        buffers.append(data[offset:offset + nbytes] if decompress is None else decompress(data[offset:offset + nbytes]))
+        offset += nbytes
+
+    def get(spec: dict):
+        dtype = np.dtype(spec['dtype'])
+        return np.frombuffer(buffers[spec['buffer']], dtype=dtype, count=int(np.prod(spec['shape'], dtype=np.int64))).reshape(spec['shape'])
+
+    index = _decode_index(header['index'], get)
+
+    df = pd.DataFrame({c: _decode_values(v, get) for c, v in zip(header['columns'], header['values'])}, index=index, columns=header['columns'], copy=False)
+
+    return df[df.columns[0]] if header['series'] else df
+
+
+def _encode_values(values, add) -> dict:
+    values = getattr(values, 'array', values)
+
+    if isinstance(values, pd.Categorical):
+        return {'kind': 'category', 'codes': add(values.codes), 'categories': _encode_values(values.categories, add), 'ordered': values.ordered}
+    elif isinstance(values.dtype, pd.DatetimeTZDtype):
+        return {'kind': 'datetime', 'tz': values.dtype.tz, 'data': add(values.asi8.view('M8[ns]'))}
+
+    values = np.asarray(values)
+
+    if values.dtype == object:
+        codes, uniques = pd.factorize(values)
+        return {'kind': 'object', 'codes': add(codes.astype(np.int32)), 'uniques': list(uniques)}
+
+    return {'kind': 'array', 'data': add(values)}
+
+
+def _decode_values(spec: dict, get):
+    kind = spec['kind']
+
+    if kind == 'array':
+        return get(spec['data'])
+    elif kind == 'datetime':
+        return pd.arrays.DatetimeArray(get(spec['data']), dtype=pd.DatetimeTZDtype(tz=spec['tz']))
+    elif kind == 'category':
+        return pd.Categorical.from_codes(get(spec['codes']), categories=_decode_values(spec['categories'], get), ordered=spec['ordered'])
+    elif kind == 'object':
+        uniques = np.empty(len(spec['uniques']) + 1, dtype=object)
+        uniques[:-1] = spec['uniques']
+        uniques[-1] = np.nan
+
+        return uniques[get(spec['codes'])]
+
+
+def _encode_index(index: pd.Index, add) -> dict:
+    if isinstance(index, pd.MultiIndex):
+        return {'kind': 'multi', 'names': list(index.names), 'levels': [_encode_values(l, add) for l in index.levels], 'codes': [add(c) for c in index.codes]}
+    elif isinstance(index, pd.RangeIndex):
+        return {'kind': 'range', 'name': index.name, 'start': index.start, 'stop': index.stop, 'step': index.step}
+    else:
+        return {'kind': 'index', 'name': index.name, 'values': _encode_values(index, add)}
+
+
+def _decode_index(spec: dict, get) -> pd.Index:
+    kind = spec['kind']
+
+    if kind == 'multi':
+        return pd.MultiIndex(levels=[pd.Index(_decode_values(l, get)) for l in spec['levels']], codes=[get(c) for c in spec['codes']], names=spec['names'], verify_integrity=False)
+    elif kind == 'range':
+        return pd.RangeIndex(spec['start'], spec['stop'], spec['step'], name=spec['name'])
+    else:
+        return pd.Index(_decode_values(spec['values'], get), name=spec['name'])
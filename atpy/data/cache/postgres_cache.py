@@ -4,15 +4,19 @@ import os
 import queue
 import threading
 import typing
+import uuid
 from functools import partial
-from io import StringIO
+from io import StringIO, BytesIO
 
+import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.extras
 from dateutil import tz
 from dateutil.relativedelta import relativedelta
 
-from atpy.data.cache.lmdb_cache import write
+from atpy.data.cache.lmdb_cache import BatchWriter
+from atpy.data.splits_dividends import adjustment_factors, effective_times
 from atpy.data.ts_util import slice_periods
 
 
@@ -81,6 +85,90 @@ bars_indices = \
         TABLESPACE pg_default;
     """
 
+create_bars_partitioned = \
+    """
+    -- Table: public.{0}
+
+    DROP TABLE IF EXISTS public.{0};
+
+    CREATE TABLE public.{0}
+    (
+        "timestamp" timestamp without time zone NOT NULL,
+        symbol character varying COLLATE pg_catalog."default" NOT NULL,
+        open real NOT NULL,
+        high real NOT NULL,
+        low real NOT NULL,
+        close real NOT NULL,
+        period_volume integer NOT NULL,
+        "interval" character varying COLLATE pg_catalog."default" NOT NULL
+    ) PARTITION BY {1};
+    """
+
+create_bars_interval_partition = \
+    """
+    -- Table: public.{0}
+
+    CREATE TABLE IF NOT EXISTS public.{0} PARTITION OF public.{1}
+        FOR VALUES IN ('{2}')
+        PARTITION BY RANGE ("timestamp");
+    """
+
+create_bars_month_partition = \
+    """
+    -- Table: public.{0}
+
+    CREATE TABLE IF NOT EXISTS public.{0} PARTITION OF public.{1}
+        FOR VALUES FROM ('{2}') TO ('{3}');
+
+    -- Index: {0}_symbol_timestamp_ind
+
+    CREATE INDEX IF NOT EXISTS {0}_symbol_timestamp_ind
+        ON public.{0} USING btree
+        (symbol COLLATE pg_catalog."default", "timestamp")
+        TABLESPACE pg_default;
+    """
+
+create_bars_watermarks = \
+    """
+    -- Table: public.{0}_watermarks
+
+    DROP TABLE IF EXISTS public.{0}_watermarks;
+
+    CREATE TABLE public.{0}_watermarks
+    (
+        symbol character varying COLLATE pg_catalog."default" NOT NULL,
+        "interval" character varying COLLATE pg_catalog."default" NOT NULL,
+        "timestamp" timestamp without time zone NOT NULL,
+        PRIMARY KEY (symbol, "interval")
+    )
+    WITH (
+        OIDS = FALSE
+    )
+    TABLESPACE pg_default;
+    """
+
+create_adjustment_factors = \
+    """
+    -- Table: public.{0}
+
+    DROP TABLE IF EXISTS public.{0};
+
+    CREATE TABLE public.{0}
+    (
+        symbol character varying COLLATE pg_catalog."default" NOT NULL,
+        bgn_prd timestamp without time zone NOT NULL,
+        end_prd timestamp without time zone NOT NULL,
+        price_factor double precision NOT NULL,
+        price_offset double precision NOT NULL,
+        volume_factor double precision NOT NULL,
+        PRIMARY KEY (symbol, end_prd)
+    )
+    WITH (
+        OIDS = FALSE
+    )
+    TABLESPACE pg_default;
+    """
+
 create_json_data = \
     """
     -- Table: public.{0}
@@ -98,24 +186,50 @@ create_json_data = \
     """
 
 
-def update_to_latest(url: str, bars_table: str, noncache_provider: typing.Callable, symbols: set = None, time_delta_back: relativedelta = relativedelta(years=5), skip_if_older_than: relativedelta = None, cluster: bool = False):
+def update_to_latest(url: str, bars_table: str, noncache_provider: typing.Callable, symbols: set = None, time_delta_back: relativedelta = relativedelta(years=5), skip_if_older_than: relativedelta = None, cluster: bool = False,
+                     partitioned: bool = False, partition_by_interval: bool = False, adjustments_table: str = None):
+    """
+    Append the latest bars to the cache. The latest timestamp for each (symbol, interval) is read from the {bars_table}_watermarks table,
+    which is maintained by insert_df. This way the update only touches the new data and not the whole bars table
+    :param url: db connection string
+    :param bars_table: bars table name
+    :param noncache_provider: provider of the new data
+    :param symbols: set of (symbol, interval_len, interval_type) to include in addition to the ones in the cache
+    :param time_delta_back: how far back to go for new symbols
+    :param skip_if_older_than: skip symbols, whose latest bar is older than this
+    :param cluster: cluster the table after the update. For partitioned tables only the partitions, which received new data, are clustered
+    :param partitioned: if the table doesn't exist, create it with monthly range partitions by timestamp. The partitions are created on demand
+    :param partition_by_interval: if the table doesn't exist and partitioned is True, list partition the table by interval first and then by month
+    :param adjustments_table: json table with the splits/dividends (see request_adjustments). If not None, the cumulative adjustment factors
+            of the bars table are rebuilt after the update, so that the bars can be requested with adjusted=True
+    """
     con = psycopg2.connect(url)
     con.autocommit = True
     cur = con.cursor()
 
+    watermarks_table = bars_watermarks_table(bars_table)
+
     cur.execute("SELECT to_regclass('public.{0}')".format(bars_table))
 
     exists = [t for t in cur][0][0] is not None
 
     if not exists:
-        cur.execute(create_bars.format(bars_table))
+        if partitioned:
+            cur.execute(create_bars_partitioned.format(bars_table, 'LIST ("interval")' if partition_by_interval else 'RANGE ("timestamp")'))
+        else:
+            cur.execute(create_bars.format(bars_table))
 
-    if exists:
-        logging.getLogger(__name__).info("Skim off the top...")
-        cur.execute("delete from {0} where (symbol, timestamp, interval) in (select symbol, max(timestamp) as timestamp, interval from {0} group by symbol, interval)".format(bars_table))
+        cur.execute(create_bars_watermarks.format(bars_table))
+    else:
+        cur.execute("SELECT to_regclass('public.{0}')".format(watermarks_table))
+
+        if [t for t in cur][0][0] is None:
+            logging.getLogger(__name__).info("Building watermarks...")
+            cur.execute(create_bars_watermarks.format(bars_table))
+            cur.execute("INSERT INTO {0} (symbol, interval, timestamp) SELECT symbol, interval, max(timestamp) FROM {1} GROUP BY symbol, interval".format(watermarks_table, bars_table))
 
     logging.getLogger(__name__).info("Ranges...")
-    ranges = pd.read_sql("select symbol, max(timestamp) as timestamp, interval from {0} group by symbol, interval".format(bars_table), con=con, index_col=['symbol'])
+    ranges = pd.read_sql("select symbol, timestamp, interval from {0}".format(watermarks_table), con=con, index_col=['symbol'])
     if not ranges.empty:
         ranges['timestamp'] = ranges['timestamp'].dt.tz_localize('UTC')
 
@@ -124,7 +238,7 @@ def update_to_latest(url: str, bars_table: str, noncache_provider: typing.Callab
     if skip_if_older_than is not None:
         skip_if_older_than = datetime.datetime.utcnow().replace(tzinfo=tz.gettz('UTC')) - skip_if_older_than
 
-    filters = dict()
+    filters, existing = dict(), set()
     for row in ranges.iterrows():
         interval_len, interval_type = int(row[1][1].split('_')[0]), row[1][1].split('_')[1]
 
@@ -134,7 +248,9 @@ def update_to_latest(url: str, bars_table: str, noncache_provider: typing.Callab
         bgn_prd = row[1][0].to_pydatetime()
 
         if skip_if_older_than is None or bgn_prd > skip_if_older_than:
-            filters[BarsFilter(ticker=row[0], bgn_prd=bgn_prd, interval_len=interval_len, interval_type=interval_type)] = None
+            f = BarsFilter(ticker=row[0], bgn_prd=bgn_prd, interval_len=interval_len, interval_type=interval_type)
+            filters[f] = None
+            existing.add(f)
 
     bgn_prd = datetime.datetime.combine(datetime.datetime.utcnow().date() - time_delta_back, datetime.datetime.min.time()).replace(tzinfo=tz.gettz('UTC'))
     for (symbol, interval_len, interval_type) in new_symbols:
@@ -142,6 +258,18 @@ def update_to_latest(url: str, bars_table: str, noncache_provider: typing.Callab
 
     logging.getLogger(__name__).info("Updating " + str(len(filters)) + " total symbols and intervals; New symbols and intervals: " + str(len(new_symbols)))
 
+    partitioning = bars_partitioning(cur, bars_table)
+
+    partitions = list()
+    if partitioning is not None and len(filters) > 0:
+        logging.getLogger(__name__).info("Partitions...")
+
+        # daily bars are requested by (US/Eastern) date, which might be a day before the UTC bgn_prd
+        partitions = create_bars_partitions(cur, bars_table,
+                                            bgn_prd=min(f.bgn_prd for f in filters) - relativedelta(days=1),
+                                            end_prd=datetime.datetime.utcnow() + relativedelta(days=1),
+                                            intervals={str(f.interval_len) + '_' + f.interval_type for f in filters})
+
     q = queue.Queue(maxsize=100)
 
     threading.Thread(target=partial(noncache_provider, filters=filters, q=q), daemon=True).start()
@@ -150,7 +278,6 @@ def update_to_latest(url: str, bars_table: str, noncache_provider: typing.Callab
 
     def worker():
         con = psycopg2.connect(url)
-        con.autocommit = True
 
         while True:
             tupl = q.get()
@@ -167,12 +294,16 @@ def update_to_latest(url: str, bars_table: str, noncache_provider: typing.Callab
 
             df['interval'] = str(ft.interval_len) + '_' + ft.interval_type
 
-            if df.iloc[0].name == ft.bgn_prd:
-                df = df.iloc[1:]
-
             try:
-                insert_df(con, bars_table, df)
+                # the last cached bar might have been incomplete. The new data overlaps with it, so the old bars are replaced within the same transaction
+                if ft in existing and not df.empty:
+                    cursor = con.cursor()
+                    cursor.execute("DELETE FROM {0} WHERE symbol = %s AND interval = %s AND timestamp >= %s".format(bars_table), (ft.ticker, df['interval'].iloc[0], str(df.index.min())))
+                    cursor.close()
+
+                insert_df(con, bars_table, df, watermarks_table=watermarks_table)
             except Exception as err:
+                con.rollback()
                 logging.getLogger(__name__).error("Error saving " + ft.ticker)
                 logging.getLogger(__name__).exception(err)
 
@@ -191,15 +322,170 @@ def update_to_latest(url: str, bars_table: str, noncache_provider: typing.Callab
 
     logging.getLogger(__name__).info("Done inserting data")
 
-    if not exists:
+    if partitioning is not None:
+        # the partitions have their own indices. The partitioned table itself can't be clustered
+        if cluster and len(partitions) > 0:
+            logging.getLogger(__name__).info("Cluster " + str(len(partitions)) + " partitions...")
+            for p in partitions:
+                cur.execute("CLUSTER {0} USING {0}_symbol_timestamp_ind".format(p))
+    elif not exists:
         logging.getLogger(__name__).info("Creating indices...")
         cur.execute(bars_indices.format(bars_table))
     elif cluster:
         logging.getLogger(__name__).info("Cluster...")
         cur.execute("CLUSTER {0}".format(bars_table))
 
+    if adjustments_table is not None:
+        logging.getLogger(__name__).info("Adjustment factors...")
+
+        # the factors are replaced within a single transaction
+        adjustments_con = psycopg2.connect(url)
+        try:
+            update_adjustment_factors(adjustments_con, adjustments_table, adjustment_factors_table(bars_table))
+        finally:
+            adjustments_con.close()
+
+
+def bars_partitioning(cursor, bars_table: str):
+    """
+    :param cursor: db cursor
+    :param bars_table: bars table name
+    :return: None if the table is not partitioned, 'list' if it is partitioned by interval (and then by month) or 'range' if it's partitioned by month
+    """
+    cursor.execute("SELECT partstrat FROM pg_partitioned_table WHERE partrelid = %s::regclass", (bars_table,))
+    strategy = cursor.fetchone()
+
+    if strategy is None:
+        return None
+
+    return {'l': 'list', 'r': 'range'}[strategy[0]]
+
+
+def create_bars_partitions(cursor, bars_table: str, bgn_prd: datetime.datetime, end_prd: datetime.datetime, intervals: set = None):
+    """
+    Create the monthly partitions (if they don't exist) of a partitioned bars table
+    :param cursor: db cursor
+    :param bars_table: bars table name
+    :param bgn_prd: start period (including)
+    :param end_prd: end period (including)
+    :param intervals: set of intervals (for example '60_s'). Only used if the table is partitioned by interval
+    :return: list of the names of the monthly partitions, which cover the period
+    """
+    partitioning = bars_partitioning(cursor, bars_table)
+
+    if partitioning == 'list':
+        parents = list()
+        for interval in sorted(intervals):
+            parent = bars_table + '_' + interval
+            cursor.execute(create_bars_interval_partition.format(parent, bars_table, interval))
+            parents.append(parent)
+    elif partitioning == 'range':
+        parents = [bars_table]
+    else:
+        raise Exception("Table " + bars_table + " is not partitioned")
+
+    bgn_prd, end_prd = [pd.Timestamp(p).tz_convert('UTC').tz_localize(None) if pd.Timestamp(p).tz is not None else pd.Timestamp(p) for p in (bgn_prd, end_prd)]
+    months = pd.date_range(bgn_prd.to_period('M').to_timestamp(), end_prd, freq='MS')
+
+    partitions = list()
+    for parent in parents:
+        for m in months:
+            partition = parent + '_' + m.strftime('%Y_%m')
+            cursor.execute(create_bars_month_partition.format(partition, parent, m.strftime('%Y-%m-%d'), (m + pd.offsets.MonthBegin()).strftime('%Y-%m-%d')))
+            partitions.append(partition)
+
+    return partitions
+
+
+def bars_watermarks_table(bars_table: str):
+    """
+    :param bars_table: bars table name
+    :return: name of the table, which holds the latest timestamp for each symbol/interval of the bars table
+    """
+    return bars_table + '_watermarks'
+
+
+def adjustment_factors_table(bars_table: str):
+    """
+    :param bars_table: bars table name
+    :return: name of the table, which holds the cumulative adjustment factors for the bars table
+    """
+    return bars_table + '_adjustments'
+
+
+def update_adjustment_factors(conn, adjustments_table: str, factors_table: str, provider: str = None):
+    """
+    Rebuild the cumulative adjustment factors from the splits/dividends in the json table. Each row of the factors table applies to the bars of its symbol
+    with bgn_prd < timestamp <= end_prd (end_prd is the effective time of the adjustment in UTC, see splits_dividends.effective_time) as price * price_factor + price_offset and volume * volume_factor.
+    Unlike adjust_df, all the adjustments after a bar are applied (and not only the ones within the requested period)
+    :param conn: db connection
+    :param adjustments_table: json table with the splits/dividends
+    :param factors_table: adjustment factors table name. It's created, if it doesn't exist
+    :param provider: data provider of the adjustments
+    """
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT to_regclass('public.{0}')".format(factors_table))
+    if cursor.fetchone()[0] is None:
+        cursor.execute(create_adjustment_factors.format(factors_table))
+
+    adjustments = request_adjustments(conn, adjustments_table, provider=provider)
+
+    rows = list()
+    if adjustments is not None:
+        factors = adjustment_factors(adjustments[['value']])
+
+        symbols = factors.index.get_level_values('symbol')
+
+        # the bars are stored in UTC
+        end_prd = pd.DatetimeIndex(effective_times(factors.index.get_level_values('timestamp'), datetime.timezone.utc))
+
+        # the first factor of a (symbol, day) contains all the adjustments of that day
+        first = ~pd.Index(list(zip(symbols, end_prd))).duplicated()
+
+        bgn_prd = datetime.datetime.min
+        for i in np.flatnonzero(first):
+            if i == 0 or symbols[i] != symbols[i - 1]:
+                bgn_prd = datetime.datetime.min
+
+            rows.append((symbols[i], bgn_prd, end_prd[i].to_pydatetime(), float(factors['price_factor'].iloc[i]), float(factors['price_offset'].iloc[i]), float(factors['volume_factor'].iloc[i])))
+            bgn_prd = end_prd[i].to_pydatetime()
+
+    cursor.execute("DELETE FROM {0}".format(factors_table))
+
+    if len(rows) > 0:
+        psycopg2.extras.execute_values(cursor, "INSERT INTO {0} (symbol, bgn_prd, end_prd, price_factor, price_offset, volume_factor) VALUES %s".format(factors_table), rows)
+
+    conn.commit()
+    cursor.close()
+
+
+def _adjusted_bars(bars_table: str):
+    """
+    :param bars_table: bars table name
+    :return: subquery, which applies the cumulative adjustment factors to the bars of the table
+    """
+    prices = ', '.join("b.{0} * coalesce(a.price_factor, 1) + coalesce(a.price_offset, 0) AS {0}".format(c) for c in ['open', 'high', 'low', 'close'])
+
+    return "(SELECT b.timestamp, b.symbol, {0}, CAST(trunc(b.period_volume * coalesce(a.volume_factor, 1)) AS bigint) AS period_volume, b.interval " \
+           "FROM {1} b LEFT JOIN {2} a ON a.symbol = b.symbol AND b.timestamp > a.bgn_prd AND b.timestamp <= a.end_prd) adjusted".format(prices, bars_table, adjustment_factors_table(bars_table))
+
+
+def request_watermarks(conn, bars_table: str):
+    """
+    Request the latest timestamp for each symbol/interval in the bars table
+    :param conn: connection
+    :param bars_table: bars table name
+    :return: series with (symbol, interval) index
+    """
+    df = pd.read_sql("SELECT symbol, interval, timestamp FROM {0}".format(bars_watermarks_table(bars_table)), con=conn, index_col=['symbol', 'interval'])
+    df['timestamp'] = df['timestamp'].dt.tz_localize('UTC')
+
+    return df['timestamp']
+
 
-def request_bars(conn, bars_table: str, interval_len: int, interval_type: str, symbol: typing.Union[list, str] = None, bgn_prd: datetime.datetime = None, end_prd: datetime.datetime = None, ascending=True, selection='*'):
+def request_bars(conn, bars_table: str, interval_len: int, interval_type: str, symbol: typing.Union[list, str] = None, bgn_prd: datetime.datetime = None, end_prd: datetime.datetime = None, ascending=True, selection='*',
+                 fetch_size: int = 100000, adjusted: bool = False):
     """
     Request bar data
     :param conn: connection
@@ -211,18 +497,61 @@ def request_bars(conn, bars_table: str, interval_len: int, interval_type: str, s
     :param end_prd: end period (excluding)
     :param ascending: asc/desc
     :param selection: what to select
+    :param fetch_size: number of rows, fetched from the server at once
+    :param adjusted: apply the splits/dividends adjustment factors (see update_adjustment_factors) within the query
     :return: dataframe
     """
+    chunks = list(_request_bars_stream(conn=conn, bars_table=bars_table, interval_len=interval_len, interval_type=interval_type, symbol=symbol, bgn_prd=bgn_prd, end_prd=end_prd, ascending=ascending, selection=selection,
+                                       fetch_size=fetch_size, adjusted=adjusted))
+
+    return _format_bars(pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0], symbol=symbol)
+
+
+def request_bars_chunks(conn, bars_table: str, interval_len: int, interval_type: str, symbol: typing.Union[list, str] = None, bgn_prd: datetime.datetime = None, end_prd: datetime.datetime = None, ascending=True, selection='*',
+                        chunk_size: int = 100000, adjusted: bool = False):
+    """
+    Request bar data as a generator of dataframes with (at most) chunk_size rows. The data is streamed through a server side cursor,
+    so only one chunk is held in memory at a time
+    :param conn: connection
+    :param bars_table: table name
+    :param interval_len: interval len
+    :param interval_type: interval type
+    :param symbol: symbol or a list of symbols
+    :param bgn_prd: start period (including)
+    :param end_prd: end period (excluding)
+    :param ascending: asc/desc
+    :param selection: what to select
+    :param chunk_size: number of rows in each chunk (and fetched from the server at once)
+    :param adjusted: apply the splits/dividends adjustment factors (see update_adjustment_factors) within the query
+    :return: generator of dataframes
+    """
+    for df in _request_bars_stream(conn=conn, bars_table=bars_table, interval_len=interval_len, interval_type=interval_type, symbol=symbol, bgn_prd=bgn_prd, end_prd=end_prd, ascending=ascending, selection=selection,
+                                   fetch_size=chunk_size, adjusted=adjusted):
+        if not df.empty:
+            yield _format_bars(df, symbol=symbol)
+
+
+def _request_bars_stream(conn, bars_table: str, interval_len: int, interval_type: str, symbol: typing.Union[list, str] = None, bgn_prd: datetime.datetime = None, end_prd: datetime.datetime = None, ascending=True, selection='*',
+                         fetch_size: int = 100000, order_by_symbol=False, adjusted: bool = False):
+    """
+    :return: generator of raw (unindexed) dataframes with at most fetch_size rows each
+    """
     where, params = __bars_query_where(interval_len=interval_len, interval_type=interval_type, symbol=symbol, bgn_prd=bgn_prd, end_prd=end_prd)
 
     sort = 'ASC' if ascending else 'DESC'
 
-    df = pd.read_sql("SELECT " + selection + " FROM " + bars_table + where + " ORDER BY timestamp " + sort + ", symbol", con=conn, index_col=['timestamp', 'symbol'], params=params)
+    order = " ORDER BY symbol, timestamp " + sort if order_by_symbol else " ORDER BY timestamp " + sort + ", symbol"
+
+    return stream_query(conn, "SELECT " + selection + " FROM " + (_adjusted_bars(bars_table) if adjusted else bars_table) + where + order, params=params, fetch_size=fetch_size)
+
+
+def _format_bars(df: pd.DataFrame, symbol: typing.Union[list, str] = None, index: list = ('timestamp', 'symbol')):
+    df = df.set_index(list(index))
 
     if not df.empty:
         del df['interval']
 
-        df.tz_localize('UTC', level='timestamp', copy=False)
+        df = df.tz_localize('UTC', level='timestamp', copy=False)
 
         if isinstance(symbol, str):
             df.reset_index(level='symbol', inplace=True, drop=True)
@@ -233,6 +562,76 @@ def request_bars(conn, bars_table: str, interval_len: int, interval_type: str, s
     return df
 
 
+# numpy dtypes of the decoded PostgreSQL types (by type oid). The rest are decoded as objects
+_pg_numpy_types = {16: np.bool_, 20: np.int64, 21: np.int64, 23: np.int64, 700: np.float64, 701: np.float64, 1114: 'datetime64[us]'}
+
+
+def stream_query(conn, query: str, params: list = None, fetch_size: int = 100000):
+    """
+    Execute query with a named (server side) cursor and decode the result into dataframes of at most fetch_size rows.
+    If the result is empty, a single empty dataframe with the result columns is generated
+    :param conn: psycopg2 connection or sqlalchemy engine
+    :param query: query
+    :param params: query parameters
+    :param fetch_size: number of rows, fetched from the server at once
+    :return: generator of dataframes
+    """
+    raw_conn = conn.raw_connection() if hasattr(conn, 'raw_connection') else None
+
+    cursor = (raw_conn or conn).cursor(name='stream_' + uuid.uuid4().hex, withhold=(raw_conn or conn).autocommit)
+
+    try:
+        cursor.itersize = fetch_size
+        cursor.execute(query, params)
+
+        empty = True
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if len(rows) == 0 and not empty:
+                break
+
+            empty = False
+
+            yield _rows_to_df(rows, cursor.description)
+
+            if len(rows) < fetch_size:
+                break
+    finally:
+        cursor.close()
+
+        if raw_conn is not None:
+            raw_conn.close()
+
+
+def _rows_to_df(rows: list, description):
+    """
+    Decode the rows into numpy column buffers
+    :param rows: list of row tuples
+    :param description: cursor description
+    :return: dataframe
+    """
+    columns = dict()
+
+    for i, c in enumerate(description):
+        dtype = _pg_numpy_types.get(c.type_code, object)
+        buffer = np.empty(len(rows), dtype=dtype)
+
+        try:
+            buffer[:] = [r[i] for r in rows]
+        except (TypeError, ValueError):
+            if dtype == np.float64:
+                # nulls in float columns are NaN (like read_sql)
+                buffer[:] = [np.nan if r[i] is None else r[i] for r in rows]
+            else:
+                # nulls in integer/boolean columns
+                buffer = np.empty(len(rows), dtype=object)
+                buffer[:] = [r[i] for r in rows]
+
+        columns[c.name] = buffer
+
+    return pd.DataFrame(columns, columns=[c.name for c in description])
+
+
 def request_symbol_counts(conn, bars_table: str, interval_len: int, interval_type: str, symbol: typing.Union[list, str] = None, bgn_prd: datetime.datetime = None, end_prd: datetime.datetime = None):
     """
     Request number of bars for each symbol
@@ -281,19 +680,14 @@ def __bars_query_where(interval_len: int, interval_type: str, symbol: typing.Uni
     return where, params
 
 
-def insert_df(conn, table_name: str, df: pd.DataFrame):
+def insert_df(conn, table_name: str, df: pd.DataFrame, watermarks_table: str = None):
     """
-    insert dataframe to the database
+    insert dataframe to the database using binary COPY
     :param conn: db connection
     :param table_name: table name
     :param df: dataframe to insert
+    :param watermarks_table: if not None, the latest timestamp for each symbol/interval of the df is upserted in this table within the same transaction
     """
-    # To CSV
-    output = StringIO()
-    df.to_csv(output, sep='\t', header=False)
-    output.seek(0)
-
-    # Insert data
     cursor = conn.cursor()
 
     if isinstance(df.index, pd.MultiIndex):
@@ -301,11 +695,201 @@ def insert_df(conn, table_name: str, df: pd.DataFrame):
     else:
         columns = [df.index.name] + list(df.columns)
 
-    cursor.copy_from(output, table_name, sep='\t', null='', columns=columns)
+    output = BytesIO(to_binary_copy(df, column_types(cursor, table_name, columns)))
+
+    cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT binary)".format(table_name, ', '.join('"' + c + '"' for c in columns)), output)
+
+    if watermarks_table is not None and not df.empty:
+        _upsert_watermarks(cursor, watermarks_table, df)
+
     conn.commit()
     cursor.close()
 
 
+def column_types(cursor, table_name: str, columns: list):
+    """
+    :param cursor: db cursor
+    :param table_name: table name
+    :param columns: list of column names
+    :return: list of PostgreSQL type names (as in pg_type.typname) for each of the columns
+    """
+    cursor.execute("SELECT a.attname, t.typname FROM pg_attribute a JOIN pg_type t ON a.atttypid = t.oid WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped", (table_name,))
+    types = dict(cursor.fetchall())
+
+    return [types[c] for c in columns]
+
+
+_binary_copy_header = b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8
+
+_binary_copy_trailer = b'\xff\xff'
+
+_binary_numeric_types = {'float4': '>f4', 'float8': '>f8', 'int2': '>i2', 'int4': '>i4', 'int8': '>i8', 'bool': '?'}
+
+_binary_string_types = {'varchar', 'text', 'bpchar'}
+
+# microseconds/days between the unix and the PostgreSQL epochs (2000-01-01)
+_pg_epoch_us = 946684800000000
+
+_pg_epoch_days = 10957
+
+
+def to_binary_copy(df: pd.DataFrame, types: list) -> bytes:
+    """
+    Encode dataframe in the PostgreSQL binary COPY format. Each column is packed at once from its numpy array
+    :param df: dataframe. The index levels are encoded first, followed by the columns (the same order as the COPY column list)
+    :param types: PostgreSQL type name (pg_type.typname) for each index level and column
+    :return: binary COPY data
+    """
+    if isinstance(df.index, pd.MultiIndex):
+        values = [df.index.get_level_values(i) for i in range(df.index.nlevels)] + [df[c] for c in df.columns]
+    else:
+        values = [df.index] + [df[c] for c in df.columns]
+
+    fields = [_binary_field(v, t) for v, t in zip(values, types)]
+
+    n = len(df)
+
+    # each row is a 2 byte field count, followed by 4 byte length and payload for each field (nulls have length -1 and no payload)
+    row_sizes = np.full(n, 2, dtype=np.int64)
+    for lengths, _ in fields:
+        row_sizes += 4 + np.maximum(lengths, 0)
+
+    row_starts = np.empty(n, dtype=np.int64)
+    row_starts[:1] = len(_binary_copy_header)
+    np.cumsum(row_sizes[:-1], out=row_starts[1:])
+    row_starts[1:] += len(_binary_copy_header)
+
+    total = len(_binary_copy_header) + int(row_sizes.sum()) + len(_binary_copy_trailer)
+    result = np.empty(total, dtype=np.uint8)
+    result[:len(_binary_copy_header)] = np.frombuffer(_binary_copy_header, dtype=np.uint8)
+    result[total - len(_binary_copy_trailer):] = np.frombuffer(_binary_copy_trailer, dtype=np.uint8)
+
+    field_count = np.frombuffer(np.array(len(fields), dtype='>i2').tobytes(), dtype=np.uint8)
+
+    if n > 0 and all([(lengths == lengths[0]).all() and lengths[0] >= 0 for lengths, _ in fields]):
+        # all rows have the same layout (no nulls and equal length of each field), so the rows can be filled as a 2d array
+        rows = result[len(_binary_copy_header):total - len(_binary_copy_trailer)].reshape(n, int(row_sizes[0]))
+        rows[:, :2] = field_count
+
+        offset = 2
+        for lengths, payload in fields:
+            size = int(lengths[0])
+            rows[:, offset:offset + 4] = np.frombuffer(np.array(size, dtype='>i4').tobytes(), dtype=np.uint8)
+            rows[:, offset + 4:offset + 4 + size] = payload.reshape(n, size)
+            offset += 4 + size
+
+        return result.tobytes()
+
+    result[row_starts[:, None] + np.arange(2)] = field_count
+
+    offsets = row_starts + 2
+    for lengths, payload in fields:
+        result[offsets[:, None] + np.arange(4)] = lengths.astype('>i4').view(np.uint8).reshape(-1, 4)
+
+        sizes = np.maximum(lengths, 0)
+        if payload.size > 0:
+            # destination of each payload byte is the start of its field plus its position within the field
+            ends = np.cumsum(sizes)
+            result[np.repeat(offsets + 4 - (ends - sizes), sizes) + np.arange(payload.size)] = payload
+
+        offsets += 4 + sizes
+
+    return result.tobytes()
+
+
+def _binary_field(values, typ: str):
+    """
+    :param values: array-like values of a single column
+    :param typ: PostgreSQL type name
+    :return: tuple of per-row payload lengths (-1 for null) and the concatenated payloads of all non-null values as uint8 array
+    """
+    if typ in ('timestamp', 'timestamptz', 'date'):
+        values = pd.DatetimeIndex(values)
+        if values.tz is not None and typ != 'timestamptz':
+            # timestamp without time zone stores the local time, like the text representation does
+            values = values.tz_localize(None)
+
+        nulls = values.isna()
+        if typ == 'date':
+            data = (values.values.astype('datetime64[D]').astype(np.int64) - _pg_epoch_days).astype('>i4')
+        else:
+            data = (values.values.astype('datetime64[us]').astype(np.int64) - _pg_epoch_us).astype('>i8')
+    elif typ in _binary_numeric_types:
+        values = np.asarray(values)
+        nulls = pd.isnull(values)
+        if nulls.any():
+            values = np.where(nulls, 0, values)
+
+        if typ in ('int2', 'int4', 'int8'):
+            _check_integers(values, typ)
+
+        data = values.astype(_binary_numeric_types[typ])
+    elif typ in _binary_string_types:
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        encoded = np.array([u.encode('utf-8') if isinstance(u, str) else str(u).encode('utf-8') for u in uniques] + [b''], dtype=object)
+
+        nulls = codes < 0
+        lengths = np.array([len(e) for e in encoded], dtype=np.int32)[codes]
+        lengths[nulls] = -1
+
+        return lengths, np.frombuffer(b''.join(encoded[codes[~nulls]]), dtype=np.uint8)
+    else:
+        raise Exception("Unsupported type " + typ + " for binary COPY")
+
+    nulls = np.asarray(nulls)
+    lengths = np.full(len(data), data.dtype.itemsize, dtype=np.int32)
+    lengths[nulls] = -1
+
+    return lengths, data[~nulls].view(np.uint8) if nulls.any() else data.view(np.uint8)
+
+
+def _check_integers(values: np.ndarray, typ: str):
+    """
+    The binary COPY casts the values to the column type. Raise, if the cast would lose data (like the text COPY fails on invalid input)
+    :param values: non-null values
+    :param typ: PostgreSQL integer type name
+    """
+    if values.size == 0 or values.dtype.kind == 'b':
+        return
+
+    info = np.iinfo(_binary_numeric_types[typ])
+
+    if values.dtype.kind in 'iu':
+        valid = info.min <= values.min() and values.max() <= info.max
+    else:
+        try:
+            floats = values.astype(np.float64)
+        except (TypeError, ValueError):
+            raise Exception("Invalid values for column type " + typ)
+
+        with np.errstate(invalid='ignore'):
+            valid = np.isfinite(floats).all() and (floats == np.trunc(floats)).all() and info.min <= floats.min() and floats.max() <= info.max
+
+    if not valid:
+        raise Exception("Values out of range or not integer for column type " + typ)
+
+
+def _upsert_watermarks(cursor, watermarks_table: str, df: pd.DataFrame):
+    """
+    upsert the latest timestamp for each symbol/interval of the dataframe
+    :param cursor: db cursor
+    :param watermarks_table: watermarks table name
+    :param df: dataframe with timestamp, symbol and interval columns/index levels
+    """
+    values = {c: df.index.get_level_values(c) if c in df.index.names else df[c].values for c in ['timestamp', 'symbol', 'interval']}
+
+    timestamps = pd.DatetimeIndex(values['timestamp'])
+    if timestamps.tz is not None:
+        values['timestamp'] = timestamps.tz_convert('UTC').tz_localize(None)
+
+    latest = pd.DataFrame(values).groupby(['symbol', 'interval'], sort=False)['timestamp'].max()
+
+    psycopg2.extras.execute_values(cursor,
+                                   "INSERT INTO {0} (symbol, interval, timestamp) VALUES %s "
+                                   "ON CONFLICT (symbol, interval) DO UPDATE SET timestamp = GREATEST({0}.timestamp, EXCLUDED.timestamp)".format(watermarks_table),
+                                   [(s, i, t.to_pydatetime()) for (s, i), t in latest.items()])
+
+
 def insert_df_json(conn, table_name: str, df: pd.DataFrame):
     """
     insert dataframe in json table
@@ -343,6 +927,7 @@ def request_adjustments(conn, table_name: str, symbol: typing.Union[list, str] =
     :param end_prd: end period
     :param provider: data provider
     :param adj_type: adjustment type (split/dividend)
+    :return: dataframe or None, if there are no adjustments
     """
     where = " WHERE 1=1"
     params = list()
@@ -376,6 +961,7 @@ def request_adjustments(conn, table_name: str, symbol: typing.Union[list, str] =
     cursor.execute("select * from {0} {1}".format(table_name, where), params)
     records = cursor.fetchall()
 
+    df = None
     if len(records) > 0:
         df = pd.DataFrame([x[0] for x in records])
         df['timestamp'] = pd.to_datetime(df['timestamp'], unit='ms')
@@ -392,7 +978,7 @@ class BarsInPeriodProvider(object):
     """
 
     def __init__(self, conn, bars_table: str, bgn_prd: datetime.datetime, delta: relativedelta, interval_len: int, interval_type: str, symbol: typing.Union[list, str] = None, ascend: bool = True, overlap: relativedelta = None,
-                 cache: typing.Callable = None):
+                 cache: typing.Callable = None, adjusted: bool = False):
         self._periods = slice_periods(bgn_prd=bgn_prd, delta=delta, ascend=ascend, overlap=overlap)
 
         self.conn = conn
@@ -402,6 +988,7 @@ class BarsInPeriodProvider(object):
         self.symbol = symbol
         self.ascending = ascend
         self.cache = cache
+        self.adjusted = adjusted
 
     def __iter__(self):
         self._deltas = -1
@@ -417,20 +1004,27 @@ class BarsInPeriodProvider(object):
                     return result
 
             return request_bars(conn=self.conn, bars_table=self.bars_table, symbol=self.symbol, interval_len=self.interval_len, interval_type=self.interval_type, bgn_prd=self._periods[self._deltas][0],
-                                end_prd=self._periods[self._deltas][1], ascending=self.ascending)
+                                end_prd=self._periods[self._deltas][1], ascending=self.ascending, adjusted=self.adjusted)
         else:
             raise StopIteration
 
     def current_cache_key(self):
-        return str(self._periods[self._deltas][0]) + ' - ' + str(self._periods[self._deltas][1]) + ' - ' + str(self.interval_len) + str(self.interval_type)
+        return str(self._periods[self._deltas][0]) + ' - ' + str(self._periods[self._deltas][1]) + ' - ' + str(self.interval_len) + str(self.interval_type) + (' - adjusted' if self.adjusted else '')
 
 
-def bars_to_lmdb(provider: BarsInPeriodProvider, lmdb_path: str = None):
+def bars_to_lmdb(provider: BarsInPeriodProvider, lmdb_path: str = None, max_batch_bytes: int = 2 ** 30):
+    """
+    Store all the results of the provider in lmdb. The data is written in large transactions
+    :param provider: bars provider
+    :param lmdb_path: path to the lmdb database
+    :param max_batch_bytes: size of the encoded data in each transaction
+    """
     if lmdb_path is None:
         lmdb_path = os.environ['ATPY_LMDB_PATH']
 
-    for df in provider:
-        write(provider.current_cache_key(), df, lmdb_path)
+    with BatchWriter(lmdb_path, max_batch_bytes=max_batch_bytes) as writer:
+        for df in provider:
+            writer.write(provider.current_cache_key(), df)
 
 
 class BarsBySymbolProvider(object):
@@ -438,15 +1032,17 @@ class BarsBySymbolProvider(object):
     OHLCV Bars for symbols provider
     """
 
-    def __init__(self, conn, records_per_query: int, table_name: str, interval_len: int, interval_type: str, bgn_prd: datetime.datetime = None, end_prd: datetime.datetime = None, symbol: typing.Union[list, str] = None):
+    def __init__(self, conn, records_per_query: int, table_name: str, interval_len: int, interval_type: str, bgn_prd: datetime.datetime = None, end_prd: datetime.datetime = None, symbol: typing.Union[list, str] = None,
+                 fetch_size: int = 100000):
         """
         add a list of splits/dividends to the database
         :param conn: db connection
-        :param records_per_query: how many records should a query retrieve
+        :param records_per_query: minimum number of records in each result (each result contains all the records of its symbols)
         :param table_name: db connection
         :param bgn_prd: begin period
         :param end_prd: end period
         :param symbol: symbol / list of symbols
+        :param fetch_size: number of rows, fetched from the server at once
         """
 
         self.conn = conn
@@ -457,34 +1053,63 @@ class BarsBySymbolProvider(object):
         self.interval_len = interval_len
         self.interval_type = interval_type
         self.symbol = symbol
+        self.fetch_size = fetch_size
 
     def __iter__(self):
-        self._symbol_counts = request_symbol_counts(conn=self.conn,
-                                                    bars_table=self.bars_table,
-                                                    interval_len=self.interval_len,
-                                                    interval_type=self.interval_type,
-                                                    symbol=self.symbol,
-                                                    bgn_prd=self.bgn_prd,
-                                                    end_prd=self.end_prd)
-
-        self._current = 0
+        self._chunks = self._request_chunks()
 
         return self
 
     def __next__(self):
-        current_count = 0
-        symbols = list()
+        return next(self._chunks)
 
-        while current_count < self.records_per_query and self._current < len(self._symbol_counts):
-            symbols.append(self._symbol_counts.index[self._current])
-            current_count += self._symbol_counts[self._current]
-            self._current += 1
+    def _request_chunks(self):
+        """
+        The bars of all symbols are streamed with a single query ordered by symbol. Once enough records are accumulated, the complete symbols are returned
+        """
+        pending, pending_len = list(), 0
 
-        if len(symbols) > 0:
-            result = request_bars(conn=self.conn, bars_table=self.bars_table, symbol=symbols, interval_len=self.interval_len, interval_type=self.interval_type, bgn_prd=self.bgn_prd, end_prd=self.end_prd)
-            if isinstance(result.index, pd.MultiIndex) and result.index.names.index('symbol') > 0:
-                result = result.swaplevel(0, 1).sort_index()
+        for df in _request_bars_stream(conn=self.conn, bars_table=self.bars_table, symbol=self.symbol, interval_len=self.interval_len, interval_type=self.interval_type, bgn_prd=self.bgn_prd, end_prd=self.end_prd,
+                                       fetch_size=self.fetch_size, order_by_symbol=True):
+            if df.empty:
+                continue
 
-            return result
-        else:
-            raise StopIteration
+            pending.append(df)
+            pending_len += len(df)
+
+            if pending_len >= self.records_per_query:
+                # the last symbol might continue in the next chunk
+                results, remainder = self._split_symbols(pd.concat(pending, ignore_index=True) if len(pending) > 1 else pending[0], complete=False)
+
+                yield from results
+
+                pending, pending_len = [remainder], len(remainder)
+
+        if pending_len > 0:
+            results, remainder = self._split_symbols(pd.concat(pending, ignore_index=True) if len(pending) > 1 else pending[0], complete=True)
+
+            yield from results
+
+            if not remainder.empty:
+                yield self._format(remainder)
+
+    def _split_symbols(self, df: pd.DataFrame, complete: bool):
+        """
+        Split symbol ordered data in results of complete symbols with at least records_per_query records each
+        :param df: symbol ordered data
+        :param complete: whether the last symbol of df is complete
+        :return: tuple of list of results and the remaining data
+        """
+        symbols = df['symbol'].values
+        ends = (np.flatnonzero(symbols[1:] != symbols[:-1]) + 1).tolist() + ([len(df)] if complete else [])
+
+        results, start = list(), 0
+        for end in ends:
+            if end - start >= self.records_per_query:
+                results.append(self._format(df.iloc[start:end]))
+                start = end
+
+        return results, df.iloc[start:]
+
+    def _format(self, df: pd.DataFrame):
+        return _format_bars(df, symbol=self.symbol, index=['symbol', 'timestamp'])
@@ -0,0 +1,305 @@
+"""
+Incremental (streaming) indicators.
+"""
+import collections
+
+import numpy as np
+import pandas as pd
+
+
+class RollingIndicator(object):
+    """
+    Incremental rolling indicator over a column of consecutive (and possibly overlapping) DataFrames with either DatetimeIndex
+    or MultiIndex with datetime and 'symbol' levels, like the ones produced by DataReplay.
+    Only the rows with timestamps newer than the last processed timestamp are computed, using per-symbol ring buffers and running sums.
+    The values for the older rows are taken from the history of the results.
+    Rolling min/max are computed with monotonic deques (amortized O(1) per row).
+    """
+
+    indicators = {'mean', 'std', 'min', 'max', 'ewma'}
+
+    def __init__(self, indicator: str, window: int):
+        """
+        :param indicator: one of mean, std, min, max (over the last window observations of each symbol) or ewma (exponentially weighted mean with span=window)
+        :param window: window size
+        """
+        if indicator not in self.indicators:
+            raise Exception("Unsupported indicator " + str(indicator))
+
+        self.indicator = indicator
+        self.window = window
+
+        self._symbols = pd.Index([])
+
+        # ring buffers of the last window values of each symbol
+        self._buffer = np.empty((0, window))
+        self._count = np.zeros(0, dtype=np.int64)
+
+        # running sums of the values in the buffers. The values are shifted by the (periodically updated) mean for numerical stability
+        self._shift = np.zeros(0)
+        self._sum = np.zeros(0)
+        self._sum_sq = np.zeros(0)
+        self._nans = np.zeros(0, dtype=np.int64)
+
+        # monotonic deques of (position, value) of each symbol for min/max
+        self._extrema = list()
+
+        # exponentially weighted sums
+        self._alpha = 2 / (window + 1)
+        self._ewm_sum = np.zeros(0)
+        self._ewm_weight = np.zeros(0)
+        self._ewm_mean = np.zeros(0)
+
+        # history of the results (timestamp x symbol). The i-th processed timestamp is stored in the i % capacity row
+        self._history_timestamps = np.empty(0, dtype=np.int64)
+        self._history = np.empty((0, 0))
+        self._processed = 0
+
+    def __call__(self, df: pd.DataFrame, column: str = 'close', full_history: bool = True):
+        """
+        Process the new rows of the DataFrame
+        :param df: DataFrame
+        :param column: column name
+        :param full_history: if True, the values are computed over the full history of the symbols. If False, the first window - 1 rows
+                of each symbol in df are nan, like df[column].groupby(level='symbol').rolling(window) (see ts_util.rolling_mean).
+                Doesn't apply to ewma
+        :return: numpy array with the indicator value for each row of df
+        """
+        timestamps, ids = self._keys(df.index)
+        values = df[column].values.astype(np.float64)
+
+        # group the rows by timestamp
+        order = None if (timestamps[:-1] <= timestamps[1:]).all() else np.argsort(timestamps, kind='mergesort')
+        sorted_timestamps = timestamps if order is None else timestamps[order]
+
+        change = np.empty(len(sorted_timestamps), dtype=np.bool_)
+        change[:1] = True
+        np.not_equal(sorted_timestamps[1:], sorted_timestamps[:-1], out=change[1:])
+
+        bounds = np.append(np.flatnonzero(change), len(sorted_timestamps))
+        unique_timestamps = sorted_timestamps[bounds[:-1]]
+
+        if len(unique_timestamps) > len(self._history_timestamps):
+            self._resize_history(len(unique_timestamps))
+
+        # process the new timestamps
+        first_new = 0 if self._processed == 0 else np.searchsorted(unique_timestamps, self._history_timestamps[(self._processed - 1) % len(self._history_timestamps)], side='right')
+
+        for i in range(first_new, len(unique_timestamps)):
+            rows = slice(bounds[i], bounds[i + 1]) if order is None else order[bounds[i]:bounds[i + 1]]
+            self._update(unique_timestamps[i], ids[rows], values[rows])
+
+        # obtain the results for all rows
+        inverse = np.repeat(np.arange(len(unique_timestamps)), np.diff(bounds))
+        if order is not None:
+            inverse[order] = inverse.copy()
+
+        result = self._lookup(unique_timestamps, inverse, ids)
+
+        if not full_history and self.indicator != 'ewma' and self.window > 1:
+            sorted_ids = ids if order is None else ids[order]
+            positions = pd.Series(sorted_ids).groupby(sorted_ids).cumcount().values
+
+            warm_up = positions < self.window - 1
+            if order is not None:
+                warm_up[order] = warm_up.copy()
+
+            result[warm_up] = np.nan
+
+        return result
+
+    def _keys(self, index):
+        """
+        :return: int64 timestamp and symbol id of each row of the index
+        """
+        if isinstance(index, pd.MultiIndex):
+            ts_level = [i for i, l in enumerate(index.levels) if isinstance(l, pd.DatetimeIndex)][0]
+            symbol_level = index.names.index('symbol')
+
+            timestamps = index.levels[ts_level].asi8[index.codes[ts_level]]
+            ids = self._symbol_ids(index.levels[symbol_level])[index.codes[symbol_level]]
+        else:
+            timestamps = index.asi8
+            ids = np.zeros(len(index), dtype=np.int64) + self._symbol_ids(pd.Index([None]))[0]
+
+        return timestamps, ids
+
+    def _symbol_ids(self, symbols: pd.Index):
+        """
+        :return: the ids of the symbols. New symbols are added
+        """
+        ids = self._symbols.get_indexer(symbols)
+
+        if (ids == -1).any():
+            self._symbols = self._symbols.append(symbols[ids == -1])
+
+            n = len(self._symbols) - len(self._count)
+
+            self._buffer = np.concatenate([self._buffer, np.full((n, self.window), np.nan)])
+            self._count = np.concatenate([self._count, np.zeros(n, dtype=np.int64)])
+            self._shift = np.concatenate([self._shift, np.zeros(n)])
+            self._sum = np.concatenate([self._sum, np.zeros(n)])
+            self._sum_sq = np.concatenate([self._sum_sq, np.zeros(n)])
+            self._nans = np.concatenate([self._nans, np.zeros(n, dtype=np.int64)])
+            self._ewm_sum = np.concatenate([self._ewm_sum, np.zeros(n)])
+            self._ewm_weight = np.concatenate([self._ewm_weight, np.zeros(n)])
+            self._ewm_mean = np.concatenate([self._ewm_mean, np.full(n, np.nan)])
+            self._extrema += [collections.deque() for _ in range(n)]
+            self._history = np.concatenate([self._history, np.full((self._history.shape[0], n), np.nan)], axis=1)
+
+            ids = self._symbols.get_indexer(symbols)
+
+        return ids
+
+    def _resize_history(self, capacity: int):
+        """
+        Increase the number of stored timestamps
+        """
+        old_capacity = len(self._history_timestamps)
+
+        timestamps = np.empty(capacity, dtype=np.int64)
+        history = np.full((capacity, len(self._symbols)), np.nan)
+
+        if self._processed > 0:
+            i = np.arange(max(0, self._processed - old_capacity), self._processed)
+            timestamps[i % capacity] = self._history_timestamps[i % old_capacity]
+            history[i % capacity] = self._history[i % old_capacity]
+
+        self._history_timestamps = timestamps
+        self._history = history
+
+    def _update(self, timestamp, ids, values):
+        """
+        Add the values of a single timestamp
+        :param timestamp: int64 timestamp
+        :param ids: symbol ids (unique)
+        :param values: values for each of the symbols
+        """
+        w = self.window
+
+        count = self._count[ids]
+        slot = count % w
+
+        # new symbols
+        self._shift[ids] = np.where((count == 0) & ~np.isnan(values), values, self._shift[ids])
+
+        # remove the oldest values from the running sums
+        old = self._buffer[ids, slot] - self._shift[ids]
+        old_nan = np.isnan(old)
+        old = np.where((count >= w) & ~old_nan, old, 0)
+
+        new = values - self._shift[ids]
+        new_nan = np.isnan(new)
+        new = np.where(new_nan, 0, new)
+
+        self._sum[ids] += new - old
+        self._sum_sq[ids] += new * new - old * old
+        self._nans[ids] += new_nan.astype(np.int64) - ((count >= w) & old_nan).astype(np.int64)
+
+        self._buffer[ids, slot] = values
+        self._count[ids] = count = count + 1
+
+        # recompute the running sums once per window to prevent error accumulation
+        refresh = ids[count % w == 0]
+        if len(refresh) > 0:
+            buffer = self._buffer[refresh]
+            not_nan = ~np.isnan(buffer)
+            not_nan_count = not_nan.sum(axis=1)
+
+            self._shift[refresh] = np.where(not_nan, buffer, 0).sum(axis=1) / np.maximum(not_nan_count, 1)
+            buffer = buffer - self._shift[refresh][:, np.newaxis]
+            self._sum[refresh] = np.nansum(buffer, axis=1)
+            self._sum_sq[refresh] = np.nansum(buffer * buffer, axis=1)
+
+        # monotonic deques
+        if self.indicator in ('min', 'max'):
+            self._update_extrema(ids, count - 1, values)
+
+        # exponentially weighted sums
+        a = 1 - self._alpha
+        values_nan = np.isnan(values)
+        self._ewm_sum[ids] = a * self._ewm_sum[ids] + np.where(values_nan, 0, values)
+        self._ewm_weight[ids] = a * self._ewm_weight[ids] + np.where(values_nan, 0, 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self._ewm_mean[ids] = np.where(values_nan, self._ewm_mean[ids], self._ewm_sum[ids] / self._ewm_weight[ids])
+
+        # store the result
+        row = self._processed % len(self._history_timestamps)
+        self._history_timestamps[row] = timestamp
+        self._history[row] = np.nan
+        self._history[row, ids] = self._compute(ids)
+        self._processed += 1
+
+    def _update_extrema(self, ids, positions, values):
+        """
+        Add the values to the monotonic deques. The front of each deque is the min/max of the last window values
+        :param ids: symbol ids
+        :param positions: position of each value in the history of its symbol
+        :param values: values
+        """
+        w = self.window
+        is_min = self.indicator == 'min'
+
+        for i, p, v in zip(ids.tolist(), positions.tolist(), values.tolist()):
+            d = self._extrema[i]
+
+            while d and d[0][0] <= p - w:
+                d.popleft()
+
+            if v == v:
+                while d and (d[-1][1] >= v if is_min else d[-1][1] <= v):
+                    d.pop()
+
+                d.append((p, v))
+
+    def _compute(self, ids):
+        """
+        :return: indicator value for each of the symbols ids
+        """
+        w = self.window
+
+        if self.indicator == 'ewma':
+            return self._ewm_mean[ids]
+
+        valid = (self._count[ids] >= w) & (self._nans[ids] == 0)
+
+        if self.indicator == 'mean':
+            result = self._shift[ids] + self._sum[ids] / w
+        elif self.indicator == 'std':
+            if w < 2:
+                return np.full(len(ids), np.nan)
+
+            s = self._sum[ids]
+            result = np.sqrt(np.maximum((self._sum_sq[ids] - s * s / w) / (w - 1), 0))
+        elif self.indicator in ('min', 'max'):
+            result = np.array([self._extrema[i][0][1] if self._extrema[i] else np.nan for i in ids.tolist()])
+
+        return np.where(valid, result, np.nan)
+
+    def _lookup(self, timestamps, inverse, ids):
+        """
+        :param timestamps: unique sorted timestamps
+        :param inverse: timestamp position for each row
+        :param ids: symbol id for each row
+        :return: the stored result for each row (or nan if not available)
+        """
+        capacity = len(self._history_timestamps)
+        first = max(0, self._processed - capacity)
+
+        rows = np.arange(first, self._processed) % capacity
+        stored = self._history_timestamps[rows]
+
+        pos = np.searchsorted(stored, timestamps)
+        valid = pos < len(stored)
+        valid[valid] = stored[pos[valid]] == timestamps[valid]
+
+        if valid.all():
+            return self._history[rows[pos][inverse], ids]
+
+        history_rows = np.where(valid, rows[np.minimum(pos, len(rows) - 1)], -1)[inverse]
+        valid = history_rows >= 0
+
+        result = np.full(len(ids), np.nan)
+        result[valid] = self._history[history_rows[valid], ids[valid]]
+
+        return result
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 
@@ -82,3 +83,100 @@ def synchronize_timestamps(df) -> pd.DataFrame:
     """
     multi_index = pd.MultiIndex.from_product([df.index.levels[0].unique(), df.index.levels[1].unique()], names=['symbol', 'timestamp']).sort_values()
     return reindex_and_fill(df, multi_index)
+
+
+def synchronize_dense(signals: dict, col: str = 'timestamp', last: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    synchronize the timestamps of single symbol DataFrames using dense symbols x timestamps numpy arrays (one field at a time).
+    Missing values are filled like reindex_and_fill: zero for volume, ffill/backfill for close, close for open/high/low and ffill/backfill for the rest
+    :param signals: dict of single symbol DataFrames with 'symbol' and col columns
+    :param col: name of the timestamp column
+    :param last: last known values for each symbol (indexed by symbol). Used to fill the leading missing values before the backfill
+    :return: DataFrame with [symbol, col] MultiIndex
+    """
+    dfs = [df for df in signals.values() if not df.empty]
+
+    if len(dfs) == 0:
+        empty = pd.concat(list(signals.values())).iloc[:0] if len(signals) > 0 else pd.DataFrame(columns=['symbol', col])
+        empty = empty[['symbol', col] + [c for c in empty.columns if c not in ('symbol', col)]]
+        empty.index = pd.MultiIndex.from_arrays([empty['symbol'].values, empty[col].values], names=['symbol', col])
+
+        return empty
+
+    symbol_values = pd.Index(np.concatenate([df['symbol'].values for df in dfs]))
+    timestamp_values = pd.Index(pd.concat([df[col] for df in dfs], ignore_index=True))
+
+    symbols = symbol_values.unique().sort_values()
+    timestamps = timestamp_values.unique().sort_values()
+
+    n_sym, n_ts = len(symbols), len(timestamps)
+
+    # position of each row in the flattened dense array
+    rows = symbols.get_indexer(symbol_values) * n_ts + timestamps.get_indexer(timestamp_values)
+
+    # reindexing only changes the dtypes if there are missing rows
+    complete = rows.size == n_sym * n_ts
+
+    last = last.reindex(symbols) if last is not None else None
+
+    def values_of(c):
+        src = np.concatenate([df[c].values for df in dfs])
+
+        if complete:
+            result = np.empty(n_sym * n_ts, dtype=src.dtype)
+        elif src.dtype.kind in 'iuf':
+            result = np.full(n_sym * n_ts, np.nan)
+        else:
+            result = np.full(n_sym * n_ts, None, dtype=object)
+
+        result[rows] = src
+
+        return result.reshape(n_sym, n_ts)
+
+    def fill(values, method):
+        mask = pd.isnull(values)
+        if not mask.any():
+            return values
+
+        if method == 'backfill':
+            return fill(values[:, ::-1], 'ffill')[:, ::-1]
+
+        ind = np.where(mask, 0, np.arange(n_ts))
+        np.maximum.accumulate(ind, axis=1, out=ind)
+
+        return values[np.arange(n_sym)[:, np.newaxis], ind]
+
+    def seed(values, c):
+        if last is None or c not in last.columns:
+            return values
+
+        mask = pd.isnull(values)
+        if not mask.any():
+            return values
+
+        return np.where(mask, last[c].values.astype(values.dtype)[:, np.newaxis], values)
+
+    columns = [c for c in dfs[0].columns if c not in ('symbol', col)]
+    data = dict()
+
+    for c in [c for c in ['period_volume', 'number_of_trades'] if c in columns]:
+        data[c] = values_of(c)
+        data[c][pd.isnull(data[c])] = 0
+
+    if 'close' in columns:
+        data['close'] = fill(seed(fill(values_of('close'), 'ffill'), 'close'), 'backfill')
+
+        for c in [c for c in ['open', 'high', 'low'] if c in columns]:
+            data[c] = values_of(c)
+            data[c] = np.where(pd.isnull(data[c]), data['close'], data[c])
+
+    for c in columns:
+        data[c] = fill(seed(fill(data[c] if c in data else values_of(c), 'ffill'), c), 'backfill').ravel()
+
+    index = pd.MultiIndex.from_product([symbols, timestamps], names=['symbol', col])
+
+    result = pd.DataFrame({c: data[c] for c in columns}, index=index, columns=columns)
+    result.insert(0, col, index.get_level_values(1))
+    result.insert(0, 'symbol', index.get_level_values(0))
+
+    return result
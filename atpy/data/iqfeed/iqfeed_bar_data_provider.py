@@ -1,16 +1,19 @@
+import threading
+
 from dateutil import tz
 
 from atpy.data.iqfeed.iqfeed_level_1_provider import get_splits_dividends
 from atpy.data.iqfeed.util import *
-from atpy.data.splits_dividends import adjust_df
+from atpy.data.splits_dividends import adjustment_factors, effective_times
 
 
 class IQFeedBarDataListener(iq.SilentBarListener):
 
-    def __init__(self, listeners, interval_len, interval_type='s', mkt_snapshot_depth=0, key_suffix=''):
+    def __init__(self, listeners, interval_len, interval_type='s', mkt_snapshot_depth=0, key_suffix='', adjustments_ttl: datetime.timedelta = datetime.timedelta(days=1)):
         """
         :param mkt_snapshot_depth: construct and maintain dataframe representing the current market snapshot with depth. If 0, then don't construct, otherwise construct for the past periods
         :param key_suffix: suffix to the fieldnames
+        :param adjustments_ttl: time to keep the cached splits/dividends of each symbol before they are requested again
         """
         super().__init__(name="Bar data listener")
 
@@ -25,6 +28,11 @@ class IQFeedBarDataListener(iq.SilentBarListener):
         self.mkt_snapshot_depth = mkt_snapshot_depth
         self.watched_symbols = set()
 
+        # symbol -> (load time, (adjustment effective times in UTC, price factors, price offsets, volume factors) or None)
+        self.adjustments_ttl = adjustments_ttl
+        self._adjustments = dict()
+        self._adjustments_lock = threading.Lock()
+
     def __enter__(self):
         launch_service()
 
@@ -77,7 +85,7 @@ class IQFeedBarDataListener(iq.SilentBarListener):
     def process_history_bar(self, bar_data: np.array) -> None:
         data = self._process_data(iqfeed_to_dict(np.copy(bar_data), key_suffix=self.key_suffix))
 
-        adjust_df(data, get_splits_dividends(data['symbol'], self.streaming_conn))
+        self._adjust(data)
 
         self.listeners({'type': 'bar', 'data': data, 'interval_type': self.interval_type, 'interval_len': self.interval_len})
 
@@ -90,6 +98,7 @@ class IQFeedBarDataListener(iq.SilentBarListener):
             data_copy = {'symbol': symbol, 'interval_type': self.interval_type, 'interval_len': self.interval_len}
             if self.mkt_snapshot_depth > 0:
                 data_copy['lookback_bars'] = self.mkt_snapshot_depth
+                self._load_adjustments([symbol])
 
             self.conn.watch(**data_copy)
             self.watched_symbols.add(symbol)
@@ -101,25 +110,84 @@ class IQFeedBarDataListener(iq.SilentBarListener):
             if self.mkt_snapshot_depth > 0:
                 data_copy['lookback_bars'] = self.mkt_snapshot_depth
 
+                # the history bars are adjusted, so the adjustments of all symbols are requested in advance
+                self._load_adjustments([s for s in data_copy['symbol'] if s not in self.watched_symbols])
+
             for s in [s for s in data_copy['symbol'] if s not in self.watched_symbols]:
                 data_copy['symbol'] = s
                 self.conn.watch(**data_copy)
                 self.watched_symbols.add(s)
 
+    def _load_adjustments(self, symbols: list):
+        """
+        Request the splits/dividends of the symbols, which are not cached (or have expired), and cache their cumulative adjustment factors
+        :param symbols: list of symbols
+        """
+        with self._adjustments_lock:
+            now = datetime.datetime.now()
+            symbols = [s for s in set(symbols) if s not in self._adjustments or now - self._adjustments[s][0] > self.adjustments_ttl]
+
+            if len(symbols) == 0:
+                return
+
+            self._cache_adjustments(symbols, get_splits_dividends(set(symbols), self.streaming_conn), now)
+
+    def _cache_adjustments(self, symbols: list, adjustments: pd.DataFrame, now: datetime.datetime):
+        """
+        Cache the cumulative adjustment factors of the symbols. The live bars are in UTC, so are the effective times of the adjustments
+        :param symbols: list of symbols
+        :param adjustments: splits/dividends of the symbols (like get_splits_dividends)
+        :param now: load time
+        """
+        factors = adjustment_factors(adjustments)
+        factors_symbols = set(factors.index.levels[0][factors.index.codes[0]])
+
+        for s in symbols:
+            if s in factors_symbols:
+                f = factors.xs(s, level='symbol')
+                self._adjustments[s] = (now, (effective_times(f.index, tz.gettz('UTC')), f['price_factor'].values, f['price_offset'].values, f['volume_factor'].values))
+            else:
+                self._adjustments[s] = (now, None)
+
+    def _adjust(self, data: pd.DataFrame):
+        """
+        Adjust single bar with the cumulative factor of the splits/dividends after the bar
+        :param data: single bar dataframe
+        """
+        symbol, timestamp = data.index[0][1], data.index[0][0]
+
+        self._load_adjustments([symbol])
+
+        factors = self._adjustments[symbol][1]
+        if factors is None:
+            return
+
+        times, price_factor, price_offset, volume_factor = factors
+
+        i = np.searchsorted(times, pd.Timestamp(timestamp).value)
+        if i < len(times):
+            sf = self.key_suffix
+
+            for c in ['open' + sf, 'high' + sf, 'low' + sf, 'close' + sf]:
+                data[c] = data[c] * price_factor[i] + price_offset[i]
+
+            for c in ['period_volume' + sf, 'total_volume' + sf]:
+                data[c] = (data[c] * volume_factor[i]).astype(data[c].dtype)
+
     def _process_data(self, data):
         result = dict()
 
         sf = self.key_suffix
 
         result['symbol' + sf] = data.pop('symbol')
-        result['timestamp' + sf] = (datetime.datetime.combine(data.pop('date'), datetime.datetime.min.time()) + data.pop('time').astype(datetime.datetime)).replace(tzinfo=tz.gettz('US/Eastern')).astimezone(tz.gettz('UTC'))
+        result['timestamp' + sf] = (datetime.datetime.combine(data.pop('date'), datetime.datetime.min.time()) + data.pop('time')).replace(tzinfo=tz.gettz('US/Eastern')).astimezone(tz.gettz('UTC'))
         result['high' + sf] = data.pop('high_p')
         result['low' + sf] = data.pop('low_p')
         result['open' + sf] = data.pop('open_p')
         result['close' + sf] = data.pop('close_p')
-        result['total_volume' + sf] = data.pop('tot_vlm')
-        result['period_volume' + sf] = data.pop('prd_vlm')
-        result['number_of_trades' + sf] = data.pop('num_trds')
+        result['total_volume' + sf] = np.uint64(data.pop('tot_vlm'))
+        result['period_volume' + sf] = np.uint64(data.pop('prd_vlm'))
+        result['number_of_trades' + sf] = np.uint64(data.pop('num_trds'))
 
         result = pd.DataFrame(result, index=pd.MultiIndex.from_tuples([(result['timestamp'], result['symbol'])], names=['timestamp', 'symbol']))
 
@@ -1,18 +1,23 @@
+import contextlib
 import datetime
 import logging
 import queue
 import threading
+import time
 import typing
 from multiprocessing.pool import ThreadPool
 
+import numpy as np
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
 import pyiqfeed
 import pyiqfeed as iq
+from atpy.data.iqfeed.bar_util import synchronize_dense
 from atpy.data.iqfeed.filters import *
 from atpy.data.iqfeed.iqfeed_level_1_provider import get_splits_dividends
-from atpy.data.iqfeed.util import launch_service, IQFeedDataProvider
+from atpy.data.iqfeed.util import launch_service, IQFeedDataProvider, eastern_to_utc
+from atpy.data.util import MemoryBoundedQueue
 from atpy.data.ts_util import slice_periods
 from atpy.data.splits_dividends import adjust_df
 
@@ -179,43 +184,134 @@ class BarsMonthlyFilter(NamedTuple):
 BarsMonthlyFilter.__new__.__defaults__ = (True, None)
 
 
+# errors of the socket connection to IQFeed. Only these errors cause a connection to be replaced and a request to be retried
+TRANSPORT_ERRORS = (OSError, EOFError)
+
+
+class HistoryConnPool(object):
+    """
+    Pool of IQFeed history connections. Connections are checked out on demand. The ones that fail with transport errors are dropped from the pool
+    and replaced with new connections on the next checkout
+    """
+
+    def __init__(self, num_connections: int):
+        """
+        :param num_connections: number of connections in the pool
+        """
+        self.num_connections = num_connections
+        self._idle = None
+        self._live = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self._idle = queue.Queue()
+
+        for _ in range(self.num_connections):
+            self._idle.put(self._new_connection())
+
+        self._live = self.num_connections
+
+    def disconnect(self):
+        if self._idle is not None:
+            while not self._idle.empty():
+                self._close_connection(self._idle.get())
+
+            self._idle = None
+            self._live = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        check out an idle connection (blocks until one is available). If a transport error is raised while the connection is in use, the connection is closed and dropped
+        """
+        conn = self._checkout()
+        try:
+            yield conn
+        except TRANSPORT_ERRORS:
+            self._drop(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._idle.put(conn)
+
+    def _checkout(self):
+        """
+        :return: idle connection or a new one, if connections were dropped
+        """
+        with self._lock:
+            replace = self._idle.empty() and self._live < self.num_connections
+            if replace:
+                self._live += 1
+
+        if not replace:
+            return self._idle.get()
+
+        try:
+            return self._new_connection()
+        except Exception:
+            with self._lock:
+                self._live -= 1
+
+            raise
+
+    def _drop(self, conn):
+        self._close_connection(conn)
+
+        with self._lock:
+            self._live -= 1
+
+    @staticmethod
+    def _new_connection():
+        conn = iq.HistoryConn()
+        conn.connect()
+
+        return conn
+
+    @staticmethod
+    def _close_connection(conn):
+        try:
+            conn.disconnect()
+        except Exception as err:
+            logging.getLogger(__name__).debug("Error while disconnecting: " + str(err))
+
+
 class IQFeedHistoryProvider(object):
     """
     IQFeed historical data provider. See the unit test on how to use
     """
 
-    def __init__(self, num_connections=10, key_suffix=''):
+    def __init__(self, num_connections=10, key_suffix='', max_retries=3, retry_delay=1):
         """
         :param num_connections: number of connections to use when requesting data
         :param key_suffix: suffix for field names
+        :param max_retries: number of retries of a request in case of transport error
+        :param retry_delay: delay (in seconds) before the first retry. The delay is doubled for each subsequent retry
         """
         self.num_connections = num_connections
         self.key_suffix = key_suffix
-        self.conn = None
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.conn_pool = None
         self.current_batch = None
         self.current_filter = None
 
     def __enter__(self):
         launch_service()
 
-        self.conn = [iq.HistoryConn() for _ in range(self.num_connections)]
-        for c in self.conn:
-            c.connect()
+        self.conn_pool = HistoryConnPool(self.num_connections)
+        self.conn_pool.connect()
 
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        for c in self.conn:
-            c.disconnect()
-
-        self.conn = None
+        self.conn_pool.disconnect()
+        self.conn_pool = None
 
     def __del__(self):
-        if self.conn is not None:
-            for c in self.conn:
-                c.disconnect()
-
-            self.conn = None
+        if self.conn_pool is not None:
+            self.conn_pool.disconnect()
+            self.conn_pool = None
 
     def request_data(self, f, sync_timestamps=True):
         """
@@ -225,7 +321,7 @@ class IQFeedHistoryProvider(object):
         :return:
         """
         if isinstance(f.ticker, str):
-            data = self.request_raw_symbol_data(f, self.conn[0])
+            data = self._request_raw_symbol_data_retry(f)
             if data is None:
                 logging.getLogger(__name__).warning("No data found for filter: " + str(f))
                 return
@@ -239,15 +335,52 @@ class IQFeedHistoryProvider(object):
 
             signals = {d[0].ticker: d[1] for d in iter(q.get, None)}
 
-            if sync_timestamps:
-                signals = self.synchronize_timestamps(signals, f)
+            return self._combine_signals(signals, f, sync_timestamps=sync_timestamps)
 
-            if isinstance(signals, dict) and len(signals) > 0:
-                signals = pd.concat(signals)
-                signals.index.set_names('symbol', level=0, inplace=True)
-                signals.sort_index(inplace=True, ascending=f.ascend)
+    def request_data_chunks(self, f, symbols_per_chunk: int = 100, max_memory: int = 2 ** 30, sync_timestamps=False):
+        """
+        request history data for a list of symbols as a stream of symbol-partitioned chunks. Only a bounded amount of data is kept in memory
+        :param f: filter tuple (with list of tickers)
+        :param symbols_per_chunk: maximum number of symbols in each chunk
+        :param max_memory: maximum memory (in bytes) of the data, which is already downloaded, but not yet assigned to a chunk. The connection workers block while the limit is exceeded
+        :param sync_timestamps: synchronize timestamps between the symbols of each chunk
+        :return: generator of DataFrames with [symbol, timestamp] MultiIndex
+        """
+        tickers = f.ticker if isinstance(f.ticker, list) else [f.ticker]
+
+        q = MemoryBoundedQueue(max_memory=max_memory)
+        threading.Thread(target=self.request_data_by_filters, args=([f._replace(ticker=t) for t in tickers], q), daemon=True).start()
+
+        done = False
+        try:
+            signals = dict()
+
+            for ft, df in iter(q.get, None):
+                signals[ft.ticker] = df
+
+                if len(signals) == symbols_per_chunk:
+                    yield self._combine_signals(signals, f, sync_timestamps=sync_timestamps)
+                    signals = dict()
+
+            done = True
+
+            if len(signals) > 0:
+                yield self._combine_signals(signals, f, sync_timestamps=sync_timestamps)
+        finally:
+            # unblock the remaining workers, if the generator is closed prematurely
+            if not done:
+                threading.Thread(target=lambda: list(iter(q.get, None)), daemon=True).start()
+
+    def _combine_signals(self, signals: dict, f, sync_timestamps=True):
+        if sync_timestamps:
+            signals = self.synchronize_timestamps(signals, f)
+
+        if isinstance(signals, dict) and len(signals) > 0:
+            signals = pd.concat(signals)
+            signals.index.set_names('symbol', level=0, inplace=True)
+            signals.sort_index(inplace=True, ascending=f.ascend)
 
-            return signals if len(signals) > 0 else None
+        return signals if len(signals) > 0 else None
 
     def request_data_by_filters(self, filters: list, q: queue.Queue):
         """
@@ -263,11 +396,9 @@ class IQFeedHistoryProvider(object):
         lock = threading.Lock()
         no_data = set()
 
-        def mp_worker(p):
-            ft, conn = p
-
+        def mp_worker(ft):
             try:
-                raw_data = self.request_raw_symbol_data(ft, conn)
+                raw_data = self._request_raw_symbol_data_retry(ft)
                 if raw_data is not None:
                     q.put((ft, self._process_data(raw_data, ft)))
             except Exception as err:
@@ -290,8 +421,14 @@ class IQFeedHistoryProvider(object):
                 self._global_not_found_counter += 1
                 no_data.add(ft.ticker)
 
+        # largest requests first, so that the long ones don't end up at the tail. The order doesn't matter with a single connection
+        if self.num_connections > 1:
+            filters = sorted(filters, key=self._estimate_size, reverse=True)
+
         pool = ThreadPool(self.num_connections)
-        pool.map(mp_worker, ((f, self.conn[i % self.num_connections]) for i, f in enumerate(filters)))
+        for _ in pool.imap_unordered(mp_worker, filters, chunksize=1):
+            pass
+
         pool.close()
 
         del self._global_counter
@@ -317,51 +454,19 @@ class IQFeedHistoryProvider(object):
         else:
             col = 'timestamp' + self.key_suffix if 'timestamp' + self.key_suffix in list(signals.values())[0] else 'date' + self.key_suffix if 'date' + self.key_suffix in list(signals.values())[0] else None
             if col is not None:
-                signals = pd.concat(signals)
-                signals.index.set_names('symbol', level=0, inplace=True)
-
-                for symbol in signals.index.get_level_values('symbol').unique():
-                    if 0 in signals.loc[symbol, 'open'].values:
+                for symbol, df in signals.items():
+                    if 'open' in df.columns and (df['open'].values == 0).any():
                         logging.getLogger(__name__).warning(symbol + " contains 0 in the Open column before timestamp sync")
 
-                multi_index = pd.MultiIndex.from_product([signals['symbol'].unique(), signals[col].unique()], names=['symbol', col]).sort_values()
-
-                signals = signals.reindex(multi_index)
-                signals.drop(['symbol', col], axis=1, inplace=True)
-                signals.reset_index(inplace=True)
-                signals.set_index(multi_index, inplace=True)
-
-                for c in [c for c in ['period_volume', 'number_of_trades'] if c in signals.columns]:
-                    signals[c].fillna(0, inplace=True)
-
-                if 'close' in signals.columns:
-                    signals['close'] = signals.groupby(level=0)['close'].fillna(method='ffill')
-
-                    if self.current_filter is not None and type(self.current_filter) == type(f) and self.current_batch is not None and f.ascend is True and self.current_batch.index.levels[0].equals(signals.index.levels[0]):
-                        last = self.current_batch.groupby(level=0)['close'].last()
-                        signals['close'] = signals.groupby(level=0)['close'].apply(lambda x: x.fillna(last[last.index.get_loc(x.name)]))
-
-                    signals['close'] = signals.groupby(level=0)['close'].fillna(method='backfill')
-
-                    op = signals['close']
-
-                    for c in [c for c in ['open', 'high', 'low'] if c in signals.columns]:
-                        signals[c].fillna(op, inplace=True)
-
-                signals = signals.groupby(level=0).fillna(method='ffill')
-
-                if self.current_filter is not None and type(self.current_filter) == type(f) and self.current_batch is not None and f.ascend is True and self.current_batch.index.levels[0].equals(signals.index.levels[0]):
+                last = None
+                if self.current_filter is not None and type(self.current_filter) == type(f) and self.current_batch is not None and f.ascend is True and self.current_batch.index.levels[0].equals(pd.Index(sorted(signals.keys()))):
                     last = self.current_batch.groupby(level=0).last()
-                    signals = signals.groupby(level=0).apply(lambda x: x.fillna(last.iloc[last.index.get_loc(x.name)]))
-
-                signals = signals.groupby(level=0).fillna(method='backfill')
 
-                zero_values = list()
+                signals = synchronize_dense(signals, col=col, last=last)
 
-                for symbol in signals.index.get_level_values('symbol').unique():
-                    if 0 in signals.loc[symbol, 'open'].values:
+                if 'open' in signals.columns:
+                    for symbol in signals.loc[signals['open'].values == 0, 'symbol'].unique():
                         logging.getLogger(__name__).warning(symbol + " contains 0 in the Open column after timestamp sync")
-                        zero_values.append(symbol)
 
                 if not f.ascend:
                     signals.sort_index(level=['symbol', col], inplace=True, ascending=False)
@@ -372,6 +477,62 @@ class IQFeedHistoryProvider(object):
 
         return result
 
+    def _request_raw_symbol_data_retry(self, f):
+        """
+        request raw data using a pooled connection. Requests, which failed due to transport errors, are retried with exponential backoff
+        :param f: filter tuple
+        :return: raw data
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.conn_pool.connection() as conn:
+                    return self.request_raw_symbol_data(f, conn)
+            except TRANSPORT_ERRORS as err:
+                if attempt == self.max_retries:
+                    raise
+
+                delay = self.retry_delay * 2 ** attempt
+                logging.getLogger(__name__).warning("Error while requesting " + str(f) + ": " + str(err) + "; Retrying in " + str(delay) + " seconds")
+                time.sleep(delay)
+
+    @staticmethod
+    def _estimate_size(f) -> float:
+        """
+        rough estimate of the number of data points, which will be returned for a filter. Used for scheduling
+        :param f: filter tuple
+        :return: estimated size (inf if unknown)
+        """
+        if isinstance(f, TicksForDaysFilter):
+            result = f.num_days * 24 * 3600
+        elif isinstance(f, BarsForDaysFilter):
+            result = f.days * 24 * 3600
+        elif isinstance(f, TicksInPeriodFilter) or isinstance(f, BarsInPeriodFilter):
+            if f.bgn_prd is not None:
+                end_prd = f.end_prd if f.end_prd is not None else datetime.datetime.now(tz=f.bgn_prd.tzinfo)
+                result = max((end_prd - f.bgn_prd).total_seconds(), 0)
+            else:
+                result = None
+        elif isinstance(f, BarsDailyFilter):
+            result = f.num_days
+        elif isinstance(f, BarsDailyForDatesFilter):
+            result = ((f.end_dt if f.end_dt is not None else datetime.date.today()) - f.bgn_dt).days if f.bgn_dt is not None else None
+        elif isinstance(f, BarsWeeklyFilter):
+            result = f.num_weeks
+        elif isinstance(f, BarsMonthlyFilter):
+            result = f.num_months
+        else:
+            result = None
+
+        # seconds to number of bars
+        if result is not None and (isinstance(f, BarsForDaysFilter) or isinstance(f, BarsInPeriodFilter)):
+            result /= f.interval_len if f.interval_type == 's' and f.interval_len else 60
+
+        limits = [getattr(f, l) for l in ('max_bars', 'max_ticks', 'max_days') if getattr(f, l, None) is not None]
+        if len(limits) > 0:
+            result = min(limits) if result is None else min(result, min(limits))
+
+        return result if result is not None else float('inf')
+
     @staticmethod
     def request_raw_symbol_data(f, conn):
         if isinstance(f, TicksFilter):
@@ -417,47 +578,50 @@ class IQFeedHistoryProvider(object):
             return self._process_daily(data, data_filter)
 
     def _process_ticks(self, data, data_filter):
-        result = pd.DataFrame(data)
         sf = self.key_suffix
 
-        result['timestamp' + sf] = pd.Index(data['date'] + data['time']).tz_localize('US/Eastern').tz_convert('UTC')
-        result.set_index('timestamp' + sf, inplace=True, drop=False)
-        result.drop(['date', 'time'], axis=1, inplace=True)
-
-        result.rename(
-            {"last": "last" + sf, "last_sz": "last_size" + sf, "tot_vlm": "total_volume" + sf, "bid": "bid" + sf, "ask": "ask" + sf, "tick_id": "tick_id" + sf, "last_type": "basis_for_last" + sf, "mkt_ctr": "trade_market_center" + sf},
-            axis="columns", copy=False, inplace=True)
-        result['symbol'] = data_filter.ticker
-
-        return result
+        return self._to_dataframe(data, data_filter.ticker, timestamps=eastern_to_utc(data['date'] + data['time']),
+                                  names={"last": "last" + sf, "last_sz": "last_size" + sf, "tot_vlm": "total_volume" + sf, "bid": "bid" + sf, "ask": "ask" + sf, "tick_id": "tick_id" + sf, "last_type": "basis_for_last" + sf,
+                                         "mkt_ctr": "trade_market_center" + sf})
 
     def _process_bars(self, data, data_filter):
-        result = pd.DataFrame(data)
         sf = self.key_suffix
 
-        result['timestamp' + sf] = pd.Index(data['date'] + data['time']).tz_localize('US/Eastern').tz_convert('UTC')
-        result.set_index('timestamp' + sf, inplace=True, drop=False)
-        result.drop(['date', 'time'], axis=1, inplace=True)
-
-        result.rename({"high_p": "high" + sf, "low_p": "low" + sf, "open_p": "open" + sf, "close_p": "close" + sf, "tot_vlm": "total_volume" + sf, "prd_vlm": "period_volume" + sf, "num_trds": "number_of_trades" + sf}, axis="columns",
-                      copy=False, inplace=True)
-        result['symbol'] = data_filter.ticker
-
-        return result
+        return self._to_dataframe(data, data_filter.ticker, timestamps=eastern_to_utc(data['date'] + data['time']),
+                                  names={"high_p": "high" + sf, "low_p": "low" + sf, "open_p": "open" + sf, "close_p": "close" + sf, "tot_vlm": "total_volume" + sf, "prd_vlm": "period_volume" + sf, "num_trds": "number_of_trades" + sf})
 
     def _process_daily(self, data, data_filter):
-        result = pd.DataFrame(data)
         sf = self.key_suffix
-        result.rename({"date": "timestamp" + sf, "high_p": "high" + sf, "low_p": "low" + sf, "open_p": "open" + sf, "close_p": "close" + sf, "prd_vlm": "period_volume" + sf, "open_int": "open_interest" + sf}, axis="columns", copy=False,
-                      inplace=True)
 
-        result['timestamp' + sf] = pd.Index(result['timestamp' + sf]).tz_localize('US/Eastern').tz_convert('UTC')
+        return self._to_dataframe(data, data_filter.ticker, timestamps=eastern_to_utc(data['date']),
+                                  names={"date": "timestamp" + sf, "high_p": "high" + sf, "low_p": "low" + sf, "open_p": "open" + sf, "close_p": "close" + sf, "prd_vlm": "period_volume" + sf, "open_int": "open_interest" + sf})
 
-        result['symbol'] = data_filter.ticker
+    def _to_dataframe(self, data, ticker: str, timestamps: pd.DatetimeIndex, names: dict):
+        """
+        Build DataFrame directly from the fields of the pyiqfeed structured array (one copy per column)
+        :param data: structured array
+        :param ticker: symbol
+        :param timestamps: UTC timestamps, used both as index and column
+        :param names: map of field names to column names. The date/time fields are replaced by the timestamps, unless they are renamed to the timestamp column
+        :return: DataFrame
+        """
+        ts_col = 'timestamp' + self.key_suffix
+        timestamps = timestamps.rename(ts_col)
 
-        result.set_index('timestamp' + sf, inplace=True, drop=False)
+        columns = dict()
+        for n in data.dtype.names:
+            c = names.get(n, n)
+            if c == ts_col:
+                columns[c] = timestamps
+            elif n not in ('date', 'time'):
+                columns[c] = data[n]
 
-        return result
+        if ts_col not in columns:
+            columns[ts_col] = timestamps
+
+        columns['symbol'] = np.full(len(data), ticker, dtype=object)
+
+        return pd.DataFrame(columns, index=timestamps)
 
     @staticmethod
     def _event_type(data_filter):
@@ -1,6 +1,7 @@
 import logging
 import queue
 import threading
+import time
 import typing
 
 import numpy as np
@@ -11,9 +12,72 @@ from atpy.data.iqfeed.util import launch_service, iqfeed_to_dict, create_batch,
 from pyevents.events import SyncListeners
 
 
+class _Minibatch(object):
+    """
+    Minibatch of pyiqfeed items. The items are copied into a preallocated structured array.
+    Once the array is full (or the deadline of its first item has passed), it is converted to DataFrame (the columns are copied) and reused
+    """
+
+    def __init__(self, size: int, dtype, key_suffix: str = '', timeout: float = None):
+        """
+        :param size: minibatch size
+        :param dtype: numpy dtype of the items
+        :param key_suffix: suffix to each column name
+        :param timeout: maximum time (in seconds) between the arrival of the first item of the minibatch and the minibatch creation
+        """
+        self._buffer = np.empty((size,), dtype=dtype)
+        self._index = 0
+        self._deadline = None
+        self.key_suffix = key_suffix
+        self.timeout = timeout
+
+    def append(self, item) -> typing.Optional[pd.DataFrame]:
+        """
+        :param item: pyiqfeed item
+        :return: the minibatch DataFrame if the minibatch is complete, otherwise None
+        """
+        buffer = self._buffer
+        buffer[self._index] = item
+        self._index += 1
+
+        if self._index == 1 and self.timeout is not None:
+            self._deadline = time.monotonic() + self.timeout
+
+        if self._index == len(buffer) or self.expired():
+            return self.flush()
+
+        return None
+
+    def expired(self) -> bool:
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    def flush(self) -> typing.Optional[pd.DataFrame]:
+        """
+        :return: DataFrame of the current (possibly incomplete) minibatch or None if the minibatch is empty
+        """
+        if self._index == 0:
+            return None
+
+        result = pd.DataFrame(create_batch(self._buffer[:self._index], self.key_suffix))
+
+        self._index = 0
+        self._deadline = None
+
+        return result
+
+
 class IQFeedLevel1Listener(iq.SilentQuoteListener):
 
-    def __init__(self, listeners, fire_ticks=True, minibatch=None, conn: iq.QuoteConn = None, key_suffix=''):
+    def __init__(self, listeners, fire_ticks=True, minibatch=None, conn: iq.QuoteConn = None, key_suffix='', minibatch_timeout: float = None):
+        """
+        :param listeners: listeners
+        :param fire_ticks: fire event for each tick
+        :param minibatch: size of the minibatches of ticks, regional quotes and news items. If None, no minibatches are created
+        :param conn: existing connection. If None, new connection is created
+        :param key_suffix: suffix to each data field name
+        :param minibatch_timeout: maximum time (in seconds) to wait for a complete tick or regional quote minibatch. Once the timeout passes,
+                the incomplete minibatch is fired. If None, only complete minibatches are fired
+        """
         super().__init__(name="Level 1 listener")
 
         self.listeners = listeners
@@ -27,10 +91,15 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
 
         self.fundamentals = dict()
 
+        self.minibatch_timeout = minibatch_timeout
+
         self.current_news_mb = list()
         self.current_regional_mb = None
         self.current_update_mb = None
         self._lock = threading.RLock()
+        # the minibatches are fired while holding the lock, so that the batches of the timeout thread are in order
+        self._minibatch_lock = threading.RLock()
+        self._stop_flush = None
 
     def __enter__(self):
         if self._own_conn:
@@ -43,10 +112,18 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
 
         self.queue = queue.Queue()
 
+        if self.minibatch is not None and self.minibatch_timeout is not None:
+            self._stop_flush = threading.Event()
+            threading.Thread(target=self._flush_expired, args=(self._stop_flush,), daemon=True).start()
+
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
         """Disconnect connection etc"""
+        if self._stop_flush is not None:
+            self._stop_flush.set()
+            self._stop_flush = None
+
         self.conn.remove_listener(self)
 
         if self._own_conn:
@@ -110,17 +187,14 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
             self.listeners({'type': 'level_1_regional_quote', 'data': iqfeed_to_dict(quote, self.key_suffix)})
 
         if self.minibatch is not None:
-            if self.current_regional_mb is None:
-                self.current_regional_mb = np.empty((self.minibatch,), dtype=self.conn.regional_type)
-                self._current_regional_mb_index = 0
+            with self._minibatch_lock:
+                if self.current_regional_mb is None:
+                    self.current_regional_mb = _Minibatch(self.minibatch, self.conn.regional_type, self.key_suffix, self.minibatch_timeout)
 
-            self.current_regional_mb[self._current_regional_mb_index] = quote
-            self._current_regional_mb_index += 1
+                batch = self.current_regional_mb.append(quote)
 
-            if len(self.current_regional_mb) == self.minibatch:
-                self.listeners({'type': 'level_1_regional_quote_batch', 'data': pd.DataFrame(create_batch(self.current_regional_mb))})
-
-                self._current_regional_mb_index = None
+                if batch is not None:
+                    self.listeners({'type': 'level_1_regional_quote_batch', 'data': batch})
 
     def regional_quote_provider(self):
         return IQFeedDataProvider(listeners=self.listeners, accept_event=lambda e: True if e['type'] == 'level_1_regional_quote' else False)
@@ -137,16 +211,29 @@ class IQFeedLevel1Listener(iq.SilentQuoteListener):
             self.listeners({'type': 'level_1_tick', 'data': iqfeed_to_dict(update, self.key_suffix)})
 
         if self.minibatch is not None:
-            if self.current_update_mb is None:
-                self.current_update_mb = np.empty((self.minibatch,), dtype=self.conn._update_dtype)
-                self._current_update_mb_index = 0
+            with self._minibatch_lock:
+                if self.current_update_mb is None:
+                    self.current_update_mb = _Minibatch(self.minibatch, self.conn._update_dtype, self.key_suffix, self.minibatch_timeout)
+
+                batch = self.current_update_mb.append(update)
 
-            self.current_update_mb[self._current_update_mb_index] = update
-            self._current_update_mb_index += 1
+                if batch is not None:
+                    self.listeners({'type': 'level_1_tick_batch', 'data': batch})
+
+    def _flush_expired(self, stop: threading.Event):
+        """
+        Fire the incomplete minibatches, whose timeout has passed
+        :param stop: stop event
+        """
+        while not stop.wait(self.minibatch_timeout / 4):
+            with self._minibatch_lock:
+                regional_batch = self.current_regional_mb.flush() if self.current_regional_mb is not None and self.current_regional_mb.expired() else None
+                if regional_batch is not None:
+                    self.listeners({'type': 'level_1_regional_quote_batch', 'data': regional_batch})
 
-            if len(self.current_update_mb) == self.minibatch:
-                self.listeners({'type': 'level_1_tick_batch', 'data': pd.DataFrame(create_batch(self.current_update_mb))})
-                self.current_update_mb = None
+                update_batch = self.current_update_mb.flush() if self.current_update_mb is not None and self.current_update_mb.expired() else None
+                if update_batch is not None:
+                    self.listeners({'type': 'level_1_tick_batch', 'data': update_batch})
 
     def update_provider(self):
         return IQFeedDataProvider(listeners=self.listeners, accept_event=lambda e: True if e['type'] == 'level_1_tick_batch' else False)
@@ -226,9 +313,9 @@ def get_splits_dividends(symbol: typing.Union[set, str], conn: iq.QuoteConn = No
     result = pd.DataFrame(points)
     result['provider'] = 'iqfeed'
 
-    result['timestamp'] = pd.to_datetime(result['timestamp'])
+    # localize the column before building the index (tz_localize of an empty index level fails)
+    result['timestamp'] = pd.to_datetime(result['timestamp']).dt.tz_localize('US/Eastern').dt.tz_convert('UTC')
     result = result.set_index(['timestamp', 'symbol', 'type', 'provider'])
-    result = result.tz_localize('US/Eastern', level=0).tz_convert('UTC', level=0)
     result = result[~result.index.duplicated(keep='last')]
     result.sort_index(inplace=True)
 
@@ -31,48 +31,140 @@ def launch_service():
     svc.launch(headless=headless)
 
 
-def create_batch(data, key_suffix=''):
+_NS_PER_DAY = 24 * 3600 * 10 ** 9
+
+# DST transition day marker in the offsets table
+_TRANSITION_DAY = np.iinfo(np.int64).min
+
+# cached difference between UTC and US/Eastern (in ns) for each day since epoch
+_eastern_offsets = dict()
+
+
+def eastern_to_utc(local: np.array) -> pd.DatetimeIndex:
     """
-    Create minibatch-type data based on the pyiqfeed data format
-    :param data: data list
-    :return:
+    Convert naive US/Eastern datetimes to UTC. Same as pd.DatetimeIndex(local).tz_localize('US/Eastern').tz_convert('UTC'),
+    but the timezone database is queried only once for each day (the offsets are cached). Only the DST transition days go through pandas
+    :param local: numpy datetime64 array
+    :return: UTC localized DatetimeIndex
     """
-    for i, datum in enumerate(data):
-        datum = datum[0] if len(datum) == 1 else datum
+    local = np.asarray(local).astype('datetime64[ns]')
+
+    if local.size == 0:
+        return pd.DatetimeIndex(local).tz_localize('UTC')
+
+    local_i8 = local.view(np.int64)
+    days = local_i8 // _NS_PER_DAY
+    first_day, last_day = int(days.min()), int(days.max())
+
+    missing = [d for d in range(first_day, last_day + 1) if d not in _eastern_offsets]
+    if len(missing) > 0:
+        # the offsets at the beginning and at the end of the day differ only on the DST transition days
+        bgn = pd.DatetimeIndex(np.array(missing, dtype=np.int64) * _NS_PER_DAY)
+        end = bgn + pd.Timedelta(days=1)
+
+        bgn_offsets = bgn.tz_localize('US/Eastern').tz_convert(None).asi8 - bgn.asi8
+        end_offsets = end.tz_localize('US/Eastern').tz_convert(None).asi8 - end.asi8
 
-        if i == 0:
-            result = {n.replace(" ", "_").lower() + key_suffix: np.empty((len(data),), d.dtype if str(d.dtype) not in ('|S4', '|S3') else object) for n, d in zip(datum.dtype.names, datum)}
+        for d, bgn_o, end_o in zip(missing, bgn_offsets, end_offsets):
+            _eastern_offsets[d] = bgn_o if bgn_o == end_o else _TRANSITION_DAY
 
-        for j, f in enumerate(datum.dtype.names):
-            d = datum[j]
-            if isinstance(datum[j], bytes):
-                d = datum[j].decode('ascii')
+    offsets = np.array([_eastern_offsets[d] for d in range(first_day, last_day + 1)], dtype=np.int64)[days - first_day]
 
-            result[f.replace(" ", "_").lower()][i] = d
+    result = local_i8 + offsets
+
+    transition = offsets == _TRANSITION_DAY
+    if transition.any():
+        result[transition] = pd.DatetimeIndex(local[transition]).tz_localize('US/Eastern').tz_convert(None).asi8
+
+    return pd.DatetimeIndex(result).tz_localize('UTC')
+
+
+def create_batch(data, key_suffix=''):
+    """
+    Create minibatch-type data based on the pyiqfeed data format. The fields are extracted as whole columns and the bytes fields are decoded in bulk
+    :param data: structured numpy array (or list of pyiqfeed data items)
+    :param key_suffix: suffix to each name
+    :return: dict of numpy arrays (one for each field)
+    """
+    if not isinstance(data, np.ndarray):
+        data = np.concatenate([np.atleast_1d(d) for d in data])
+
+    data = data.reshape(-1)
+
+    result = dict()
+    for n in data.dtype.names:
+        column = data[n]
+        result[n.replace(" ", "_").lower() + key_suffix] = column.astype(str) if column.dtype.kind == 'S' else column.copy()
 
     return result
 
 
 def iqfeed_to_dict(data, key_suffix=''):
     """
-    Turn one iqfeed data item to dict
+    Turn one iqfeed data item to dict. The values are python types (str, int, float, datetime.date/datetime, datetime.timedelta).
+    NaN and NaT values are replaced with None
     :param data: data list
     :param key_suffix: suffix to each name
     :return:
     """
-    data = data[0] if len(data) == 1 else data
+    try:
+        fields = _dict_fields[(data.dtype, key_suffix)]
+    except KeyError:
+        fields = _dict_fields[(data.dtype, key_suffix)] = _fields(data.dtype, key_suffix)
 
-    result = {n.replace(" ", "_").lower() + key_suffix: d for n, d in zip(data.dtype.names, data)}
+    v = data.item(0) if data.ndim > 0 else data.item()
 
-    for k, v in result.items():
-        if isinstance(v, bytes):
-            result[k] = v.decode('ascii')
-        elif isinstance(v, np.datetime64):
-            result[k] = v.astype(datetime.datetime)
-        elif pd.isnull(v):
-            result[k] = None
+    return {k: v[i] if decode is None else decode(v[i]) for k, i, decode in fields}
 
-    return result
+
+# (dtype, key suffix) -> tuple of fields
+_dict_fields = dict()
+
+
+def _fields(dtype: np.dtype, key_suffix: str = ''):
+    """
+    The key name, position and decoder of each field of the dtype. The values of the fields are extracted at once with item().
+    bytes are decoded, NaN floats are replaced with None (NaT is already None) and the rest of the values are used as they are
+    :param dtype: numpy dtype of the data item
+    :param key_suffix: suffix to each name
+    :return: tuple of (key, index, decoder) for each field. decoder is None, if the value doesn't need conversion
+    """
+    result = list()
+
+    for i, n in enumerate(dtype.names):
+        kind = dtype[i].kind
+
+        if kind == 'S':
+            decode = _decode_bytes
+        elif kind in ('f', 'c'):
+            decode = _nan_to_none
+        elif kind in ('i', 'u', 'b', 'U', 'M', 'm'):
+            decode = None
+        else:
+            decode = _generic_value
+
+        result.append((n.replace(" ", "_").lower() + key_suffix, i, decode))
+
+    return tuple(result)
+
+
+def _decode_bytes(v):
+    return v.decode('ascii')
+
+
+def _nan_to_none(v):
+    return v if v == v else None
+
+
+def _generic_value(v):
+    if isinstance(v, bytes):
+        return v.decode('ascii')
+    elif isinstance(v, np.datetime64):
+        return v.astype(datetime.datetime)
+    elif pd.isnull(v):
+        return None
+
+    return v
 
 
 def get_symbols(symbols_file: str = None, flt: dict = None):
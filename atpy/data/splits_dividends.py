@@ -7,6 +7,9 @@ import pandas as pd
 def adjust_df(data: pd.DataFrame, adjustments: pd.DataFrame):
     """
     IMPORTANT !!! This method supports MultiIndex dataframes
+    The adjustments within the period of the data are composed into cumulative factors, which are applied to all rows at once.
+    The result is the same as the sequential application of the adjustments (adjust_split_multiindex, adjust_dividend_multiindex for MultiIndex data
+    and adjust_split, adjust_dividend otherwise) from the latest to the earliest
     :param data: dataframe with data.
     :param adjustments: list of adjustments in the form of [(date, split_factor/dividend_amount, 'split'/'dividend'), ...]
     :return adjusted data
@@ -16,24 +19,173 @@ def adjust_df(data: pd.DataFrame, adjustments: pd.DataFrame):
         start = data.iloc[0].name[0] if isinstance(data.iloc[0].name, tuple) else data.iloc[0].name
         end = data.iloc[-1].name[0] if isinstance(data.iloc[0].name, tuple) else data.iloc[-1].name
 
-        adjustments = adjustments.loc[idx[start:end, list(adjustments.index.levels[1]), :, :], :].sort_index(ascending=False)
+        adjustments = adjustments.loc[idx[start:end, list(adjustments.index.levels[1]), :, :], :]
 
-        if isinstance(data.index, pd.MultiIndex):
-            for (_, row) in adjustments.iterrows():
-                if row.name[2] == 'split':
-                    adjust_split_multiindex(data=data, symbol=row.name[1], split_date=row.name[0], split_factor=row[0])
-                elif row.name[2] == 'dividend':
-                    adjust_dividend_multiindex(data=data, symbol=row.name[1], dividend_date=row.name[0], dividend_amount=row[0])
-        else:
-            for (_, row) in adjustments.iterrows():
-                if row.name[2] == 'split':
-                    adjust_split(data=data, split_date=row.name[0], split_factor=row[0])
-                elif row.name[2] == 'dividend':
-                    adjust_dividend(data=data, dividend_date=row.name[0], dividend_amount=row[0])
+        if len(adjustments) > 0:
+            if isinstance(data.index, pd.MultiIndex):
+                _adjust_multiindex(data, adjustments)
+            else:
+                _adjust_single_index(data, adjustments)
 
     return data
 
 
+_price_columns = ['close', 'high', 'open', 'low', 'ask', 'bid', 'last']
+_volume_columns = ['period_volume', 'total_volume', 'last_size']
+
+
+def effective_time(timestamp, tz) -> int:
+    """
+    Effective time of an adjustment: the start of the day of the adjustment timestamp in the time zone of the data (as in adjust_split/adjust_dividend).
+    The adjustment applies to the data with timestamp <= effective time. All the adjustment paths (adjust_df, the cached bar adjustments of
+    the streaming bars and the postgres adjustment factors) use this convention
+    :param timestamp: adjustment timestamp (or date)
+    :param tz: time zone of the data
+    :return: effective time as int64 (nanoseconds since epoch)
+    """
+    return pd.Timestamp(datetime.datetime.combine(timestamp, datetime.datetime.min.time()).replace(tzinfo=tz)).value
+
+
+def effective_times(timestamps, tz) -> np.ndarray:
+    """
+    :param timestamps: adjustment timestamps
+    :param tz: time zone of the data
+    :return: int64 array of the effective times (see effective_time)
+    """
+    return np.array([effective_time(ts, tz) for ts in timestamps], dtype=np.int64)
+
+
+def _adjust_multiindex(data: pd.DataFrame, adjustments: pd.DataFrame):
+    timestamps = data.index.levels[0]
+    tz = data.iloc[0].name[0].tz
+
+    row_timestamps = timestamps.asi8[data.index.codes[0]]
+    row_symbols = data.index.codes[1]
+    symbols = data.index.levels[1]
+
+    # the first and the last timestamp of each symbol
+    bounds = pd.Series(row_timestamps).groupby(row_symbols).agg(['min', 'max'])
+
+    # only the adjustments within the period of their symbol are applied
+    keep = np.zeros(len(adjustments), dtype=np.bool_)
+    for i, (ts, symbol, _, _) in enumerate(adjustments.index):
+        code = symbols.get_indexer([symbol])[0]
+        if code in bounds.index:
+            keep[i] = bounds.at[code, 'min'] <= effective_time(ts, tz) <= bounds.at[code, 'max']
+
+    if not keep.any():
+        return
+
+    factors = adjustment_factors(adjustments[keep])
+    factor_times = effective_times(factors.index.get_level_values('timestamp'), tz)
+    factor_symbols = symbols.get_indexer(factors.index.get_level_values('symbol'))
+
+    # the split factors in the order of the factors. The volumes of a row are adjusted with the splits of its symbol from the last one backwards
+    kept = adjustments[keep].reorder_levels([1, 0, 2, 3]).sort_index()
+    values = kept.iloc[:, 0].values.astype(np.float64)
+    is_split = (kept.index.get_level_values(2) == 'split') & (values > 0)
+    split_values = values[is_split][::-1]
+    splits_cumsum = np.cumsum(is_split)
+
+    # the rows of each symbol are adjusted with the factors of the first adjustment with effective time >= row timestamp
+    row_factor = np.full(len(data), -1, dtype=np.int64)
+    row_split_start = np.zeros(len(data), dtype=np.int64)
+
+    order = np.argsort(row_symbols, kind='mergesort')
+    row_bounds = np.searchsorted(row_symbols[order], np.arange(len(symbols) + 1))
+
+    factor_bounds = np.flatnonzero(np.diff(np.concatenate([[-1], factor_symbols, [-1]])) != 0)
+    for fb, fe in zip(factor_bounds[:-1], factor_bounds[1:]):
+        rows = order[row_bounds[factor_symbols[fb]]:row_bounds[factor_symbols[fb] + 1]]
+
+        pos = fb + np.searchsorted(factor_times[fb:fe], row_timestamps[rows], side='left')
+        row_factor[rows] = np.where(pos < fe, pos, -1)
+        row_split_start[rows] = len(split_values) - splits_cumsum[fe - 1]
+
+    adjusted = row_factor >= 0
+    row_factor = np.maximum(row_factor, 0)
+
+    _apply_prices(data, np.where(adjusted, factors['price_factor'].values[row_factor], 1.0), np.where(adjusted, factors['price_offset'].values[row_factor], 0.0))
+    _apply_splits(data, split_values, row_split_start, np.where(adjusted, factors['splits'].values[row_factor], 0))
+
+
+def _adjust_single_index(data: pd.DataFrame, adjustments: pd.DataFrame):
+    tz = data.iloc[0]['timestamp'].tz
+    first = pd.Timestamp(data['timestamp'].iloc[0]).value
+
+    row_timestamps = pd.DatetimeIndex(data['timestamp']).asi8
+
+    # the adjustments from the latest to the earliest
+    adjustments = adjustments.sort_index(ascending=False)
+    adjustment_times = effective_times(adjustments.index.get_level_values(0), tz)
+    types = adjustments.index.get_level_values(2)
+    values = adjustments.iloc[:, 0].values.astype(np.float64)
+
+    # the splits are applied to the rows before the effective time. The dividends are applied to all rows, if the effective time is after the first row
+    is_split = (types == 'split') & (values > 0) & (adjustment_times > first)
+    is_dividend = (types == 'dividend') & (adjustment_times > first)
+
+    if not (is_split.any() or is_dividend.any()):
+        return
+
+    # the rows between consecutive split times share the same adjustments
+    split_times = np.unique(adjustment_times[is_split])
+    segments = np.searchsorted(split_times, row_timestamps, side='right')
+
+    price_factor, price_offset = np.empty(len(split_times) + 1), np.empty(len(split_times) + 1)
+    for k in range(len(split_times) + 1):
+        a, b = 1.0, 0.0
+
+        for e in np.flatnonzero((is_split & (adjustment_times > (split_times[k - 1] if k > 0 else np.iinfo(np.int64).min))) | is_dividend):
+            if is_split[e]:
+                a, b = a * values[e], b * values[e]
+            else:
+                b -= values[e]
+
+        price_factor[k], price_offset[k] = a, b
+
+    _apply_prices(data, price_factor[segments], price_offset[segments])
+
+    if is_split.any():
+        # the splits with later effective time come first
+        split_values = values[is_split]
+        row_splits = (adjustment_times[is_split][np.newaxis, :] > row_timestamps[:, np.newaxis]).sum(axis=1) if len(data) * is_split.sum() < 10 ** 7 \
+            else np.array([(adjustment_times[is_split] > t).sum() for t in row_timestamps])
+
+        _apply_splits(data, split_values, np.zeros(len(data), dtype=np.int64), row_splits, np.uint64)
+
+
+def _apply_prices(data: pd.DataFrame, price_factor: np.ndarray, price_offset: np.ndarray):
+    """
+    :param price_factor: cumulative price factor of each row
+    :param price_offset: cumulative price offset of each row
+    """
+    for c in [c for c in _price_columns if c in data.columns]:
+        data[c] = data[c].values * price_factor + price_offset
+
+
+def _apply_splits(data: pd.DataFrame, split_values: np.ndarray, row_start: np.ndarray, row_splits: np.ndarray, dtype=None):
+    """
+    Adjust the volumes. The splits are applied one by one, because the volumes are truncated after each of them
+    :param split_values: split factors
+    :param row_start: position of the first (latest) split for each row in split_values
+    :param row_splits: number of splits for each row
+    :param dtype: dtype of the adjusted volume columns. If None, each column keeps its original dtype
+    """
+    if len(row_splits) == 0 or row_splits.max() == 0:
+        return
+
+    for c in [c for c in _volume_columns if c in data.columns]:
+        column_dtype = dtype if dtype is not None else data[c].dtype
+        values = data[c].values.astype(np.float64)
+
+        for j in range(row_splits.max()):
+            rows = np.flatnonzero(row_splits > j)
+            values[rows] = np.trunc(values[rows] * (1 / split_values[row_start[rows] + j]))
+
+        data[c] = values.astype(column_dtype)
+
+
 def adjust(data, adjustments: pd.DataFrame):
     """
     IMPORTANT !!! This method supports single index df
@@ -120,6 +272,47 @@ def adjust_split_multiindex(data: pd.DataFrame, symbol: str, split_factor: float
                 data.loc[idx[:split_date, symbol], c] *= split_factor
 
 
+def adjustment_factors(adjustments: pd.DataFrame) -> pd.DataFrame:
+    """
+    Cumulative adjustment factors of each symbol. The adjustments are composed from the latest to the earliest (the order of adjust_df).
+    Data with timestamp t is adjusted with all the adjustments of its symbol, which have timestamp >= t:
+    price * price_factor + price_offset and volume * volume_factor
+    :param adjustments: adjustments with (timestamp, symbol, type, provider) index and a single value column (like get_splits_dividends)
+    :return: DataFrame with (symbol, timestamp) index, sorted ascending, and price_factor, price_offset, volume_factor, splits (number of splits) columns.
+            Each row contains the composition of the adjustment with that timestamp and all the later adjustments of the symbol
+    """
+    # (symbol, timestamp, type, provider). For the same timestamp the splits are composed before the dividends
+    adjustments = adjustments.reorder_levels([1, 0, 2, 3]).sort_index()
+
+    symbols = adjustments.index.get_level_values(0)
+    timestamps = adjustments.index.get_level_values(1)
+    types = adjustments.index.get_level_values(2)
+    values = adjustments.iloc[:, 0].values.astype(np.float64)
+
+    is_split = (types == 'split') & (values > 0)
+    is_dividend = types == 'dividend'
+
+    # each adjustment as p -> a * p + b
+    a = np.where(is_split, values, 1.0)
+    b = np.where(is_dividend, -values, 0.0)
+    v = np.where(is_split, 1 / np.where(is_split, values, 1.0), 1.0)
+
+    price_factor, price_offset, volume_factor, splits = np.empty(len(a)), np.empty(len(a)), np.empty(len(a)), np.empty(len(a), dtype=np.int64)
+
+    for i in range(len(a) - 1, -1, -1):
+        if i == len(a) - 1 or symbols[i] != symbols[i + 1]:
+            price_factor[i], price_offset[i], volume_factor[i], splits[i] = a[i], b[i], v[i], is_split[i]
+        else:
+            price_factor[i] = a[i] * price_factor[i + 1]
+            price_offset[i] = a[i] * price_offset[i + 1] + b[i]
+            volume_factor[i] = v[i] * volume_factor[i + 1]
+            splits[i] = is_split[i] + splits[i + 1]
+
+    return pd.DataFrame({'price_factor': price_factor, 'price_offset': price_offset, 'volume_factor': volume_factor, 'splits': splits},
+                        index=pd.MultiIndex.from_arrays([symbols, timestamps], names=['symbol', 'timestamp']),
+                        columns=['price_factor', 'price_offset', 'volume_factor', 'splits'])
+
+
 def exclude_splits(data: pd.Series, splits: pd.Series, quarantine_length: int):
     """
     exclude data based on proximity to split event
@@ -1,3 +1,5 @@
+import queue
+import typing
 from ftplib import FTP
 from io import StringIO
 
@@ -83,3 +85,65 @@ def get_us_listed_companies():
     symbols.sort()
 
     return pd.DataFrame(symbols)
+
+
+def dataframe_memory(item) -> int:
+    """
+    Memory footprint of a DataFrame (or of the DataFrames in a tuple) in bytes
+    :param item: DataFrame, tuple, or None
+    :return: size in bytes
+    """
+    if isinstance(item, pd.DataFrame):
+        return int(item.memory_usage(index=True).sum())
+    elif isinstance(item, pd.Series):
+        return int(item.memory_usage(index=True))
+    elif isinstance(item, tuple):
+        return sum([dataframe_memory(i) for i in item])
+    else:
+        return 0
+
+
+class MemoryBoundedQueue(queue.Queue):
+    """
+    FIFO queue, bounded by the total memory of the items (instead of their number).
+    The producers block while the limit is exceeded. An item is always admitted into an empty queue, even if it's larger than the limit
+    """
+
+    def __init__(self, max_memory: int, sizeof: typing.Callable = dataframe_memory):
+        """
+        :param max_memory: maximum memory of the queued items in bytes
+        :param sizeof: function, which computes the size of an item
+        """
+        self.max_memory = max_memory
+        self.sizeof = sizeof
+
+        super().__init__()
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.memory = 0
+
+    def put(self, item, block=True, timeout=None):
+        size = self.sizeof(item)
+
+        with self.not_full:
+            if self.memory > 0 and self.memory + size > self.max_memory:
+                if not block:
+                    raise queue.Full
+                elif not self.not_full.wait_for(lambda: self.memory == 0 or self.memory + size <= self.max_memory, timeout=timeout):
+                    raise queue.Full
+
+            self._put((size, item))
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put(self, item):
+        self.memory += item[0]
+        super()._put(item)
+
+    def _get(self):
+        size, item = super()._get()
+        self.memory -= size
+        self.not_full.notify_all()
+
+        return item
@@ -19,6 +19,8 @@ class BaseOrder(object, metaclass=ABCMeta):
         self.quantity = quantity
 
         self.__obtained_positions = list()
+        self.__obtained_quantity = 0
+        self.__cost = 0
         self.request_time = datetime.datetime.utcnow().replace(tzinfo=tz.gettz('UTC'))
         self.__fulfill_time = None
 
@@ -35,22 +37,28 @@ class BaseOrder(object, metaclass=ABCMeta):
 
     @property
     def obtained_quantity(self):
-        return sum([op[0] for op in self.__obtained_positions])
+        return self.__obtained_quantity
 
     def add_position(self, quantity, price):
-        if self.obtained_quantity >= self.quantity:
+        if self.__obtained_quantity >= self.quantity:
             raise Exception("Order already fulfilled")
 
-        self.__obtained_positions.append((quantity if self.quantity - self.obtained_quantity >= quantity else self.quantity - self.obtained_quantity, price))
+        quantity = quantity if self.quantity - self.__obtained_quantity >= quantity else self.quantity - self.__obtained_quantity
 
-        if self.obtained_quantity >= self.quantity:
+        self.__obtained_positions.append((quantity, price))
+
+        # running totals, accumulated in the same order as the positions
+        self.__obtained_quantity += quantity
+        self.__cost += quantity * price
+
+        if self.__obtained_quantity >= self.quantity:
             self.__fulfill_time = datetime.datetime.utcnow().replace(tzinfo=tz.gettz('UTC'))
 
         return True
 
     @property
     def cost(self):
-        return sum([p[0] * p[1] for p in self.__obtained_positions])
+        return self.__cost
 
     @property
     def last_cost_per_share(self):
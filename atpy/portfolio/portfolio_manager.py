@@ -1,28 +1,59 @@
 import logging
 import threading
 
+import numpy as np
+import pandas as pd
+
 from atpy.portfolio.order import *
 
 
 class PortfolioManager(object):
     """Orders portfolio manager"""
 
-    def __init__(self, listeners, initial_capital: float, uid=None, orders=None):
+    def __init__(self, listeners, initial_capital: float, uid=None, orders=None, value_update_interval=None):
+        """
+        :param listeners: listeners
+        :param initial_capital: initial capital
+        :param uid: portfolio id
+        :param orders: initial list of fulfilled orders
+        :param value_update_interval: coalesce the portfolio_value_update events, which are fired on price updates.
+                None fires an event for each price update. datetime.timedelta (or number of milliseconds) fires at most one event per interval
+                of the price data timestamps (or of the wall clock, if the data has no timestamps).
+                'timestamp' fires one event per timestamp of the price data, once all the prices for the timestamp are received.
+                In both modes the last coalesced event is fired on the 'no_data' event (end of the data replay) or when flush_value_update is called
+        """
         self.listeners = listeners
         self.listeners += self.on_event
 
         self.initial_capital = initial_capital
         self._id = uid if uid is not None else uuid.uuid4()
-        self.orders = orders if orders is not None else list()
+        self.orders = list()
         self._lock = threading.RLock()
         self._values = dict()
 
+        # ledgers, which are updated with each new order
+        self._uids = set()
+        self._quantities = dict()
+        self._last_orders = dict()
+        self._turnover = 0
+
+        for o in orders if orders is not None else list():
+            self._add_to_ledgers(o)
+
+        if value_update_interval is not None and value_update_interval != 'timestamp' and not isinstance(value_update_interval, datetime.timedelta):
+            value_update_interval = datetime.timedelta(milliseconds=value_update_interval)
+
+        self.value_update_interval = value_update_interval
+        self._value_update_pending = False
+        self._value_update_timestamp = None
+        self._last_value_update = None
+
     def add_order(self, order):
         with self._lock:
             if order.fulfill_time is None:
                 raise Exception("Order has no fulfill_time set")
 
-            if len([o for o in self.orders if o.uid == order.uid]) > 0:
+            if order.uid in self._uids:
                 raise Exception("Attempt to fulfill existing order")
 
             if order.order_type == Type.SELL and self._quantity(order.symbol) < order.quantity:
@@ -31,14 +62,32 @@ class PortfolioManager(object):
             if order.order_type == Type.BUY and self._capital < order.cost:
                 raise Exception("Not enough capital to fulfill order")
 
-            self.orders.append(order)
+            self._add_to_ledgers(order)
 
             self.listeners({'type': 'watch_ticks', 'data': order.symbol})
             self.listeners({'type': 'portfolio_update', 'data': self})
 
+    def _add_to_ledgers(self, order):
+        self.orders.append(order)
+        self._uids.add(order.uid)
+
+        if order.order_type == Type.BUY:
+            self._quantities[order.symbol] = self._quantities.get(order.symbol, 0) + order.quantity
+            self._turnover -= order.cost
+        elif order.order_type == Type.SELL:
+            self._quantities[order.symbol] = self._quantities.get(order.symbol, 0) - order.quantity
+            self._turnover += order.cost
+        else:
+            self._quantities.setdefault(order.symbol, 0)
+
+        # the earliest of the orders with the latest fulfill time
+        last = self._last_orders.get(order.symbol)
+        if last is None or order.fulfill_time > last.fulfill_time:
+            self._last_orders[order.symbol] = order
+
     @property
     def symbols(self):
-        return set([o.symbol for o in self.orders])
+        return set(self._quantities.keys())
 
     @property
     def capital(self):
@@ -47,15 +96,7 @@ class PortfolioManager(object):
 
     @property
     def _capital(self):
-        turnover = 0
-        for o in self.orders:
-            cost = o.cost
-            if o.order_type == Type.SELL:
-                turnover += cost
-            elif o.order_type == Type.BUY:
-                turnover -= cost
-
-        return self.initial_capital + turnover
+        return self.initial_capital + self._turnover
 
     def quantity(self, symbol=None):
         with self._lock:
@@ -63,21 +104,25 @@ class PortfolioManager(object):
 
     def _quantity(self, symbol=None):
         if symbol is not None:
-            quantity = 0
-
-            for o in [o for o in self.orders if o.symbol == symbol]:
-                if o.order_type == Type.BUY:
-                    quantity += o.quantity
-                elif o.order_type == Type.SELL:
-                    quantity -= o.quantity
-
-            return quantity
+            return self._quantities.get(symbol, 0)
         else:
-            result = dict()
-            for s in set([o.symbol for o in self.orders]):
-                result[s] = self._quantity(s)
+            return dict(self._quantities)
 
-            return result
+    @property
+    def prices(self):
+        """
+        :return: dict of the current prices of the portfolio symbols
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def update_prices(self, prices: dict):
+        """
+        Set the current prices of symbols (without firing events)
+        :param prices: dict of symbol: price
+        """
+        with self._lock:
+            self._values.update(prices)
 
     def value(self, symbol=None, multiply_by_quantity=False):
         with self._lock:
@@ -87,14 +132,12 @@ class PortfolioManager(object):
         if symbol is not None:
             if symbol not in self._values:
                 logging.getLogger(__name__).debug("No current information available for " + symbol + ". Falling back to last traded price")
-                symbol_orders = [o for o in self.orders if o.symbol == symbol]
-                order = sorted(symbol_orders, key=lambda o: o.fulfill_time, reverse=True)[0]
-                return order.last_cost_per_share * (self._quantity(symbol=symbol) if multiply_by_quantity else 1)
+                return self._last_orders[symbol].last_cost_per_share * (self._quantity(symbol=symbol) if multiply_by_quantity else 1)
             else:
                 return self._values[symbol] * (self._quantity(symbol=symbol) if multiply_by_quantity else 1)
         else:
             result = dict()
-            for s in set([o.symbol for o in self.orders]):
+            for s in self._quantities:
                 result[s] = self._value(symbol=s, multiply_by_quantity=multiply_by_quantity)
 
             return result
@@ -102,16 +145,97 @@ class PortfolioManager(object):
     def on_event(self, event):
         if event['type'] == 'order_fulfilled':
             self.add_order(event['data'])
-        elif event['type'] == 'level_1_tick':
+        elif event['type'] == 'no_data':
+            self.flush_value_update()
+        elif event['type'] in ('level_1_tick', 'level_1_tick_batch', 'bar'):
             with self._lock:
-                if event['data']['symbol'] in [o.symbol for o in self.orders]:
-                    self._values[event['data']['symbol']] = event['data']['bid']
-                    self.listeners({'type': 'portfolio_value_update', 'data': self})
-        elif event['type'] == 'bar':
-            with self._lock:
-                if event['data']['symbol'] in [o.symbol for o in self.orders]:
-                    self._values[event['data']['symbol']] = event['data']['close']
-                    self.listeners({'type': 'portfolio_value_update', 'data': self})
+                timestamp = self._event_timestamp(event) if self.value_update_interval is not None else None
+
+                # the prices of the previous timestamp are complete
+                if self._value_update_pending and self.value_update_interval == 'timestamp' and (timestamp is None or timestamp != self._value_update_timestamp):
+                    self._fire_value_update()
+
+                if self._update_values(event['data'], 'close' if event['type'] == 'bar' else 'bid'):
+                    self._value_update_pending = True
+                    self._value_update_timestamp = timestamp
+
+                if self._value_update_pending:
+                    if self.value_update_interval is None or (self.value_update_interval == 'timestamp' and timestamp is None):
+                        self._fire_value_update()
+                    elif isinstance(self.value_update_interval, datetime.timedelta):
+                        now = timestamp if timestamp is not None else datetime.datetime.now()
+                        if self._last_value_update is None or now - self._last_value_update >= self.value_update_interval:
+                            self._fire_value_update(now)
+
+    def flush_value_update(self):
+        """
+        Fire the coalesced portfolio_value_update event, if there is one
+        """
+        with self._lock:
+            if self._value_update_pending:
+                self._fire_value_update(self._value_update_timestamp)
+
+    def _fire_value_update(self, now=None):
+        """
+        :param now: time of the update (event timestamp or wall clock). Used for the timedelta value_update_interval
+        """
+        self._value_update_pending = False
+        self._value_update_timestamp = None
+        self._last_value_update = now if now is not None else datetime.datetime.now()
+
+        self.listeners({'type': 'portfolio_value_update', 'data': self})
+
+    def _update_values(self, data, column: str):
+        """
+        Update the current prices of the portfolio symbols
+        :param data: dict with the price of a single symbol or DataFrame (bars or tick batch) with the prices of multiple symbols.
+                For DataFrames, the last price of each symbol is used
+        :param column: price column
+        :return: whether any of the prices was updated
+        """
+        if not isinstance(data, pd.DataFrame):
+            if data['symbol'] in self._quantities:
+                self._values[data['symbol']] = data[column]
+                return True
+
+            return False
+
+        if len(self._quantities) == 0 or len(data) == 0:
+            return False
+
+        symbols = data.index.get_level_values('symbol') if 'symbol' in data.index.names else pd.Index(data['symbol'])
+        rows = np.flatnonzero(symbols.isin(list(self._quantities.keys())))
+        if len(rows) == 0:
+            return False
+
+        marks = pd.Series(data[column].values[rows], index=symbols[rows])
+        marks = marks[~marks.index.duplicated(keep='last')]
+
+        self._values.update(marks.items())
+
+        return True
+
+    @staticmethod
+    def _event_timestamp(event):
+        """
+        :return: timestamp of the price data in the event or None if not available
+        """
+        if 'timestamp' in event:
+            return event['timestamp']
+
+        data = event['data']
+
+        if isinstance(data, pd.DataFrame):
+            if isinstance(data.index, pd.DatetimeIndex):
+                return data.index.max()
+            elif isinstance(data.index, pd.MultiIndex):
+                for i, l in enumerate(data.index.levels):
+                    if isinstance(l, pd.DatetimeIndex):
+                        return l[data.index.codes[i].max()]
+
+            return data['timestamp'].max() if 'timestamp' in data.columns else None
+
+        return data.get('timestamp')
 
     def __getstate__(self):
         # Copy the object's state from self.__dict__ which contains
@@ -10,7 +10,7 @@ import psycopg2
 from dateutil.relativedelta import relativedelta
 
 import atpy.data.iqfeed.util as iqutil
-from atpy.data.cache.postgres_cache import update_to_latest
+from atpy.data.cache.postgres_cache import update_to_latest, bars_watermarks_table
 from atpy.data.iqfeed.iqfeed_history_provider import IQFeedHistoryProvider
 from atpy.data.iqfeed.iqfeed_postgres_cache import noncache_provider
 
@@ -23,6 +23,8 @@ if __name__ == "__main__":
     parser.add_argument('-drop', action='store_true', help="Drop the table")
     parser.add_argument('-table_name', type=str, default=None, required=True, help="PostgreSQL database name")
     parser.add_argument('-cluster', action='store_true', help="Cluster the table after the opertion")
+    parser.add_argument('-partitioned', action='store_true', help="Create the table with monthly partitions (if it doesn't exist)")
+    parser.add_argument('-partition_by_interval', action='store_true', help="Partition the table by interval and then by month (if it doesn't exist)")
 
     parser.add_argument('-interval_len', type=int, default=None, help="Interval length")
     parser.add_argument('-interval_type', type=str, default='s', help="Interval type (seconds, days, etc)")
@@ -40,6 +42,7 @@ if __name__ == "__main__":
     if args.drop:
         cur = con.cursor()
         cur.execute("DROP TABLE IF EXISTS {0};".format(args.table_name))
+        cur.execute("DROP TABLE IF EXISTS {0};".format(bars_watermarks_table(args.table_name)))
 
     if args.interval_len is None or args.interval_type is None:
         parser.error('-interval_len and -interval_type are required')
@@ -47,4 +50,5 @@ if __name__ == "__main__":
     with IQFeedHistoryProvider(num_connections=args.iqfeed_conn) as history:
         all_symbols = set((s, args.interval_len, args.interval_type) for s in set(iqutil.get_symbols(symbols_file=args.symbols_file).keys()))
         update_to_latest(url=args.url, bars_table=args.table_name, noncache_provider=noncache_provider(history), symbols=all_symbols, time_delta_back=relativedelta(years=args.delta_back),
-                         skip_if_older_than=relativedelta(days=args.skip_if_older) if args.skip_if_older is not None else None, cluster=args.cluster)
+                         skip_if_older_than=relativedelta(days=args.skip_if_older) if args.skip_if_older is not None else None, cluster=args.cluster,
+                         partitioned=args.partitioned or args.partition_by_interval, partition_by_interval=args.partition_by_interval)
@@ -82,6 +82,8 @@ setup(
         'quandl': ['quandl'],
         'postgres': ['psycopg2-binary', 'lmdb'],
         'sqlalchemy': ['sqlalchemy'],
+        'lz4': ['lz4'],
+        'zstandard': ['zstandard'],
     },
 
     dependency_links=[
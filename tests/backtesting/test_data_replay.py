@@ -1,6 +1,8 @@
 import random
 import unittest
 
+from pandas.util.testing import assert_frame_equal
+
 from atpy.backtesting.data_replay import DataReplay, DataReplayEvents
 from atpy.data.iqfeed.iqfeed_history_provider import *
 from atpy.data.latest_data_snapshot import LatestDataSnapshot
@@ -126,6 +128,156 @@ class TestDataReplay(unittest.TestCase):
 
             self.assertTrue({3, 4, 5, 6, 8} < months)
 
+    def test_interleaved(self):
+        historical_depth = 3
+
+        ind1 = pd.date_range('2017-01-01', periods=100, freq='min', tz='US/Eastern', name='timestamp')
+        ind1 = pd.MultiIndex.from_product([ind1[::2].union(ind1[1::5]), ['AAPL', 'IBM']], names=['timestamp', 'symbol'])
+        df1 = pd.DataFrame({'close': range(len(ind1))}, index=ind1)
+
+        ind2 = pd.date_range('2017-01-01 00:00:30', periods=50, freq='90s', tz='US/Eastern', name='timestamp')
+        df2 = pd.DataFrame({'close': range(len(ind2))}, index=ind2)
+
+        chunks1 = [df1.iloc[:40], df1.iloc[:0], df1.iloc[40:100], df1.iloc[100:]]
+        chunks1 = [df.set_index(df.index.remove_unused_levels()) for df in chunks1]
+
+        dr = DataReplay().add_source(chunks1, 'e1', historical_depth=historical_depth) \
+            .add_source([df2.iloc[:7], df2.iloc[7:]], 'e2')
+
+        timeline = ind1.levels[0].union(ind2)
+        results = list(dr)
+
+        self.assertEqual(len(results), len(timeline))
+
+        for t, r in zip(timeline, results):
+            self.assertEqual(r['timestamp'], t.to_pydatetime())
+            self.assertEqual(list(r.keys())[0], 'timestamp')
+            self.assertEqual('e1' in r, t in ind1.levels[0])
+            self.assertEqual('e2' in r, t in ind2)
+
+            if 'e1' in r:
+                timestamps = ind1.levels[0]
+                expected = df1.loc[timestamps[max(0, timestamps.get_loc(t) - historical_depth)]:t]
+                assert_frame_equal(r['e1'], expected)
+
+            if 'e2' in r:
+                assert_frame_equal(r['e2'], df2.loc[t:t])
+
+    def test_read_ahead(self):
+        ind = pd.MultiIndex.from_product([pd.date_range('2017-01-01', periods=200, freq='min', tz='UTC', name='timestamp'), ['AAPL', 'IBM']], names=['timestamp', 'symbol'])
+        df1 = pd.DataFrame({'close': range(len(ind))}, index=ind)
+
+        df2 = pd.DataFrame({'close': range(100)}, index=pd.date_range('2017-01-01 00:00:30', periods=100, freq='3min', tz='UTC', name='timestamp'))
+
+        requested = list()
+
+        def chunks(df, name, size):
+            for i in range(0, len(df), size):
+                time.sleep(0.01)
+                requested.append(name)
+                chunk = df.iloc[i:i + size]
+                yield chunk.set_index(chunk.index.remove_unused_levels()) if isinstance(chunk.index, pd.MultiIndex) else chunk
+
+        def replay(read_ahead):
+            pre_data = list()
+
+            dr = DataReplay().add_source(chunks(df1, 'e1', 50), 'e1', historical_depth=5, listeners=lambda e: pre_data.append(e['e1_full']), read_ahead=read_ahead) \
+                .add_source(chunks(df2, 'e2', 30), 'e2', historical_depth=2, read_ahead=read_ahead)
+
+            return list(dr), pre_data
+
+        expected, expected_pre_data = replay(0)
+        del requested[:]
+
+        results, pre_data = replay(2)
+
+        self.assertEqual(len(results), len(expected))
+        self.assertEqual(len(pre_data), len(expected_pre_data))
+
+        for r1, r2 in zip(expected, results):
+            self.assertEqual(list(r1.keys()), list(r2.keys()))
+            self.assertEqual(r1['timestamp'], r2['timestamp'])
+
+            for e in [e for e in r1 if e != 'timestamp']:
+                assert_frame_equal(r1[e], r2[e])
+
+        for d1, d2 in zip(expected_pre_data, pre_data):
+            assert_frame_equal(d1, d2)
+
+        self.assertEqual(requested.count('e1'), 8)
+        self.assertEqual(requested.count('e2'), 4)
+
+        def failing():
+            yield df2.iloc[:10]
+            raise Exception('Provider error')
+
+        self.assertRaises(Exception, list, DataReplay().add_source(failing(), 'e1', read_ahead=1))
+
+        # the prefetch thread stops, if the replay is closed before the end
+        def endless():
+            while True:
+                yield df2
+
+        threads = threading.active_count()
+
+        dr = iter(DataReplay().add_source(endless(), 'e1', read_ahead=2))
+        for _ in range(5):
+            next(dr)
+
+        self.assertEqual(threading.active_count(), threads + 1)
+
+        dr.close()
+
+        for _ in range(50):
+            if threading.active_count() == threads:
+                break
+
+            time.sleep(0.1)
+
+        self.assertEqual(threading.active_count(), threads)
+
+        # the replay is closed before the first chunk
+        dr = iter(DataReplay().add_source(endless(), 'e1', read_ahead=2))
+
+        self.assertEqual(threading.active_count(), threads + 1)
+
+        dr.close()
+
+        for _ in range(50):
+            if threading.active_count() == threads:
+                break
+
+            time.sleep(0.1)
+
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_year_replay_performance(self):
+        """
+        Replay one year of 1 minute bars for 500 symbols, provided in monthly chunks
+        """
+        logging.basicConfig(level=logging.DEBUG)
+
+        historical_depth = 100
+        symbols = ['SYMBOL_' + str(i) for i in range(500)]
+
+        def months():
+            days = pd.bdate_range('2017-01-01', '2017-12-31')
+            for _, month in days.to_series().groupby(days.month):
+                timestamps = pd.DatetimeIndex(np.concatenate([pd.date_range(d + pd.Timedelta('9h30m'), periods=390, freq='min').values for d in month.index]), name='timestamp')
+                ind = pd.MultiIndex.from_product([timestamps.tz_localize('US/Eastern'), symbols], names=['timestamp', 'symbol'])
+                yield pd.DataFrame({'close': np.random.rand(len(ind)), 'period_volume': np.random.randint(0, 100000, len(ind))}, index=ind)
+
+        now = datetime.datetime.now()
+
+        i = 0
+        for i, r in enumerate(DataReplay().add_source(months(), 'e1', historical_depth=historical_depth)):
+            self.assertEqual(r['e1'].shape[0], min(i + 1, historical_depth + 1) * len(symbols))
+
+        elapsed = datetime.datetime.now() - now
+        logging.getLogger(__name__).debug('Time elapsed ' + str(elapsed) + ' for ' + str(i + 1) + ' iterations; ' + str(elapsed / (i + 1)) + ' per iteration')
+
+        self.assertEqual(i + 1, len(pd.bdate_range('2017-01-01', '2017-12-31')) * 390)
+
     def test_3_performance(self):
         logging.basicConfig(level=logging.DEBUG)
 
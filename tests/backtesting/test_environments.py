@@ -1,7 +1,12 @@
 import unittest
 
+import numpy as np
+
 from atpy.backtesting.environments import *
+from atpy.backtesting.mock_broker import MockBroker
 from atpy.data.iqfeed.iqfeed_postgres_cache import *
+from atpy.portfolio.order import MarketOrder, Type
+from atpy.portfolio.portfolio_manager import PortfolioManager
 from pyevents.events import SyncListeners
 
 
@@ -111,6 +116,65 @@ class TestEnvironments(unittest.TestCase):
         self.assertIsNotNone(dct['latest_1d'])
         self.assertIsNotNone(dct['latest_quandl_sf0'])
 
+    def test_parameter_sweep(self):
+        ind = pd.MultiIndex.from_product([pd.date_range('2017-01-01', periods=500, freq='min', tz='UTC', name='timestamp'), ['AAPL', 'IBM']], names=['timestamp', 'symbol'])
+        rs = np.random.RandomState(0)
+        df = pd.DataFrame({'close': rs.randint(10, 20, len(ind)).astype(np.float64), 'period_volume': rs.randint(1, 100, len(ind))}, index=ind)
+
+        def stack(listeners, window):
+            def strategy(e):
+                if e['type'] == 'data':
+                    close = e['bars'].xs('AAPL', level='symbol')
+                    if close['close_rm_' + str(window)].iloc[-1] < close['close'].iloc[-1]:
+                        listeners({'type': 'order_request', 'data': MarketOrder(Type.BUY, 'AAPL', 1)})
+
+            listeners += strategy
+
+            MockBroker(listeners=listeners, accept_bars=lambda e: e['bars'] if e['type'] == 'data' else None)
+
+            return PortfolioManager(listeners=listeners, initial_capital=1000000)
+
+        def run(windows, sweep):
+            listeners = SyncListeners()
+
+            dre = data_replay_events(listeners)
+            dre.data_replay.add_source([df], 'bars', historical_depth=20)
+
+            counter = {'features': 0}
+
+            def features(e):
+                if e['type'] == 'data':
+                    counter['features'] += 1
+                    for w in windows:
+                        e['bars']['close_rm_' + str(w)] = e['bars']['close'].groupby(level='symbol').transform(lambda x: x.rolling(w).mean())
+
+            listeners += features
+
+            if sweep:
+                results = add_parameter_sweep(listeners, stack, windows)
+            else:
+                results = [stack(listeners, windows[0])]
+
+            dre.start()
+
+            return results, counter['features']
+
+        windows = [3, 5, 10]
+        results, features = run(windows, sweep=True)
+
+        self.assertEqual(features, 500)
+        self.assertEqual(len(results), len(windows))
+
+        for w, pm in zip(windows, results):
+            expected, _ = run([w], sweep=False)
+            expected = expected[0]
+
+            self.assertGreater(len(pm.orders), 0)
+            self.assertEqual(pm.quantity(), expected.quantity())
+            self.assertAlmostEqual(pm.capital, expected.capital)
+
+        self.assertNotEqual(results[0].capital, results[2].capital)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -280,6 +280,142 @@ class TestMockOrders(unittest.TestCase):
         self.assertGreater(o3.cost, 0)
         self.assertIsNotNone(o3.fulfill_time)
 
+    def test_resting_orders(self):
+        listeners = SyncListeners()
+
+        broker = MockBroker(listeners=listeners)
+
+        fulfilled = list()
+        listeners += lambda x: fulfilled.append(x['data']) if x['type'] == 'order_fulfilled' else None
+
+        resting = [LimitOrder(Type.BUY, 'GOOG', 1, 10 - i / 1000) for i in range(1000)] + [LimitOrder(Type.SELL, 'GOOG', 1, 20 + i / 1000) for i in range(1000)]
+        for o in resting:
+            listeners({'type': 'order_request', 'data': o})
+
+        o1 = LimitOrder(Type.BUY, 'GOOG', 5, 15)
+        o2 = StopMarketOrder(Type.SELL, 'GOOG', 5, 16)
+        o3 = MarketOrder(Type.BUY, 'AAPL', 5)
+        o4 = StopLimitOrder(Type.BUY, 'GOOG', 3, 14, 14.5)
+
+        for o in [o1, o2, o3, o4]:
+            listeners({'type': 'order_request', 'data': o})
+
+        self.assertEqual(len(broker.pending_orders), 2004)
+
+        index = pd.MultiIndex.from_product([pd.date_range('2017-01-01', periods=2, freq='min'), ['AAPL', 'GOOG', 'IBM']], names=['timestamp', 'symbol'])
+
+        # the stop limit order is triggered, but not filled
+        listeners({'type': 'bar', 'data': pd.DataFrame({'close': [1, 2, 3, 1, 13.5, 3], 'period_volume': [3, 3, 3, 3, 3, 3]}, index=index)})
+
+        self.assertEqual(fulfilled, [])
+        self.assertEqual(o1.obtained_quantity, 3)
+        self.assertEqual(o3.obtained_quantity, 3)
+        self.assertEqual(o4.obtained_quantity, 0)
+        self.assertTrue(o4._is_limit)
+
+        listeners({'type': 'bar', 'data': pd.DataFrame({'close': [1, 2, 3, 1, 16.5, 3], 'period_volume': [3, 3, 3, 3, 3, 3]}, index=index)})
+
+        self.assertEqual(fulfilled, [o3, o4])
+        self.assertEqual(o1.obtained_quantity, 3)
+        self.assertEqual(o2.obtained_quantity, 3)
+
+        listeners({'type': 'level_1_tick', 'data': {'symbol': 'GOOG', 'tick_id': 1, 'last_size': 10, 'ask': 14, 'bid': 15}})
+
+        self.assertEqual(fulfilled, [o3, o4, o1, o2])
+        self.assertEqual(broker.pending_orders, resting)
+        self.assertTrue(all([o.obtained_quantity == 0 for o in resting]))
+
+    def test_tick_fills_compaction(self):
+        listeners = SyncListeners()
+
+        broker = MockBroker(listeners=listeners)
+
+        fulfilled = list()
+        listeners += lambda x: fulfilled.append(x['data']) if x['type'] == 'order_fulfilled' else None
+
+        symbols = ['SYMBOL_' + str(i) for i in range(10)]
+
+        requested = [LimitOrder(Type.BUY, symbols[i % len(symbols)], 1, 10 + i % 3) for i in range(1000)]
+        for o in requested:
+            listeners({'type': 'order_request', 'data': o})
+
+        # fill the orders of each symbol one price level at a time, so that the table is compacted along the way
+        expected = list()
+        for price in [12, 11]:
+            for i, s in enumerate(symbols):
+                listeners({'type': 'level_1_tick', 'data': {'symbol': s, 'tick_id': i, 'last_size': 1000, 'ask': price, 'bid': price}})
+                expected += [o for o in requested if o.symbol == s and o.price >= price and o not in expected]
+
+                self.assertEqual(fulfilled, expected)
+                self.assertEqual(broker.pending_orders, [o for o in requested if o not in expected])
+
+            # new orders after the compaction
+            o = MarketOrder(Type.SELL, symbols[0], 1)
+            listeners({'type': 'order_request', 'data': o})
+            listeners({'type': 'level_1_tick', 'data': {'symbol': symbols[0], 'tick_id': 0, 'last_size': 1, 'ask': 20, 'bid': 20}})
+            expected.append(o)
+
+            self.assertEqual(fulfilled, expected)
+
+        self.assertEqual(broker.pending_orders, [o for o in requested if o.price == 10])
+        self.assertTrue(all([o.obtained_quantity == 1 for o in expected]))
+
+    def test_resting_orders_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        listeners = SyncListeners()
+
+        broker = MockBroker(listeners=listeners)
+
+        symbols = ['SYMBOL_' + str(i) for i in range(500)]
+        for i in range(10000):
+            listeners({'type': 'order_request', 'data': LimitOrder(Type.BUY, symbols[i % len(symbols)], 1, 10 - i / 100000)})
+
+        index = pd.MultiIndex.from_product([pd.date_range('2017-01-01', periods=100, freq='min'), symbols], names=['timestamp', 'symbol'])
+        df = pd.DataFrame({'close': np.random.uniform(11, 12, len(index)), 'period_volume': np.random.randint(1, 100, len(index))}, index=index)
+
+        now = datetime.datetime.now()
+
+        for t in df.index.levels[0]:
+            listeners({'type': 'bar', 'data': df.loc[t:t]})
+
+        for i in range(10000):
+            listeners({'type': 'level_1_tick', 'data': {'symbol': symbols[i % len(symbols)], 'tick_id': i, 'last_size': 10, 'ask': 11, 'bid': 11}})
+
+        logging.getLogger(__name__).debug('Time elapsed for 100 bars and 10000 ticks with 10000 resting orders: ' + str(datetime.datetime.now() - now))
+
+        self.assertEqual(len(broker.pending_orders), 10000)
+
+    def test_bar_fills_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        listeners = SyncListeners()
+
+        MockBroker(listeners=listeners)
+
+        fulfilled = list()
+        listeners += lambda x: fulfilled.append(x['data']) if x['type'] == 'order_fulfilled' else None
+
+        symbols = ['SYMBOL_' + str(i) for i in range(500)]
+
+        requested = list()
+        for i in range(20000):
+            o = MarketOrder(Type.BUY, symbols[i % len(symbols)], 10) if i % 2 == 0 else LimitOrder(Type.SELL, symbols[i % len(symbols)], 10, 11)
+            requested.append(o)
+            listeners({'type': 'order_request', 'data': o})
+
+        index = pd.MultiIndex.from_product([pd.date_range('2017-01-01', periods=2, freq='min'), symbols], names=['timestamp', 'symbol'])
+        df = pd.DataFrame({'close': np.full(len(index), 12.0), 'period_volume': np.full(len(index), 100)}, index=index)
+
+        now = datetime.datetime.now()
+
+        listeners({'type': 'bar', 'data': df})
+
+        logging.getLogger(__name__).debug('Time elapsed for filling 20000 orders: ' + str(datetime.datetime.now() - now))
+
+        self.assertEqual(fulfilled, requested)
+        self.assertTrue(all([o.cost == 120 for o in requested]))
+
 
 if __name__ == '__main__':
     unittest.main()
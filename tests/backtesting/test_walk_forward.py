@@ -0,0 +1,110 @@
+import datetime
+import unittest
+
+import numpy as np
+import pandas as pd
+from dateutil import tz
+
+from atpy.backtesting.data_replay import DataReplay, DataReplayEvents
+from atpy.backtesting.mock_broker import MockBroker
+from atpy.backtesting.walk_forward import time_shards, run_shard, walk_forward, merge_portfolios
+from atpy.portfolio.order import MarketOrder, Type
+from atpy.portfolio.portfolio_manager import PortfolioManager
+
+historical_depth = 10
+
+
+def bars(bgn_prd: datetime.datetime):
+    """
+    Daily chunks of 1 minute bars for two symbols, starting at bgn_prd
+    """
+    for day in pd.date_range(pd.Timestamp(bgn_prd).tz_convert('UTC').floor('D'), pd.Timestamp('2017-01-20', tz='UTC'), freq='D'):
+        timestamps = pd.date_range(day, periods=1440, freq='min', name='timestamp')
+        timestamps = timestamps[timestamps >= bgn_prd]
+
+        ind = pd.MultiIndex.from_product([timestamps, ['AAPL', 'IBM']], names=['timestamp', 'symbol'])
+        rs = np.random.RandomState(day.dayofyear)
+
+        yield pd.DataFrame({'close': rs.randint(10, 20, len(ind)).astype(np.float64), 'period_volume': rs.randint(1, 100, len(ind))}, index=ind)
+
+
+def environment(listeners, bgn_prd: datetime.datetime):
+    dre = DataReplayEvents(listeners, DataReplay().add_source(bars(bgn_prd), 'bars', historical_depth=historical_depth), 'data')
+
+    def strategy(e):
+        if e['type'] == 'data':
+            if len(e['bars']) != (historical_depth + 1) * 2:
+                raise Exception("Incomplete historical window")
+
+            if e['timestamp'].minute % 30 == 0:
+                listeners({'type': 'order_request', 'data': MarketOrder(Type.BUY if e['timestamp'].hour < 12 else Type.SELL, 'AAPL', 1)})
+
+    listeners += strategy
+
+    MockBroker(listeners=listeners, accept_bars=lambda e: e['bars'] if e['type'] == 'data' else None)
+    pm = PortfolioManager(listeners=listeners, initial_capital=100000)
+
+    return dre, pm
+
+
+def buy_and_hold_environment(listeners, bgn_prd: datetime.datetime):
+    dre = DataReplayEvents(listeners, DataReplay().add_source(bars(bgn_prd), 'bars', historical_depth=historical_depth), 'data')
+
+    def strategy(e):
+        if e['type'] == 'data' and e['timestamp'].hour == 23 and e['timestamp'].minute == 0:
+            listeners({'type': 'order_request', 'data': MarketOrder(Type.BUY, 'AAPL', 1)})
+
+    listeners += strategy
+
+    MockBroker(listeners=listeners, accept_bars=lambda e: e['bars'] if e['type'] == 'data' else None)
+    pm = PortfolioManager(listeners=listeners, initial_capital=100000)
+
+    return dre, pm
+
+
+class TestWalkForward(unittest.TestCase):
+
+    def test_time_shards(self):
+        shards = time_shards(datetime.datetime(2017, 1, 1), datetime.datetime(2017, 1, 10), datetime.timedelta(days=4))
+        self.assertEqual(shards, [(datetime.datetime(2017, 1, 1), datetime.datetime(2017, 1, 5)),
+                                  (datetime.datetime(2017, 1, 5), datetime.datetime(2017, 1, 9)),
+                                  (datetime.datetime(2017, 1, 9), datetime.datetime(2017, 1, 10))])
+
+    def test_walk_forward(self):
+        bgn_prd = datetime.datetime(2017, 1, 3, tzinfo=tz.gettz('UTC'))
+        end_prd = datetime.datetime(2017, 1, 10, tzinfo=tz.gettz('UTC'))
+        warm_up = datetime.timedelta(hours=1)
+
+        sequential = run_shard(environment, bgn_prd, end_prd, warm_up)
+
+        results = walk_forward(environment, bgn_prd, end_prd, delta=datetime.timedelta(days=2), warm_up=warm_up, processes=2)
+        self.assertEqual(len(results), 4)
+
+        merged = merge_portfolios(results)
+
+        self.assertEqual(len(sequential.orders), 7 * 48)
+        self.assertEqual(len(merged.orders), len(sequential.orders))
+        self.assertEqual([(o.order_type, o.symbol, o.cost) for o in merged.orders], [(o.order_type, o.symbol, o.cost) for o in sequential.orders])
+        self.assertEqual(merged.quantity(), sequential.quantity())
+        self.assertAlmostEqual(merged.capital, sequential.capital)
+
+        self.assertRaises(Exception, run_shard, environment, bgn_prd, end_prd, datetime.timedelta(minutes=5))
+
+    def test_walk_forward_not_flat(self):
+        bgn_prd = datetime.datetime(2017, 1, 3, tzinfo=tz.gettz('UTC'))
+        end_prd = datetime.datetime(2017, 1, 7, tzinfo=tz.gettz('UTC'))
+        warm_up = datetime.timedelta(hours=1)
+
+        # positions are carried over the shard boundaries
+        self.assertRaises(Exception, walk_forward, buy_and_hold_environment, bgn_prd, end_prd, datetime.timedelta(days=2), warm_up, 2)
+
+        # the last shard doesn't have to be flat
+        run_shard(buy_and_hold_environment, bgn_prd, end_prd, warm_up, require_flat=False)
+        self.assertRaises(Exception, run_shard, buy_and_hold_environment, bgn_prd, end_prd, warm_up, True)
+
+        results = [run_shard(buy_and_hold_environment, bgn, end, warm_up) for bgn, end in time_shards(bgn_prd, end_prd, datetime.timedelta(days=2))]
+        self.assertRaises(Exception, merge_portfolios, results)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import datetime
+import logging
+import unittest
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+
+from atpy.backtesting.data_replay import DataReplay
+from atpy.data.indicators import RollingIndicator
+from atpy.data.ts_util import rolling_mean
+
+
+class TestIndicators(unittest.TestCase):
+
+    @staticmethod
+    def __bars(periods: int, symbols: list):
+        timestamps = pd.date_range('2017-01-01', periods=periods, freq='min', tz='UTC', name='timestamp')
+        index = pd.MultiIndex.from_product([timestamps, symbols], names=['timestamp', 'symbol'])
+
+        return pd.DataFrame({'close': 100 + np.random.randn(len(index)).cumsum()}, index=index)
+
+    @staticmethod
+    def __chunks(df: pd.DataFrame, size: int):
+        timestamps = df.index.levels[0]
+
+        for i in range(0, len(timestamps), size):
+            chunk = df.loc[timestamps[i]:timestamps[min(i + size, len(timestamps)) - 1]]
+            yield chunk.set_index(chunk.index.remove_unused_levels())
+
+    def test_rolling_indicators(self):
+        df = self.__bars(1000, ['AAPL', 'IBM', 'GOOG'])
+        df = df.drop(df.sample(frac=0.1).index)
+        df.iloc[100, 0] = np.nan
+
+        grouped = df['close'].groupby(level='symbol')
+
+        expected = dict()
+        for w in [1, 5, 20]:
+            expected[('mean', w)] = grouped.transform(lambda x: x.rolling(w).mean())
+            expected[('std', w)] = grouped.transform(lambda x: x.rolling(w).std())
+            expected[('min', w)] = grouped.transform(lambda x: x.rolling(w).min())
+            expected[('max', w)] = grouped.transform(lambda x: x.rolling(w).max())
+            expected[('ewma', w)] = grouped.transform(lambda x: x.ewm(span=w).mean())
+
+        indicators = {k: RollingIndicator(*k) for k in expected}
+
+        for r in DataReplay().add_source(self.__chunks(df, 150), 'bars', historical_depth=30):
+            for k, indicator in indicators.items():
+                assert_allclose(indicator(r['bars'], 'close'), expected[k].reindex(r['bars'].index).values, rtol=1e-9, atol=1e-9, err_msg=str(k))
+
+        # single symbol
+        df = df.xs('AAPL', level='symbol')
+        indicator = RollingIndicator('std', 10)
+
+        for i in range(len(df)):
+            result = indicator(df.iloc[max(0, i - 5):i + 1])
+
+        assert_allclose(result, df['close'].rolling(10).std().iloc[-6:].values, rtol=1e-9)
+
+        self.assertRaises(Exception, RollingIndicator, 'median', 10)
+
+    def test_rolling_indicators_frame_warm_up(self):
+        df = self.__bars(500, ['AAPL', 'IBM', 'GOOG'])
+        df = df.drop(df.sample(frac=0.1).index)
+
+        indicators = {k: RollingIndicator(k, 10) for k in ['mean', 'min', 'max']}
+
+        for r in DataReplay().add_source(self.__chunks(df, 100), 'bars', historical_depth=30):
+            bars = r['bars']
+            grouped = bars['close'].groupby(level='symbol', group_keys=False)
+
+            expected = {'mean': rolling_mean(bars, 10, 'close').droplevel(0).reindex(bars.index),
+                        'min': grouped.rolling(10).min().droplevel(0).reindex(bars.index),
+                        'max': grouped.rolling(10).max().droplevel(0).reindex(bars.index)}
+
+            for k, indicator in indicators.items():
+                assert_allclose(indicator(bars, 'close', full_history=False), expected[k].values, rtol=1e-9, atol=1e-9, err_msg=k)
+
+    def test_rolling_indicators_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        df = self.__bars(400, ['SYMBOL_' + str(i) for i in range(500)])
+        windows = [r['bars'] for r in DataReplay().add_source([df], 'bars', historical_depth=300)][300:]
+
+        now = datetime.datetime.now()
+        for w in windows:
+            expected = w['close'].groupby(level='symbol', group_keys=False).rolling(20).mean()
+
+        recompute_time = datetime.datetime.now() - now
+
+        indicator = RollingIndicator('mean', 20)
+        indicator(windows[0], 'close', full_history=False)
+
+        now = datetime.datetime.now()
+        for w in windows[1:]:
+            result = indicator(w, 'close', full_history=False)
+
+        incremental_time = datetime.datetime.now() - now
+
+        logging.getLogger(__name__).debug('Recompute time: ' + str(recompute_time) + '; incremental time: ' + str(incremental_time) + ' for ' + str(len(windows)) + ' steps')
+
+        assert_allclose(result, expected.droplevel(0).reindex(windows[-1].index).values, rtol=1e-9, atol=1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
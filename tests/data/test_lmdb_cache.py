@@ -0,0 +1,156 @@
+import logging
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+import numpy as np
+import pandas as pd
+from pandas.util.testing import assert_frame_equal
+
+import atpy.data.cache.lmdb_cache as lmdb_cache
+
+
+class TestLmdbCache(unittest.TestCase):
+
+    @staticmethod
+    def __bars(n: int):
+        timestamps = pd.date_range('2017-01-01', periods=n // 4, freq='min', tz='UTC', name='timestamp')
+        index = pd.MultiIndex.from_product([timestamps, ['AAPL', 'IBM', 'GOOG', 'MSFT']], names=['timestamp', 'symbol'])
+
+        return pd.DataFrame({'open': np.random.rand(len(index)),
+                             'high': np.random.rand(len(index)),
+                             'low': np.random.rand(len(index)),
+                             'close': np.random.rand(len(index)),
+                             'period_volume': np.random.randint(0, 100000, len(index)).astype(np.uint64),
+                             'symbol_copy': index.get_level_values('symbol').values}, index=index)
+
+    def test_columnar(self):
+        df = self.__bars(10000)
+        df['category'] = pd.Categorical(np.random.choice(['a', 'b', None], len(df)))
+        df['eastern'] = df.index.get_level_values('timestamp').tz_convert('US/Eastern')
+
+        for codec in [None, 'zlib', lmdb_cache.default_codec]:
+            assert_frame_equal(lmdb_cache.from_columnar(lmdb_cache.to_columnar(df, codec=codec)), df)
+
+        assert_frame_equal(lmdb_cache.from_columnar(lmdb_cache.to_columnar(df['close'])).to_frame(), df['close'].to_frame())
+
+    def test_read_write(self):
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            df = self.__bars(10000)
+
+            lmdb_cache.write('compressed', df, tmpdir)
+            lmdb_cache.write('uncompressed', df, tmpdir, compress=False)
+            lmdb_cache.write('other', {'a': 1}, tmpdir)
+
+            result = lmdb_cache.read_pickle('compressed', tmpdir)
+            assert_frame_equal(result, df)
+
+            result['close'] += 1
+            assert_frame_equal(lmdb_cache.read('uncompressed', tmpdir), df)
+
+            with lmdb_cache.read_view('uncompressed', tmpdir) as result:
+                assert_frame_equal(result, df)
+                self.assertFalse(result['close'].values.flags.writeable)
+
+            self.assertEqual(lmdb_cache.read('other', tmpdir), {'a': 1})
+            self.assertIsNone(lmdb_cache.read('missing', tmpdir))
+
+            # previous format
+            with lmdb_cache.environment(tmpdir).begin(write=True) as txn:
+                txn.put('pickle'.encode(), zlib.compress(pickle.dumps(df)))
+
+            assert_frame_equal(lmdb_cache.read_pickle('pickle', tmpdir), df)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_batch(self):
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            data = {str(i): self.__bars(1000) for i in range(10)}
+
+            lmdb_cache.write_many(data, tmpdir)
+
+            result = lmdb_cache.read_many(list(data.keys()) + ['missing'], tmpdir)
+            self.assertIsNone(result['missing'])
+            for k, v in data.items():
+                assert_frame_equal(result[k], v)
+
+            with lmdb_cache.BatchWriter(tmpdir, max_batch_bytes=100000) as writer:
+                for k, v in data.items():
+                    writer.write('batch_' + k, v)
+
+                self.assertLess(len(writer._batch), len(data))
+
+            for k, v in data.items():
+                assert_frame_equal(lmdb_cache.read('batch_' + k, tmpdir), v)
+
+            # the completed writes are committed, even if an exception is raised
+            def write_and_fail():
+                with lmdb_cache.BatchWriter(tmpdir) as w:
+                    w.write('failed_batch_1', data['0'])
+                    w.write('failed_batch_2', data['1'])
+                    raise ValueError()
+
+            self.assertRaises(ValueError, write_and_fail)
+            assert_frame_equal(lmdb_cache.read('failed_batch_1', tmpdir), data['0'])
+            assert_frame_equal(lmdb_cache.read('failed_batch_2', tmpdir), data['1'])
+
+            self.assertTrue(lmdb_cache.environment(tmpdir) is lmdb_cache.environment(tmpdir))
+
+            # concurrent readers
+            errors = list()
+
+            def read():
+                try:
+                    for k, v in data.items():
+                        with lmdb_cache.read_view(k, tmpdir) as df:
+                            assert_frame_equal(df, v)
+                except Exception as err:
+                    errors.append(err)
+
+            threads = [threading.Thread(target=read) for _ in range(20)]
+            for t in threads:
+                t.start()
+
+            for t in threads:
+                t.join()
+
+            self.assertEqual(len(errors), 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_performance(self):
+        tmpdir = tempfile.mkdtemp()
+
+        try:
+            df = self.__bars(1000000)
+
+            lmdb_cache.write('columnar', df, tmpdir)
+
+            with lmdb_cache.environment(tmpdir).begin(write=True) as txn:
+                txn.put('pickle'.encode(), zlib.compress(pickle.dumps(df)))
+
+            now = time.time()
+            lmdb_cache.read('pickle', tmpdir)
+            pickle_time = time.time() - now
+
+            now = time.time()
+            result = lmdb_cache.read('columnar', tmpdir)
+            columnar_time = time.time() - now
+
+            logging.getLogger(__name__).debug('Pickle read time: ' + str(pickle_time) + '; columnar read time: ' + str(columnar_time))
+
+            assert_frame_equal(result, df)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
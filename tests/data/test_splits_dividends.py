@@ -4,13 +4,14 @@ import random
 import threading
 import unittest
 
+import numpy as np
 import pandas as pd
 
 import pyiqfeed as iq
 from atpy.data.iqfeed.filters import DefaultFilterProvider
 from atpy.data.iqfeed.iqfeed_history_provider import BarsInPeriodFilter, IQFeedHistoryEvents, IQFeedHistoryProvider, BarsFilter
 from atpy.data.iqfeed.iqfeed_level_1_provider import get_splits_dividends
-from atpy.data.splits_dividends import exclude_splits
+from atpy.data.splits_dividends import exclude_splits, adjustment_factors, adjust_df, adjust_split_multiindex, adjust_dividend_multiindex
 from pyevents.events import AsyncListeners
 
 
@@ -156,3 +157,97 @@ class TestSplitsDividends(unittest.TestCase):
 
             self.assertTrue(result[~result].size > 10)
             self.assertTrue(result[result].size > 0)
+
+    def test_adjustment_factors(self):
+        adjustments = pd.DataFrame({'value': [0.5, 0.2, 0.25, 0.3, 0.1, 0.5],
+                                    'timestamp': pd.to_datetime(['2017-01-05', '2017-01-05', '2017-02-01', '2017-03-01', '2017-01-10', '2017-02-10']).tz_localize('UTC'),
+                                    'symbol': ['AAPL', 'AAPL', 'AAPL', 'AAPL', 'IBM', 'IBM'],
+                                    'type': ['split', 'dividend', 'split', 'dividend', 'dividend', 'split'],
+                                    'provider': 'iqfeed'}).set_index(['timestamp', 'symbol', 'type', 'provider'])
+
+        factors = adjustment_factors(adjustments)
+
+        for symbol in ['AAPL', 'IBM']:
+            symbol_factors = factors.xs(symbol, level='symbol')
+
+            for t in pd.date_range('2017-01-01', '2017-03-05', freq='D', tz='UTC'):
+                # sequential application of the later adjustments from the latest to the earliest
+                price, volume = 100.0, 1000.0
+                for (ts, s, tp, _), row in adjustments.sort_index(ascending=False).iterrows():
+                    if s == symbol and ts >= t:
+                        if tp == 'split':
+                            price *= row['value']
+                            volume *= 1 / row['value']
+                        else:
+                            price -= row['value']
+
+                i = symbol_factors.index.searchsorted(t)
+                if i < len(symbol_factors):
+                    f = symbol_factors.iloc[i]
+                    self.assertAlmostEqual(100 * f['price_factor'] + f['price_offset'], price)
+                    self.assertAlmostEqual(1000 * f['volume_factor'], volume)
+                else:
+                    self.assertEqual((price, volume), (100, 1000))
+
+    @staticmethod
+    def __adjust_data(symbols: int, days: int, seed: int = 0):
+        rs = np.random.RandomState(seed)
+
+        timestamps = pd.date_range('2015-01-01 15:00', periods=days, freq='D', tz='UTC', name='timestamp')
+        index = pd.MultiIndex.from_product([timestamps, ['SYMBOL_' + str(i) for i in range(symbols)]], names=['timestamp', 'symbol'])
+
+        data = pd.DataFrame({'open': rs.uniform(10, 100, len(index)), 'close': rs.uniform(10, 100, len(index)),
+                             'period_volume': rs.randint(1, 10000, len(index)).astype(np.uint64)}, index=index)
+        data = data.drop(data.sample(frac=0.2, random_state=rs).index)
+
+        adjustments = list()
+        for s in index.levels[1]:
+            for d in rs.choice(days + 60, 5, replace=False):
+                split = rs.rand() < 0.3
+                adjustments.append((pd.Timestamp('2014-12-01', tz='UTC') + pd.Timedelta(days=int(d)), s, 'split' if split else 'dividend', 'iqfeed',
+                                    rs.choice([0.5, 1 / 3, 2.0]) if split else rs.uniform(0.01, 2)))
+
+        adjustments = pd.DataFrame(adjustments, columns=['timestamp', 'symbol', 'type', 'provider', 'value']).set_index(['timestamp', 'symbol', 'type', 'provider']).sort_index()
+
+        return data, adjustments
+
+    @staticmethod
+    def __adjust_sequential(data: pd.DataFrame, adjustments: pd.DataFrame):
+        for (ts, symbol, tp, _), row in adjustments.sort_index(ascending=False).iterrows():
+            if tp == 'split':
+                adjust_split_multiindex(data=data, symbol=symbol, split_factor=row['value'], split_date=ts)
+            elif tp == 'dividend':
+                adjust_dividend_multiindex(data=data, symbol=symbol, dividend_amount=row['value'], dividend_date=ts)
+
+        return data
+
+    def test_adjust_df(self):
+        data, adjustments = self.__adjust_data(symbols=10, days=200)
+
+        expected = self.__adjust_sequential(data.copy(), adjustments)
+        result = adjust_df(data.copy(), adjustments)
+
+        self.assertFalse(expected.equals(data))
+        np.testing.assert_allclose(result[['open', 'close']].values, expected[['open', 'close']].values, rtol=1e-12)
+
+        # the volumes keep their dtype
+        self.assertEqual(result['period_volume'].dtype, np.uint64)
+        pd.testing.assert_frame_equal(result, expected.astype(data.dtypes.to_dict()), check_exact=False, rtol=1e-12)
+
+    def test_adjust_df_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        data, adjustments = self.__adjust_data(symbols=100, days=500)
+
+        now = datetime.datetime.now()
+        expected = self.__adjust_sequential(data.copy(), adjustments)
+        sequential_time = datetime.datetime.now() - now
+
+        now = datetime.datetime.now()
+        result = adjust_df(data.copy(), adjustments)
+        factors_time = datetime.datetime.now() - now
+
+        logging.getLogger(__name__).debug('Adjustment of ' + str(data.shape) + ' with ' + str(len(adjustments)) + ' adjustments. Sequential: ' + str(sequential_time) + '; cumulative factors: ' + str(factors_time))
+
+        np.testing.assert_allclose(result[['open', 'close']].values, expected[['open', 'close']].values, rtol=1e-12)
+        np.testing.assert_array_equal(result['period_volume'].values, expected['period_volume'].values)
@@ -1,9 +1,11 @@
 import threading
 import unittest
+import unittest.mock
 
 from atpy.data.iqfeed.iqfeed_bar_data_provider import *
 from atpy.data.latest_data_snapshot import LatestDataSnapshot
-from pyevents.events import AsyncListeners
+from atpy.data.splits_dividends import adjust_df
+from pyevents.events import AsyncListeners, SyncListeners
 
 
 class TestIQFeedBarData(unittest.TestCase):
@@ -11,6 +13,52 @@ class TestIQFeedBarData(unittest.TestCase):
     IQFeed bar data test, which checks whether the class works in basic terms
     """
 
+    def test_adjust(self):
+        timestamps = pd.date_range('2017-01-01', '2017-01-10', freq='H', tz='UTC', name='timestamp')
+        index = pd.MultiIndex.from_product([timestamps, ['AAPL']], names=['timestamp', 'symbol'])
+        rs = np.random.RandomState(1)
+        close = rs.uniform(10, 20, len(index))
+        bars = pd.DataFrame({'open': close, 'high': close + 1, 'low': close - 1, 'close': close,
+                             'total_volume': rs.randint(1, 10000, len(index)).astype(np.uint64), 'period_volume': rs.randint(1, 1000, len(index)).astype(np.uint64)}, index=index)
+
+        # the same format as get_splits_dividends. The adjustment days start at 05:00 UTC
+        adjustments = pd.DataFrame({'value': [0.5, 0.2]}, index=pd.MultiIndex.from_tuples([(pd.Timestamp('2017-01-04'), 'AAPL', 'split', 'iqfeed'), (pd.Timestamp('2017-01-07'), 'AAPL', 'dividend', 'iqfeed')],
+                                                                                           names=['timestamp', 'symbol', 'type', 'provider']))
+        adjustments = adjustments.tz_localize('US/Eastern', level=0).tz_convert('UTC', level=0)
+
+        listener = IQFeedBarDataListener(listeners=SyncListeners(), interval_len=3600)
+        listener._cache_adjustments(['AAPL'], adjustments, datetime.datetime.now())
+
+        streamed = list()
+        for i in range(len(bars)):
+            bar = bars.iloc[[i]].copy()
+            listener._adjust(bar)
+            streamed.append(bar)
+
+        # the bars streamed one by one are adjusted in the same way as the whole period with adjust_df
+        pd.testing.assert_frame_equal(pd.concat(streamed), adjust_df(bars.copy(), adjustments))
+
+    def test_adjust_no_adjustments(self):
+        index = pd.MultiIndex.from_product([pd.date_range('2017-01-01', periods=10, freq='H', tz='UTC', name='timestamp'), ['AAPL']], names=['timestamp', 'symbol'])
+        bars = pd.DataFrame({'close': np.random.uniform(10, 20, len(index)), 'period_volume': np.random.randint(1, 1000, len(index)).astype(np.uint64)}, index=index)
+
+        listener = IQFeedBarDataListener(listeners=SyncListeners(), interval_len=3600)
+
+        # none of the symbols has splits or dividends
+        with unittest.mock.patch('atpy.data.iqfeed.iqfeed_level_1_provider.get_fundamentals', return_value={}):
+            adjustments = get_splits_dividends({'AAPL', 'IBM'})
+            listener._load_adjustments(['AAPL', 'IBM'])
+
+        self.assertEqual(len(adjustments), 0)
+        self.assertEqual(list(adjustments.index.names), ['timestamp', 'symbol', 'type', 'provider'])
+        self.assertEqual(listener._adjustments['AAPL'][1], None)
+        self.assertEqual(listener._adjustments['IBM'][1], None)
+
+        for i in range(len(bars)):
+            bar = bars.iloc[[i]].copy()
+            listener._adjust(bar)
+            pd.testing.assert_frame_equal(bar, bars.iloc[[i]])
+
     def test_provider(self):
         listeners = AsyncListeners()
 
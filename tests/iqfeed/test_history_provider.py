@@ -1,5 +1,10 @@
+import random
 import unittest
 
+import numpy as np
+from pandas.util.testing import assert_frame_equal
+
+from atpy.data.iqfeed.bar_util import synchronize_timestamps, synchronize_dense
 from atpy.data.iqfeed.iqfeed_history_provider import *
 from pyevents.events import AsyncListeners
 
@@ -373,5 +378,209 @@ class TestIQFeedHistory(unittest.TestCase):
             self.assertEqual(requested_data.loc['AAPL'].shape, requested_data.loc['IBM'].shape)
 
 
+    def test_bars_chunks(self):
+        with IQFeedHistoryProvider(num_connections=2) as history:
+            tickers = ["AAPL", "IBM", "MSFT", "GOOG", "SPY"]
+            f = BarsInPeriodFilter(ticker=tickers, bgn_prd=datetime.datetime(2017, 4, 1), end_prd=datetime.datetime(2017, 5, 1), interval_len=3600, ascend=True, interval_type='s')
+
+            symbols = list()
+            for chunk in history.request_data_chunks(f, symbols_per_chunk=2, max_memory=2 ** 10):
+                chunk_symbols = list(chunk.index.get_level_values('symbol').unique())
+                self.assertLessEqual(len(chunk_symbols), 2)
+                self.assertEqual(chunk.shape[1], 9)
+                symbols += chunk_symbols
+
+            self.assertEqual(set(symbols), set(tickers))
+            self.assertEqual(len(symbols), len(tickers))
+
+    def test_requests_scheduling(self):
+        filters = [BarsInPeriodFilter(ticker="IBM", bgn_prd=datetime.datetime(2017, 4, 1), end_prd=datetime.datetime(2017, 5, 1), interval_len=3600, ascend=True, interval_type='s'),
+                   BarsInPeriodFilter(ticker="AAPL", bgn_prd=datetime.datetime(2017, 4, 1), end_prd=datetime.datetime(2017, 5, 1), interval_len=60, ascend=True, interval_type='s'),
+                   BarsFilter(ticker="MSFT", interval_len=60, interval_type='s', max_bars=20),
+                   BarsInPeriodFilter(ticker="GOOG", bgn_prd=datetime.datetime(2017, 4, 1), end_prd=None, interval_len=60, ascend=True, interval_type='s')]
+
+        filters.sort(key=IQFeedHistoryProvider._estimate_size, reverse=True)
+        self.assertEqual([f.ticker for f in filters], ["GOOG", "AAPL", "IBM", "MSFT"])
+
+        with IQFeedHistoryProvider(num_connections=2) as history:
+            q = queue.Queue()
+            history.request_data_by_filters(filters, q)
+
+            self.assertEqual({ft.ticker for ft, _ in iter(q.get, None)}, {f.ticker for f in filters})
+
+    def test_request_retry(self):
+        provider = IQFeedHistoryProvider(num_connections=2, retry_delay=0)
+        provider.conn_pool = HistoryConnPool(2)
+        provider.conn_pool._new_connection = lambda: object()
+        provider.conn_pool.connect()
+
+        calls = {'count': 0}
+
+        def transport_error(f, conn):
+            calls['count'] += 1
+            if calls['count'] < 3:
+                raise ConnectionResetError()
+
+            return 'data'
+
+        provider.request_raw_symbol_data = transport_error
+        self.assertEqual(provider._request_raw_symbol_data_retry(None), 'data')
+        self.assertEqual(calls['count'], 3)
+
+        # the failed connections are dropped and replaced on demand
+        self.assertEqual(provider.conn_pool._idle.qsize(), 1)
+
+        def other_error(f, conn):
+            calls['count'] += 1
+            raise KeyError()
+
+        calls['count'] = 0
+        provider.request_raw_symbol_data = other_error
+        self.assertRaises(KeyError, provider._request_raw_symbol_data_retry, None)
+        self.assertEqual(calls['count'], 1)
+        self.assertEqual(provider.conn_pool._idle.qsize(), 1)
+
+    def test_process_bars_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        batch_len = 1000000
+
+        data = np.empty((batch_len,), dtype=[('date', 'M8[D]'), ('time', 'm8[us]'), ('open_p', 'f8'), ('high_p', 'f8'), ('low_p', 'f8'), ('close_p', 'f8'), ('tot_vlm', 'u8'), ('prd_vlm', 'u8'), ('num_trds', 'u8')])
+        data['date'] = np.datetime64('2016-01-01') + np.sort(np.random.randint(0, 2 * 365, batch_len)).astype('m8[D]')
+        data['time'] = (np.random.randint(4 * 3600, 20 * 3600, batch_len) * 10 ** 6).astype('m8[us]')
+        for c in ['open_p', 'high_p', 'low_p', 'close_p']:
+            data[c] = np.random.rand(batch_len)
+        for c in ['tot_vlm', 'prd_vlm', 'num_trds']:
+            data[c] = np.random.randint(0, 1000, batch_len)
+
+        f = BarsFilter(ticker="IBM", interval_len=60, interval_type='s', max_bars=batch_len)
+
+        now = datetime.datetime.now()
+
+        expected = pd.DataFrame(data)
+        expected['timestamp'] = pd.Index(data['date'] + data['time']).tz_localize('US/Eastern').tz_convert('UTC')
+        expected.set_index('timestamp', inplace=True, drop=False)
+        expected.drop(['date', 'time'], axis=1, inplace=True)
+        expected.rename({"high_p": "high", "low_p": "low", "open_p": "open", "close_p": "close", "tot_vlm": "total_volume", "prd_vlm": "period_volume", "num_trds": "number_of_trades"}, axis="columns", copy=False, inplace=True)
+        expected['symbol'] = f.ticker
+
+        old_elapsed = datetime.datetime.now() - now
+
+        now = datetime.datetime.now()
+        result = IQFeedHistoryProvider()._process_bars(data, f)
+        new_elapsed = datetime.datetime.now() - now
+
+        logging.getLogger(__name__).debug('Bars processed in ' + str(new_elapsed) + ' vs ' + str(old_elapsed) + ' with shape ' + str(result.shape))
+
+        self.assertEqual(result['symbol'].dtype, object)
+        assert_frame_equal(expected, result)
+
+    def test_synchronize_timestamps_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        batch_len = 2000
+        batch_width = 1000
+
+        timestamps = pd.date_range(start=datetime.datetime(2017, 4, 3, 13, 30), periods=batch_len, freq='1min', tz='UTC', name='timestamp')
+
+        signals = dict()
+        for i in range(batch_width):
+            symbol = 'SYM_' + str(i)
+            ind = timestamps[np.sort(random.sample(range(batch_len), random.randint(int(batch_len / 3), batch_len - 1)))]
+            df = pd.DataFrame({'high': np.random.rand(len(ind)) + 10, 'low': np.random.rand(len(ind)) + 9, 'open': np.random.rand(len(ind)) + 9.5, 'close': np.random.rand(len(ind)) + 9.5,
+                               'total_volume': np.random.randint(1, 10 ** 6, len(ind)).astype(np.uint64), 'period_volume': np.random.randint(1, 1000, len(ind)).astype(np.uint64),
+                               'number_of_trades': np.random.randint(1, 100, len(ind)).astype(np.uint64), 'timestamp': ind, 'symbol': symbol}, index=ind)
+
+            signals[symbol] = df
+
+        now = datetime.datetime.now()
+        expected = synchronize_timestamps(pd.concat(signals))
+        old_elapsed = datetime.datetime.now() - now
+
+        now = datetime.datetime.now()
+        result = IQFeedHistoryProvider().synchronize_timestamps(signals, BarsInPeriodFilter(ticker=list(signals.keys()), bgn_prd=None, end_prd=None, interval_len=60, interval_type='s'))
+        new_elapsed = datetime.datetime.now() - now
+
+        logging.getLogger(__name__).debug('Timestamps synchronized in ' + str(new_elapsed) + ' vs ' + str(old_elapsed) + ' with shape ' + str(result.shape))
+
+        assert_frame_equal(expected, result)
+        self.assertFalse(result.isnull().values.any())
+
+    @staticmethod
+    def __synchronize_seeded_reference(signals: dict, last: pd.DataFrame):
+        """
+        The previous IQFeedHistoryProvider.synchronize_timestamps with the last values of the previous batch
+        """
+        signals = pd.concat(signals)
+        signals.index.set_names('symbol', level=0, inplace=True)
+
+        multi_index = pd.MultiIndex.from_product([signals['symbol'].unique(), signals['timestamp'].unique()], names=['symbol', 'timestamp']).sort_values()
+
+        signals = signals.reindex(multi_index)
+        signals.drop(['symbol', 'timestamp'], axis=1, inplace=True)
+        signals.reset_index(inplace=True)
+        signals.set_index(multi_index, inplace=True)
+
+        for c in ['period_volume', 'number_of_trades']:
+            signals[c].fillna(0, inplace=True)
+
+        signals['close'] = signals.groupby(level=0)['close'].fillna(method='ffill')
+        signals['close'] = signals.groupby(level=0)['close'].apply(lambda x: x.fillna(last['close'][last.index.get_loc(x.name)]))
+        signals['close'] = signals.groupby(level=0)['close'].fillna(method='backfill')
+
+        for c in ['open', 'high', 'low']:
+            signals[c].fillna(signals['close'], inplace=True)
+
+        signals = signals.groupby(level=0).fillna(method='ffill')
+        signals = signals.groupby(level=0).apply(lambda x: x.fillna(last.iloc[last.index.get_loc(x.name)]))
+        signals = signals.groupby(level=0).fillna(method='backfill')
+
+        return signals
+
+    def test_synchronize_dense_last(self):
+        timestamps = pd.date_range(start=datetime.datetime(2017, 4, 3, 13, 30), periods=20, freq='1min', tz='UTC', name='timestamp')
+        rs = np.random.RandomState(0)
+
+        def batch(timestamps, gaps: bool):
+            signals = dict()
+            for i in range(5):
+                symbol = 'SYM_' + str(i)
+
+                # the symbols start later and have gaps
+                ind = timestamps[i * 2:]
+                if gaps:
+                    ind = ind[rs.rand(len(ind)) > 0.3]
+
+                signals[symbol] = pd.DataFrame({'high': rs.rand(len(ind)) + 10, 'low': rs.rand(len(ind)) + 9, 'open': rs.rand(len(ind)) + 9.5, 'close': rs.rand(len(ind)) + 9.5,
+                                                'total_volume': rs.randint(1, 10 ** 6, len(ind)).astype(np.uint64), 'period_volume': rs.randint(1, 1000, len(ind)).astype(np.uint64),
+                                                'number_of_trades': rs.randint(1, 100, len(ind)).astype(np.uint64), 'timestamp': ind, 'symbol': symbol}, index=ind)
+
+            return signals
+
+        f = BarsInPeriodFilter(ticker=['SYM_' + str(i) for i in range(5)], bgn_prd=None, end_prd=None, interval_len=60, interval_type='s')
+
+        provider = IQFeedHistoryProvider()
+        provider.current_filter = f
+        provider.current_batch = provider.synchronize_timestamps(batch(timestamps[:10], gaps=False), f)
+        last = provider.current_batch.groupby(level=0).last()
+
+        signals = batch(timestamps[10:], gaps=True)
+        expected = self.__synchronize_seeded_reference(signals, last)
+
+        # the leading missing values are taken from the previous batch, not backfilled
+        assert_frame_equal(expected, synchronize_dense(signals, last=last))
+        assert_frame_equal(expected, provider.synchronize_timestamps(signals, f))
+
+    def test_synchronize_dense_empty(self):
+        columns = ['high', 'low', 'open', 'close', 'period_volume', 'timestamp', 'symbol']
+        signals = {s: pd.DataFrame({c: [] for c in columns}, columns=columns) for s in ['AAPL', 'IBM']}
+
+        result = synchronize_dense(signals)
+
+        self.assertTrue(result.empty)
+        self.assertEqual(list(result.index.names), ['symbol', 'timestamp'])
+        self.assertEqual(list(result.columns), ['symbol', 'timestamp', 'high', 'low', 'open', 'close', 'period_volume'])
+
+
 if __name__ == '__main__':
     unittest.main()
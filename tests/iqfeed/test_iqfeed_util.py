@@ -0,0 +1,113 @@
+import datetime
+import logging
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from atpy.data.iqfeed.util import iqfeed_to_dict, create_batch
+
+update_dtype = np.dtype([('Symbol', 'S128'), ('Most Recent Trade', 'f8'), ('Most Recent Trade Size', 'u8'), ('Most Recent Trade Time', 'm8[us]'),
+                         ('Most Recent Trade Market Center', 'u1'), ('Total Volume', 'u8'), ('Bid', 'f8'), ('Bid Size', 'u8'), ('Ask', 'f8'), ('Ask Size', 'u8'),
+                         ('Open', 'f8'), ('High', 'f8'), ('Low', 'f8'), ('Close', 'f8'), ('Message Contents', 'S9'), ('Most Recent Trade Date', 'M8[D]')])
+
+
+def reference_iqfeed_to_dict(data, key_suffix=''):
+    """
+    Field by field conversion
+    """
+    data = data[0] if len(data) == 1 else data
+
+    result = {n.replace(" ", "_").lower() + key_suffix: d for n, d in zip(data.dtype.names, data)}
+
+    for k, v in result.items():
+        if isinstance(v, bytes):
+            result[k] = v.decode('ascii')
+        elif isinstance(v, np.datetime64):
+            result[k] = v.astype(datetime.datetime)
+        elif pd.isnull(v):
+            result[k] = None
+
+    return result
+
+
+def updates(n: int):
+    data = np.zeros((n,), dtype=update_dtype)
+    data['Symbol'] = [('SYMBOL_' + str(i % 500)).encode('ascii') for i in range(n)]
+    data['Most Recent Trade'] = np.random.uniform(10, 20, n)
+    data['Most Recent Trade Size'] = np.random.randint(1, 1000, n)
+    data['Most Recent Trade Time'] = np.random.randint(0, 86400 * 10 ** 6, n).astype('m8[us]')
+    data['Bid'] = np.random.uniform(10, 20, n)
+    data['Message Contents'] = b'Cbavo'
+    data['Most Recent Trade Date'] = np.datetime64('2017-01-03')
+
+    data['Bid'][::3] = np.nan
+    data['Most Recent Trade Time'][::5] = np.timedelta64('NaT')
+
+    return data
+
+
+class TestIQFeedUtil(unittest.TestCase):
+
+    def test_iqfeed_to_dict(self):
+        for item in updates(100):
+            for key_suffix in ['', '_1']:
+                expected = reference_iqfeed_to_dict(np.array([item]), key_suffix)
+                result = iqfeed_to_dict(np.array([item]), key_suffix)
+
+                self.assertEqual(list(result.keys()), list(expected.keys()))
+                self.assertEqual(result, expected)
+                self.assertTrue(all([type(v) in (str, int, float, datetime.date, datetime.timedelta, type(None)) for v in result.values()]))
+
+    def test_iqfeed_to_dict_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        data = [np.array([item]) for item in updates(50000)]
+
+        now = datetime.datetime.now()
+        for d in data:
+            reference_iqfeed_to_dict(d)
+
+        reference_time = datetime.datetime.now() - now
+
+        now = datetime.datetime.now()
+        for d in data:
+            iqfeed_to_dict(d)
+
+        compiled_time = datetime.datetime.now() - now
+
+        logging.getLogger(__name__).debug('iqfeed_to_dict of ' + str(len(data)) + ' updates. Field by field: ' + str(reference_time) + '; precomputed fields: ' + str(compiled_time))
+
+    def test_create_batch(self):
+        data = updates(1000)
+
+        batch = pd.DataFrame(create_batch(data))
+
+        self.assertEqual(batch.shape, (1000, 16))
+        self.assertEqual(list(batch.columns), list(reference_iqfeed_to_dict(data[:1]).keys()))
+        self.assertEqual(batch['symbol'].iloc[501], 'SYMBOL_1')
+        self.assertEqual(batch['message_contents'].iloc[0], 'Cbavo')
+        np.testing.assert_array_equal(batch['bid'].values, data['Bid'])
+
+        # the batch doesn't share memory with the data
+        data['Bid'] = 0
+        self.assertFalse((batch['bid'] == 0).any())
+
+    def test_create_batch_performance(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        data = updates(100000)
+
+        now = datetime.datetime.now()
+        pd.DataFrame([reference_iqfeed_to_dict(data[i:i + 1]) for i in range(len(data))])
+        reference_time = datetime.datetime.now() - now
+
+        now = datetime.datetime.now()
+        pd.DataFrame(create_batch(data))
+        batch_time = datetime.datetime.now() - now
+
+        logging.getLogger(__name__).debug('Minibatch of ' + str(len(data)) + ' updates. Row by row: ' + str(reference_time) + '; create_batch: ' + str(batch_time))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -158,6 +158,32 @@ class TestIQFeedLevel1(unittest.TestCase):
                 if i == 1:
                     break
 
+    def test_update_minibatch_timeout(self):
+        listeners = AsyncListeners()
+
+        with IQFeedLevel1Listener(minibatch=100000, minibatch_timeout=1, listeners=listeners) as listener:
+            listener.watch('IBM')
+            listener.watch('AAPL')
+            listener.watch('GOOG')
+            listener.watch('MSFT')
+            listener.watch('SPY')
+
+            e = threading.Event()
+
+            def on_update_mb(event):
+                if event['type'] == 'level_1_tick_batch':
+                    try:
+                        update_item = event['data']
+                        self.assertEqual(update_item.shape[1], 16)
+                        self.assertLess(update_item.shape[0], 100000)
+                        self.assertTrue(set(update_item['symbol']) <= {'SPY', 'AAPL', 'IBM', 'GOOG', 'MSFT'})
+                    finally:
+                        e.set()
+
+            listeners += on_update_mb
+
+            self.assertTrue(e.wait(10))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,11 @@
 import unittest
 
+from atpy.backtesting.data_replay import DataReplay, DataReplayEvents
 from atpy.backtesting.mock_broker import MockBroker
 from atpy.data.iqfeed.iqfeed_history_provider import *
 from atpy.data.iqfeed.iqfeed_level_1_provider import *
 from atpy.portfolio.portfolio_manager import *
-from pyevents.events import AsyncListeners
+from pyevents.events import AsyncListeners, SyncListeners
 from pyevents_util.mongodb.mongodb_store import *
 
 
@@ -373,6 +374,105 @@ class TestPortfolioManager(unittest.TestCase):
         self.assertGreater(pm.value('AAPL'), 0)
         self.assertGreater(pm.value('IBM'), 0)
 
+    def test_ledgers(self):
+        logging.basicConfig(level=logging.DEBUG)
+
+        pm = PortfolioManager(listeners=SyncListeners(), initial_capital=1000000)
+
+        symbols = ['SYMBOL_' + str(i) for i in range(50)]
+
+        now = datetime.datetime.now()
+
+        for i in range(20000):
+            symbol = symbols[i % len(symbols)]
+            o = MarketOrder(Type.SELL if i % 3 == 2 and i >= len(symbols) else Type.BUY, symbol, 10)
+            o.add_position(4, 1 + i % 7)
+            o.add_position(6, 2 + i % 5)
+            o.fulfill_time = datetime.datetime(2017, 1, 1) + datetime.timedelta(minutes=i)
+            pm.add_order(o)
+
+            pm.capital
+            pm.quantity(symbol)
+            pm.value(symbol)
+
+        logging.getLogger(__name__).debug('Time elapsed for 20000 orders: ' + str(datetime.datetime.now() - now))
+
+        self.assertEqual(pm.symbols, set(symbols))
+        self.assertRaises(Exception, pm.add_order, o)
+
+        for s in symbols:
+            symbol_orders = [o for o in pm.orders if o.symbol == s]
+            self.assertEqual(pm.quantity(s), sum([o.quantity if o.order_type == Type.BUY else -o.quantity for o in symbol_orders]))
+            self.assertEqual(pm.value(s), symbol_orders[-1].last_cost_per_share)
+
+        self.assertEqual(pm.capital, pm.initial_capital + sum([o.cost if o.order_type == Type.SELL else -o.cost for o in pm.orders]))
+
+    def test_value_updates(self):
+        def portfolio(value_update_interval):
+            listeners = SyncListeners()
+
+            pm = PortfolioManager(listeners=listeners, initial_capital=10000, value_update_interval=value_update_interval)
+
+            for s in ['AAPL', 'IBM']:
+                o = MarketOrder(Type.BUY, s, 10)
+                o.add_position(10, 10)
+                o.fulfill_time = datetime.datetime.now()
+                listeners({'type': 'order_fulfilled', 'data': o})
+
+            updates = list()
+            listeners += lambda e: updates.append(pm.value(multiply_by_quantity=True)) if e['type'] == 'portfolio_value_update' else None
+
+            return listeners, pm, updates
+
+        index = pd.MultiIndex.from_product([pd.date_range('2017-01-01', periods=3, freq='min', name='timestamp'), ['AAPL', 'GOOG', 'IBM']], names=['timestamp', 'symbol'])
+        bars = pd.DataFrame({'close': np.arange(len(index), dtype=np.float64)}, index=index)
+
+        # bar DataFrames
+        listeners, pm, updates = portfolio(None)
+        listeners({'type': 'bar', 'data': bars})
+        listeners({'type': 'bar', 'data': bars.xs('GOOG', level='symbol', drop_level=False)})
+
+        self.assertEqual(updates, [{'AAPL': 60, 'IBM': 80}])
+
+        # tick batches
+        listeners({'type': 'level_1_tick_batch', 'data': pd.DataFrame({'symbol': ['IBM', 'AAPL', 'IBM', 'GOOG'], 'bid': [1.0, 2.0, 3.0, 4.0]})})
+
+        self.assertEqual(updates, [{'AAPL': 60, 'IBM': 80}, {'AAPL': 20, 'IBM': 30}])
+
+        # one update per timestamp
+        listeners, pm, updates = portfolio('timestamp')
+        for t, df in bars.groupby(level='timestamp'):
+            for s in ['AAPL', 'IBM']:
+                listeners({'type': 'bar', 'data': df.xs(s, level='symbol', drop_level=False)})
+
+        self.assertEqual(updates, [{'AAPL': 0, 'IBM': 20}, {'AAPL': 30, 'IBM': 50}])
+
+        pm.flush_value_update()
+        self.assertEqual(updates, [{'AAPL': 0, 'IBM': 20}, {'AAPL': 30, 'IBM': 50}, {'AAPL': 60, 'IBM': 80}])
+
+        # at most one update per interval
+        listeners, pm, updates = portfolio(datetime.timedelta(hours=1))
+        for i in range(1000):
+            listeners({'type': 'level_1_tick', 'data': {'symbol': 'AAPL', 'bid': i}})
+
+        self.assertEqual(updates, [{'AAPL': 0, 'IBM': 100}])
+
+        pm.flush_value_update()
+        self.assertEqual(updates, [{'AAPL': 0, 'IBM': 100}, {'AAPL': 9990, 'IBM': 100}])
+
+        # interval of the event timestamps
+        listeners, pm, updates = portfolio(datetime.timedelta(minutes=2))
+        for t, df in bars.groupby(level='timestamp'):
+            listeners({'type': 'bar', 'data': df})
+
+        self.assertEqual(updates, [{'AAPL': 0, 'IBM': 20}, {'AAPL': 60, 'IBM': 80}])
+
+        # the last update is fired at the end of the replay
+        listeners, pm, updates = portfolio('timestamp')
+        listeners += lambda e: listeners({'type': 'bar', 'data': e['bars']}) if e['type'] == 'bar_data' else None
+        DataReplayEvents(listeners, DataReplay().add_source([bars], 'bars'), 'bar_data').start()
+        self.assertEqual(updates, [{'AAPL': 0, 'IBM': 20}, {'AAPL': 30, 'IBM': 50}, {'AAPL': 60, 'IBM': 80}])
+
 
 if __name__ == '__main__':
     unittest.main()